@@ -10,11 +10,21 @@ from apps.models import App
 DEBUG_URL_REWRITE = False
 
 
+TRUSTED_DOMAINS = frozenset(settings.DOMAINS)
+
+# Memoized results of app_id_from_trusted_domain.
+HOSTNAME_CACHE = {}
+MAX_HOSTNAME_CACHE = 1000
+
+
 def app_id_from_trusted_domain(hostname):
     """
     Return the first subdomain part if the rest is listed in
     settings.DOMAINS (ignoring optional port numbers like :8080).
     """
+    if hostname in HOSTNAME_CACHE:
+        return HOSTNAME_CACHE[hostname]
+    app_id = None
     parts = hostname.split(':')[0].split('.')
     # Normalize App Engine deployment versions, e.g.
     # app_id.2010-05-12.latest.pageforest.appspot.com
@@ -23,8 +33,12 @@ def app_id_from_trusted_domain(hostname):
         parts[4] == 'appspot' and
         parts[5] == 'com'):
         parts[1] = 'version'
-    if '.'.join(parts[1:]) in settings.DOMAINS:
-        return parts[0]
+    if '.'.join(parts[1:]) in TRUSTED_DOMAINS:
+        app_id = parts[0]
+    if len(HOSTNAME_CACHE) >= MAX_HOSTNAME_CACHE:
+        HOSTNAME_CACHE.clear()
+    HOSTNAME_CACHE[hostname] = app_id
+    return app_id
 
 
 class AppMiddleware(object):
@@ -64,7 +78,9 @@ class AppMiddleware(object):
             request.app = App.create(app_id)
             request.app.cache_put()
 
-        if request.app is None:
+        if request.app is None or (request.app.deleted and
+                                   request.method != 'DELETE'):
+            # Tombstones are only visible to DELETE, for progress.
             return HttpResponseNotFound(
                 "Application not found for app: " + app_id)
 
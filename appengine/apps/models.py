@@ -32,6 +32,8 @@ class App(SuperDoc):
     are trusted. The default http://app_id.pageforest.com/ is always
     trusted, it does not need to be listed here.
     """
+    stats_name = 'apps'  # Count new entities for the dashboard.
+
     url = db.StringProperty()           # Canonical URL for this app.
     referers = db.StringListProperty()  # URL prefixes for referer check.
     cloneable = db.BooleanProperty(default=False)  # Opt-in to allow clones.
@@ -46,6 +48,8 @@ class App(SuperDoc):
     """
     current_schema = SuperDoc.current_schema + 2
 
+    view_methods = SuperDoc.view_methods + ('get_app_id', 'is_www')
+
     @classmethod
     def json_props(cls):
         props = super(App, cls).json_props()
@@ -96,12 +100,13 @@ class App(SuperDoc):
     @classmethod
     def lookup(cls, app_id):
         """
-        Lookup App by app_id (key name for model).
+        Lookup App by app_id (key name for model). The result may be
+        a CachedView if the app was found in memcache.
         """
         if app_id is None or app_id in settings.RESERVED_APPS:
             return None
 
-        app = cls.get_by_key_name(app_id)
+        app = cls.get_view_by_key_name(app_id)
         if app is None and app_id == 'www':
             # First invocation on an empty datastore, create www app.
             app = App(key_name='www', secret=crypto.random64(),
@@ -15,6 +15,7 @@ from blobs.models import Blob
 
 from apps.middleware import app_id_from_trusted_domain
 from utils.middleware import RequestMiddleware
+from utils import tasks
 
 TAG_REGEX = re.compile(r'<[/!\w][^>]*>')
 
@@ -53,6 +54,8 @@ class AppTestCase(TestCase):
     def setUp(self):
         # Reset the RequestMiddleware.
         RequestMiddleware.thread_local = None
+        # Drop tasks left over from other tests (settings.TASKS_LOCAL).
+        del tasks.LOCAL_TASKS[:]
         # Mock the datetime object.
         datetime.datetime = MockDatetime
         MockDatetime.reset_time()
@@ -201,7 +201,9 @@ def app_json_put(request):
 
 def app_json_delete(request):
     """
-    Delete the application.
+    Delete the application. The app is marked as deleted, and its
+    blobs are deleted in the background. Repeated DELETE requests
+    return the progress until the app is gone.
 
     Note that none of the user created documents are delete - they will be orphaned.
 
@@ -213,6 +215,10 @@ def app_json_delete(request):
     if not request.app.is_writable(request.user):
         return AccessDenied(request, "No write permission.")
 
+    if request.app.deleted:
+        return HttpJSONResponse(dict(statusText="Deleting",
+                                     **request.app.delete_status()))
     request.app.delete()
+    status = request.app.delete_status()
     request.app = None
-    return HttpJSONResponse({'statusText': "Deleted"})
+    return HttpJSONResponse(dict(statusText="Deleted", **status))
@@ -0,0 +1,67 @@
+"""
+Micro-benchmarks for authentication, run by "manage.py benchmark" (see
+settings.MICRO_BENCHMARKS).
+"""
+
+from utils.benchmark import time_calls, report
+
+from apps.models import App
+from auth import models
+from auth.models import User
+from auth.referers import RefererRules
+
+APP_ID = 'micro'
+
+
+def create_app(referers=None):
+    """
+    Create an app with these trusted referers.
+    """
+    app = App(key_name=APP_ID, url='http://%s.pageforest.com/' % APP_ID,
+              title="Micro", owner=APP_ID, referers=referers or [],
+              secret='micro_secret')
+    app.put()
+    return app
+
+
+def referers():
+    """
+    Compiled referer rules against a linear scan of 500 prefixes.
+    """
+    app = create_app(['http://site%d.example.com/' % index
+                      for index in range(500)])
+    referer = 'https://site499.example.com/index.html'
+
+    def linear():
+        for allowed in app.referers:
+            if referer.startswith(allowed) or \
+               referer.startswith(allowed.replace('http://', 'https://')):
+                return True
+        return False
+    rules = RefererRules.for_app(app)
+    baseline = time_calls(linear, 100)
+    compiled = time_calls(lambda: rules.check(referer), 100)
+    return [report('referer check with 500 prefixes', compiled, baseline)]
+
+
+def verify_session():
+    """
+    Per-request auth cost with and without the session cache.
+    """
+    user = User(key_name=APP_ID, username=APP_ID,
+                email='micro@example.com')
+    user.set_password('micro_secret')
+    user.put()
+    app = create_app()
+    session_key = user.generate_session_key(app)
+
+    def uncached():
+        models.SESSION_CACHE.clear()
+        User.verify_session_key(session_key, app)
+
+    def cached():
+        User.verify_session_key(session_key, app)
+    baseline = time_calls(uncached)
+    return [report('verify_session_key (uncached)', baseline),
+            report('verify_session_key (cached)', time_calls(cached),
+                   baseline)]
@@ -1,3 +1,5 @@
+from functools import wraps
+
 from django.http import HttpResponseForbidden
 
 from auth.middleware import AccessDenied
@@ -8,6 +10,7 @@ def login_required(func):
     View function decorator to check session key for valid signed in
     user account.
     """
+    @wraps(func)
     def wrapper(request, *args, **kwargs):
         if request.user is None:
             return AccessDenied(request)
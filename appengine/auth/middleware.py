@@ -1,14 +1,12 @@
 import logging
 
-from urlparse import urlparse
-
 from django.conf import settings
 from django.http import HttpResponseForbidden, HttpResponseNotAllowed, \
     HttpResponseRedirect
 
 from auth import SignatureError
 from auth.models import User
-from apps.middleware import app_id_from_trusted_domain
+from auth.referers import RefererRules
 
 READ_METHODS = ('GET', 'HEAD', 'LIST', 'SLICE')
 
@@ -27,7 +25,8 @@ class AccessDenied(HttpResponseForbidden):
 
 def referer_is_trusted(request):
     """
-    Check the referer for this request.
+    Check the referer for this request, using the compiled
+    RefererRules for the current version of the app.
     """
     if 'HTTP_REFERER' not in request.META:
         request.referer_error = "Missing Referer header."
@@ -39,30 +38,11 @@ def referer_is_trusted(request):
     if referer.count('/') < 2:
         request.referer_error = "Invalid Referer header."
         return False
-    (scheme, netloc, path, parameters, query, fragment) = urlparse(referer)
-    # Remove optional port number.
-    hostname = netloc.split(':')[0]
-    app_id = app_id_from_trusted_domain(hostname)
-    if app_id == 'www':
-        # Always trust the www front-end.
-        return True
-    if app_id in settings.APPS_WITH_MIRROR:
-        # Always trust editor.pageforest.com.
-        return True
-    if app_id == request.app.get_app_id():
-        # Don't trust user-generated documents under /docs/.
-        if path.startswith('/docs/'):
-            request.referer_error = "Untrusted Referer path: " + path
-            return False
-        # Trust the default domain for this app.
-        return True
-    for allowed_referer in request.app.referers:
-        if referer.startswith(allowed_referer) or \
-           referer.startswith(allowed_referer.replace('http://', 'https://')):
-            # Explicitly trusted by the app developer.
-            return True
-    request.referer_error = "Untrusted Referer domain: " + hostname
-    return False
+    error = RefererRules.for_app(request.app).check(referer)
+    if error is not None:
+        request.referer_error = error
+        return False
+    return True
 
 
 def check_permissions(request, resource, method_override=None):
@@ -70,8 +50,9 @@ def check_permissions(request, resource, method_override=None):
     Check read or write permissions for the current user.
     """
     method = method_override or request.method
+    acl = resource.get_acl()
     if method in READ_METHODS:
-        if 'public' not in resource.readers:
+        if not acl.public_read:
             # Skip referer check for initial HTML requests on
             # non-public applications.
             skip_referer_check = (
@@ -87,12 +68,12 @@ def check_permissions(request, resource, method_override=None):
             if not skip_referer_check:
                 if not referer_is_trusted(request):
                     return AccessDenied(request)
-        if not resource.is_readable(request.user):
+        if not acl.is_readable(request.user):
             return AccessDenied(request, "Read permission denied.")
     else:
         if not referer_is_trusted(request):
             return AccessDenied(request)
-        if not resource.is_writable(request.user):
+        if not acl.is_writable(request.user):
             return AccessDenied(request, "Write permission denied.")
 
 
@@ -186,7 +167,7 @@ class AuthMiddleware(object):
 
         # Redirect http://app_id.pageforest.com/ to sign-in if not public.
         if (request.path_info == '/app/'
-            and 'public' not in request.app.readers
+            and not request.app.get_acl().public_read
             and request.user is None
             and not hasattr(request, 'session_key_error')):
             return HttpResponseRedirect(
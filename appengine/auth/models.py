@@ -1,11 +1,13 @@
 import time
 import logging
 import re
+import hashlib
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
 
 from utils.mixins import Timestamped, Migratable, Cacheable
+from utils.mixins.cacheable import CachedView
 from utils.forms import ValidationError
 from utils import crypto
 from utils.shortcuts import dict_from_attrs
@@ -18,6 +20,14 @@ import settings
 CHALLENGE_EXPIRATION = 60  # Seconds.
 CHALLENGE_CACHE_PREFIX = 'CR1~'
 
+# Verified session keys in this process:
+# digest => (username, user protobuf, valid until)
+SESSION_CACHE = {}
+MAX_SESSION_CACHE = 1000
+# Other instances don't see password changes in this process, so
+# limit how long a verified session key is trusted without checking.
+SESSION_CACHE_SECONDS = 60
+
 # From Djano forms.fields
 email_match = re.compile(
     r"(^[-!#$%&'*+/=?^_`{}|~0-9A-Z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Z]+)*"
@@ -33,6 +43,8 @@ class User(db.Expando, Timestamped, Migratable, Cacheable):
     The entity key name is username.lower() for case-insensitive matching.
     The password is hmac_sha1(key=raw_password, message=username.lower()).
     """
+    stats_name = 'users'  # Count new entities for the dashboard.
+
     username = db.StringProperty(required=True)  # May include capital letters.
     password = db.StringProperty()
     last_login = db.DateTimeProperty(auto_now_add=True)
@@ -43,6 +55,8 @@ class User(db.Expando, Timestamped, Migratable, Cacheable):
 
     current_schema = 2
 
+    view_methods = Cacheable.view_methods + ('get_username', )
+
     def migrate(self):
         if self.schema < 2:
             self.max_apps = settings.MAX_APPS
@@ -69,15 +83,37 @@ class User(db.Expando, Timestamped, Migratable, Cacheable):
     def put(self):
         self.validate()
         super(User, self).put()
+        self.forget_sessions(self.get_username())
+
+    @classmethod
+    def forget_sessions(cls, username):
+        """
+        Remove verified session keys for this user from the cache,
+        e.g. because the password may have changed.
+        """
+        for digest, entry in SESSION_CACHE.items():
+            if entry[0] == username:
+                del SESSION_CACHE[digest]
+
+    @classmethod
+    def session_cache_key(cls, session_key, app, subdomain=None):
+        """
+        Digest of the session key, subdomain, app and app secret. A
+        new app secret makes old digests unreachable.
+        """
+        return hashlib.sha1(crypto.join(
+                session_key, subdomain or '', app.get_app_id(),
+                app.secret)).digest()
 
     @classmethod
     def lookup(cls, username):
         """
         Prefer this accessor over direct calls to get_by_key_name.
+        The result may be a CachedView if the user was found in memcache.
         """
         if username is None:
             return None
-        return cls.get_by_key_name(username.lower())
+        return cls.get_view_by_key_name(username.lower())
 
     # REVIEW: This is confusing because I would expect to get the
     # username, not the username converted to lowercase. Can we
@@ -171,7 +207,19 @@ class User(db.Expando, Timestamped, Migratable, Cacheable):
         """
         Verify the session key and return the user object. If the
         session key is invalid, raise SignatureError with explanation.
+
+        Verified session keys are cached in this process, to skip the
+        HMAC and the User lookup for the next request with the same
+        cookie.
         """
+        now = time.time()
+        digest = cls.session_cache_key(session_key, app, subdomain)
+        entry = SESSION_CACHE.get(digest)
+        if entry is not None:
+            (username, binary, valid_until) = entry
+            if now < valid_until:
+                return CachedView(cls, binary)
+            del SESSION_CACHE[digest]
         parts = crypto.split(session_key)
         if len(parts) != 4:
             raise SignatureError("Expected 4 parts.")
@@ -202,6 +250,10 @@ class User(db.Expando, Timestamped, Migratable, Cacheable):
         secret = crypto.join(user.password, app.secret)
         if not crypto.verify(session_key, secret):
             raise SignatureError("Password incorrect.")
+        if len(SESSION_CACHE) >= MAX_SESSION_CACHE:
+            SESSION_CACHE.clear()
+        SESSION_CACHE[digest] = (user.get_username(), user.to_protobuf(),
+                                 min(expires, now + SESSION_CACHE_SECONDS))
         return user
 
     @classmethod
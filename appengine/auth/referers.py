@@ -0,0 +1,137 @@
+import re
+
+from django.conf import settings
+
+from apps.middleware import app_id_from_trusted_domain
+
+# Compiled referer rules, keyed by (app_id, sha1).
+RULES_CACHE = {}
+MAX_RULES_CACHE = 1000
+
+# Split an absolute URL into hostname (without port) and path, like
+# urlparse but without building the other parts.
+URL_REGEX = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#:]*)[^/?#]*([^?#;]*)')
+
+
+class PrefixTrie(object):
+    """
+    Character trie to check if a string starts with any of a set of
+    prefixes, in time proportional to the length of the match instead
+    of the number of prefixes.
+
+    >>> trie = PrefixTrie(['http://a.com/', 'http://b.com/x'])
+    >>> trie.matches('http://a.com/index.html')
+    True
+    >>> trie.matches('http://b.com/y')
+    False
+    >>> trie.matches('http://b.com/x/y')
+    True
+    >>> PrefixTrie([]).matches('http://a.com/')
+    False
+    """
+    TERMINAL = None
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self.TERMINAL] = True
+
+    def matches(self, text):
+        node = self.root
+        if self.TERMINAL in node:
+            return True
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return False
+            if self.TERMINAL in node:
+                return True
+        return False
+
+
+def split_referer(referer):
+    """
+    Return (hostname, path) of the referer URL.
+
+    >>> split_referer('http://myapp.pageforest.com:8080/docs/x?y=1')
+    ('myapp.pageforest.com', '/docs/x')
+    >>> split_referer('https://trusted.com')
+    ('trusted.com', '')
+    >>> split_referer('trusted.com/foo/')
+    ('', 'trusted.com/foo/')
+    """
+    match = URL_REGEX.match(referer)
+    if match is None:
+        return '', referer.split('?')[0].split('#')[0]
+    return match.group(1), match.group(2)
+
+
+class RefererRules(object):
+    """
+    Referer check for one version of an App, compiled once:
+
+    * The www front-end and apps in settings.APPS_WITH_MIRROR are
+      always trusted.
+    * The default domain of the app is trusted, except for
+      user-generated documents under /docs/.
+    * URL prefixes in app.referers are compiled into a PrefixTrie,
+      with https variants for http prefixes.
+    """
+
+    def __init__(self, app_id, referers):
+        self.app_id = app_id
+        self.trusted_apps = frozenset(['www'] + list(settings.APPS_WITH_MIRROR))
+        prefixes = []
+        for referer in referers:
+            prefixes.append(referer)
+            prefixes.append(referer.replace('http://', 'https://'))
+        self.trie = PrefixTrie(prefixes)
+
+    @classmethod
+    def for_app(cls, app):
+        """
+        Get the compiled rules for this App, from the process cache
+        if possible.
+        """
+        app_id = app.get_app_id()
+        if app.sha1 is None:
+            return cls(app_id, app.referers)
+        cache_key = (app_id, app.sha1)
+        rules = RULES_CACHE.get(cache_key)
+        if rules is None:
+            rules = cls(app_id, app.referers)
+            if len(RULES_CACHE) >= MAX_RULES_CACHE:
+                RULES_CACHE.clear()
+            RULES_CACHE[cache_key] = rules
+        return rules
+
+    def check(self, referer):
+        """
+        Return None if the referer is trusted, or an error message.
+        """
+        hostname, path = split_referer(referer)
+        app_id = app_id_from_trusted_domain(hostname)
+        if app_id in self.trusted_apps:
+            # Always trust www and editor.pageforest.com.
+            return None
+        if app_id == self.app_id:
+            # Don't trust user-generated documents under /docs/.
+            if path.startswith('/docs/'):
+                return "Untrusted Referer path: " + path
+            # Trust the default domain for this app.
+            return None
+        if self.trie.matches(referer):
+            # Explicitly trusted by the app developer.
+            return None
+        return "Untrusted Referer domain: " + hostname
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
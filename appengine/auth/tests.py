@@ -1,6 +1,7 @@
 import re
 import time
 import logging
+import doctest
 from mock import Mock
 
 from django.conf import settings
@@ -9,7 +10,10 @@ from django.utils import simplejson as json
 
 from google.appengine.api import mail
 
+from auth import models
 from auth.models import User
+from auth import referers
+from auth.referers import RefererRules
 
 from apps.tests import AppTestCase
 from utils import crypto
@@ -545,6 +549,56 @@ class SimpleAuthTest(AppTestCase):
         self.assertContains(response, "Password incorrect.", status_code=403)
 
 
+class SessionCacheTest(AppTestCase):
+
+    def setUp(self):
+        super(SessionCacheTest, self).setUp()
+        self.session_key = self.peter.generate_session_key(self.app)
+        models.SESSION_CACHE.clear()
+
+    def test_cache_hit(self):
+        """A verified session key should be cached in this process."""
+        user = User.verify_session_key(self.session_key, self.app)
+        self.assertEqual(user.get_username(), 'peter')
+        self.assertEqual(len(models.SESSION_CACHE), 1)
+        lookup = User.lookup
+        User.lookup = Mock(side_effect=AssertionError("User.lookup"))
+        try:
+            user = User.verify_session_key(self.session_key, self.app)
+        finally:
+            User.lookup = lookup
+        self.assertEqual(user.get_username(), 'peter')
+        self.assertEqual(user.password, self.peter.password)
+
+    def test_invalid_not_cached(self):
+        """Rejected session keys should not be cached."""
+        self.assertRaises(models.SignatureError, User.verify_session_key,
+                          self.session_key[:-1], self.app)
+        self.assertEqual(len(models.SESSION_CACHE), 0)
+
+    def test_subdomain(self):
+        """The subdomain is part of the cache key."""
+        User.verify_session_key(self.session_key, self.app)
+        self.assertRaises(models.SignatureError, User.verify_session_key,
+                          self.session_key, self.app, 'other')
+
+    def test_password_change(self):
+        """Changing the password should invalidate cached sessions."""
+        User.verify_session_key(self.session_key, self.app)
+        self.peter.set_password('new_secret')
+        self.peter.put()
+        self.assertEqual(len(models.SESSION_CACHE), 0)
+        self.assertRaises(models.SignatureError, User.verify_session_key,
+                          self.session_key, self.app)
+
+    def test_app_secret_change(self):
+        """A new app secret should invalidate cached sessions."""
+        User.verify_session_key(self.session_key, self.app)
+        self.app.secret = crypto.random64()
+        self.assertRaises(models.SignatureError, User.verify_session_key,
+                          self.session_key, self.app)
+
+
 class AnonymousTest(AppTestCase):
     """
     Anonymous user (without session key) should have limited access.
@@ -639,6 +693,45 @@ class AppCreatorTest(AppTestCase):
         self.assertContains(response, '3 apps', status_code=403)
 
 
+class RefererRulesTest(AppTestCase):
+
+    def test_doctest(self):
+        """Run doctest on the referers module."""
+        (failures, tests) = doctest.testmod(referers)
+        self.assertEqual(failures, 0)
+
+    def test_check(self):
+        """Compiled rules should match the referer check."""
+        rules = RefererRules.for_app(self.app)
+        self.assertTrue(RefererRules.for_app(self.app) is rules)
+        for referer in ['http://www.pageforest.com/',
+                        'http://editor.pageforest.com/x',
+                        'http://myapp.pageforest.com:8080/index.html',
+                        'http://trusted.com',
+                        'https://trusted.com/foo']:
+            self.assertEqual(rules.check(referer), None)
+        self.assertEqual(rules.check('http://myapp.pageforest.com/docs/x'),
+                         "Untrusted Referer path: /docs/x")
+        self.assertEqual(rules.check('http://evil.com/'),
+                         "Untrusted Referer domain: evil.com")
+        # A new version of the app gets new rules.
+        self.app.referers = ['http://evil.com/']
+        self.app.put()
+        rules = RefererRules.for_app(self.app)
+        self.assertEqual(rules.check('http://evil.com/'), None)
+
+    def test_many_referers(self):
+        """Compiled rules should agree with a linear scan of prefixes."""
+        self.app.referers = ['http://site%d.example.com/' % index
+                             for index in range(500)]
+        self.app.put()
+        rules = RefererRules.for_app(self.app)
+        self.assertEqual(
+            rules.check('https://site499.example.com/index.html'), None)
+        self.assertEqual(rules.check('http://site500.example.com/'),
+                         "Untrusted Referer domain: site500.example.com")
+
+
 class CookieTest(AppTestCase):
     resources = {
         '/': (200, '<html>'),
@@ -0,0 +1,33 @@
+"""
+Micro-benchmarks for backups, run by "manage.py benchmark" (see
+settings.MICRO_BENCHMARKS).
+"""
+
+import time
+
+from utils import tasks
+from utils.benchmark import report
+
+from blobs.models import Blob
+from backups import pipeline, restore
+
+
+def restore_throughput():
+    """
+    Restore time per entity with the local datastore.
+    """
+    for index in range(200):
+        blob = Blob(key_name='apps/micro/more%03d.txt/' % index,
+                    value='%03d' % index)
+        blob.tags.append('pf:backup')
+        blob.put()
+    run = pipeline.start_run(Blob)
+    tasks.run_local_tasks()
+    keys = list(Blob.all(keys_only=True).filter('tags', 'pf:backup'))
+    Blob.delete_keys(keys)
+    tasks.run_local_tasks()
+    start = time.time()
+    restore.start_restore(run.key().name(), '')
+    tasks.run_local_tasks()
+    seconds = time.time() - start
+    return [report("restore per entity", seconds / len(keys))]
@@ -6,9 +6,74 @@ from utils.mixins import Migratable, Timestamped
 class Backup(Migratable, Timestamped):
     """
     Save recently modified entities from datastore to a zip file.
+
+    Each Backup is one part of a BackupRun, with the key name
+    run-shard-part.zip. Older backups have no run.
     """
     model = db.StringProperty()       # Model kind of entities, e.g. User.
     keys = db.StringListProperty()    # All key names in this backup.
     oldest = db.DateTimeProperty()    # When the oldest entity was modified.
     youngest = db.DateTimeProperty()  # When the youngest entity was modified.
     zipfile = db.BlobProperty()       # Binary storage for zip file.
+    run = db.StringProperty()         # Key name of the BackupRun.
+    shard = db.IntegerProperty()
+    part = db.IntegerProperty()
+    chunks = db.StringListProperty()  # Values stored as Chunk references.
+
+
+class BackupValue(db.Model):
+    """
+    Index of values in backup archives, so that each value is stored
+    only once across all backups. The key name is the sha1 of the
+    value, and the zip archive stores it with that filename.
+    """
+    backup = db.StringProperty()      # Key name of the Backup part.
+
+
+class BackupRun(Timestamped):
+    """
+    Incremental backup of all entities of one model kind that were
+    modified in the time range oldest <= modified < youngest. The
+    range is split into shards that are backed up in parallel.
+    """
+    model = db.StringProperty()
+    oldest = db.DateTimeProperty()
+    youngest = db.DateTimeProperty()
+    shards = db.IntegerProperty()
+    done = db.BooleanProperty(default=False)
+
+    def shard_keys(self):
+        return [db.Key.from_path('BackupShard',
+                                 '%s-%d' % (self.key().name(), shard))
+                for shard in range(self.shards)]
+
+
+class BackupShard(Timestamped):
+    """
+    Progress of one shard of a BackupRun, saved after each part.
+    The key name is run-shard.
+    """
+    run = db.StringProperty()
+    model = db.StringProperty()
+    shard = db.IntegerProperty()
+    oldest = db.DateTimeProperty()
+    youngest = db.DateTimeProperty()
+    cursor = db.TextProperty()        # Query cursor after the last part.
+    parts = db.IntegerProperty(default=0)
+    entities = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+
+
+class BackupRestore(Timestamped):
+    """
+    Progress of restoring the parts of a BackupRun, saved after each
+    part. The key name is the run, a slash, and the key name prefix
+    of the entities to restore (empty for all).
+    """
+    run = db.StringProperty()
+    prefix = db.StringProperty(default='')
+    cursor = db.TextProperty()        # Query cursor after the last part.
+    parts = db.IntegerProperty(default=0)
+    restored = db.IntegerProperty(default=0)
+    skipped = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
@@ -0,0 +1,316 @@
+"""
+Streaming incremental backups in multi-part archives.
+
+A BackupRun covers all entities of one model kind that were modified
+since the previous run. The datastore allows inequality filters on
+one property only, so the run is split into shards by ranges of the
+modified timestamp, and each shard is backed up by a chain of tasks.
+
+Each task streams entities by query cursor into zip archive parts of
+less than 1 MB, and saves the cursor after each part. An interrupted
+task resumes after the last saved part, and writes the next part
+with the same key name again.
+
+Archives are content-addressed. The MANIFEST_FILENAME in each part
+maps key names to the sha1 and metadata of each entity. Values are
+stored in the zip archive with the sha1 as filename, unless the
+BackupValue index shows that an earlier part already has them. Large
+Blob values are not copied at all: the part counts a reference to
+keep their Chunk.
+"""
+
+import time
+import hashlib
+import zipfile
+import logging
+from StringIO import StringIO
+from datetime import datetime, timedelta
+
+from django.utils import simplejson as json
+
+from google.appengine.ext import db
+
+from utils import tasks
+
+from auth.models import User
+from apps.models import App
+from docs.models import Doc
+from blobs.models import Blob
+from chunks.models import Chunk
+from backups.models import Backup, BackupRun, BackupShard, BackupValue
+
+MODELS = dict([(model.kind(), model) for model in (User, App, Doc, Blob)])
+SHARDS = 4
+RUN_SECONDS = 20
+PAGE_SIZE = 100
+MAX_ZIPFILE_BYTES = 900 * 1024  # Datastore requests must be less than 1 MB.
+# Zip headers, manifest and key name properties for each entity.
+ENTRY_OVERHEAD = 150
+# Entities modified less than this long ago are left for the next run,
+# because a slower request may still save an earlier timestamp.
+BACKUP_LAG = timedelta(minutes=1)
+FIRST_BACKUP = datetime(2010, 1, 1)
+MANIFEST_FILENAME = 'pageforest-manifest.json'
+
+
+def get_serializer(model):
+    """
+    Blobs are backed up as their value (Blob.to_backup). Other models
+    are backed up as protocol buffers, so that all properties can be
+    restored.
+    """
+    if hasattr(model, 'to_backup'):
+        return model.to_backup
+    return model.to_protobuf
+
+
+def backup_query(model, oldest, youngest, cursor=None):
+    """
+    Entities that were modified in the time range, in order.
+    """
+    query = model.all()
+    # We don't backup user blobs - just application blobs (marked for backup)
+    if model.kind() == 'Blob':
+        query.filter('tags', 'pf:backup')
+    query.filter('modified >=', oldest)
+    query.filter('modified <', youngest)
+    query.order('modified')
+    if cursor:
+        query.with_cursor(cursor)
+    return query
+
+
+def stored_values(sha1_list, key_name):
+    """
+    The sha1s of values that are stored in backup parts other than
+    key_name. A part that is written again must store its values
+    again.
+    """
+    keys = [db.Key.from_path('BackupValue', sha1) for sha1 in set(sha1_list)]
+    return set([value.key().name() for value in db.get(keys)
+                if value is not None and value.backup != key_name])
+
+
+class PartWriter(object):
+    """
+    Zip archive for one Backup part, built in memory.
+    """
+
+    def __init__(self, shard):
+        self.serialize = get_serializer(MODELS[shard.model])
+        self.temp = StringIO()
+        self.archive = zipfile.ZipFile(self.temp, 'w', zipfile.ZIP_DEFLATED)
+        self.overhead = 0
+        self.manifest = {}
+        self.values = []
+        self.backup = Backup(
+            key_name='%s-%d.zip' % (shard.key().name(), shard.parts),
+            model=shard.model,
+            run=shard.run,
+            shard=shard.shard,
+            part=shard.parts,
+            oldest=datetime(2100, 1, 1),
+            youngest=datetime(2000, 1, 1))
+
+    def is_empty(self):
+        return not self.backup.keys
+
+    def prepare(self, entities):
+        """
+        Serialize entities for this part, as (entity, sha1, size, data)
+        where data is None if the value doesn't need to be stored.
+        """
+        entries = []
+        for entity in entities:
+            if entity.kind() == 'Blob' and entity.chunk_reference():
+                entries.append((entity, entity.sha1, entity.size, None))
+                continue
+            data = self.serialize(entity)
+            if entity.kind() == 'Blob':
+                sha1 = entity.sha1
+            else:
+                sha1 = hashlib.sha1(data).hexdigest()
+            entries.append((entity, sha1, len(data), data))
+        stored = stored_values([entry[1] for entry in entries],
+                               self.backup.key().name())
+        stored.update(self.values)
+        result = []
+        for entity, sha1, size, data in entries:
+            if sha1 in stored:
+                data = None
+            stored.add(sha1)
+            result.append((entity, sha1, size, data))
+        return result
+
+    def add(self, entity, sha1, size, data):
+        """
+        Add an entity to the archive, and return True. Return False
+        without adding it if the part would be too large.
+        """
+        key_name = entity.key().name()
+        overhead = 2 * len(key_name) + len(sha1) + ENTRY_OVERHEAD
+        part_size = (self.temp.tell() + self.overhead + overhead +
+                     len(data or ''))
+        if part_size > MAX_ZIPFILE_BYTES:
+            return False
+        chunk = entity.kind() == 'Blob' and entity.chunk_reference()
+        if chunk:
+            self.backup.chunks.append(chunk)
+        elif data is not None:
+            info = zipfile.ZipInfo(filename=sha1,
+                                   date_time=entity.modified.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data)
+            self.values.append(sha1)
+        self.manifest[key_name] = {
+            'sha1': sha1,
+            'size': size,
+            'modified': entity.modified.isoformat(),
+            'tags': getattr(entity, 'tags', []),
+            'chunk': bool(chunk),
+            }
+        if entity.kind() == 'Blob':
+            self.manifest[key_name]['valid_json'] = entity.valid_json
+            self.manifest[key_name]['content_type'] = entity.content_type
+        self.overhead += overhead
+        self.backup.keys.append(key_name)
+        self.backup.oldest = min(self.backup.oldest, entity.modified)
+        self.backup.youngest = max(self.backup.youngest, entity.modified)
+        return True
+
+    def finish(self):
+        """
+        Close the archive and return the Backup entity.
+        """
+        self.archive.writestr(MANIFEST_FILENAME,
+                              json.dumps(self.manifest, sort_keys=True))
+        self.archive.close()
+        self.backup.zipfile = self.temp.getvalue()
+        self.backup.chunks = sorted(set(self.backup.chunks))
+        self.temp.close()
+        return self.backup
+
+
+def latest_run(kind):
+    return BackupRun.all().filter('model', kind).order('-youngest').get()
+
+
+def start_run(model):
+    """
+    Start backing up entities of this model that were modified since
+    the previous run, unless that run is still in progress. Return
+    the latest run.
+    """
+    kind = model.kind()
+    previous = latest_run(kind)
+    if previous is not None and not previous.done:
+        return previous
+    if previous is not None:
+        oldest = previous.youngest
+    else:
+        # Continue after single-part backups from before runs.
+        query = Backup.all().filter('model', kind).order('-youngest')
+        fetched = query.fetch(1)
+        if fetched:
+            oldest = fetched[0].youngest + timedelta(microseconds=1)
+        else:
+            oldest = FIRST_BACKUP
+    youngest = datetime.now() - BACKUP_LAG
+    if youngest <= oldest:
+        return previous
+    run = BackupRun(
+        key_name='%ss-%s' % (kind.lower(), youngest.strftime('%y%m%d-%H%M%S')),
+        model=kind, oldest=oldest, youngest=youngest, shards=SHARDS)
+    run.put()
+    step = (youngest - oldest) / SHARDS
+    for index, key in enumerate(run.shard_keys()):
+        shard = BackupShard(
+            key_name=key.name(),
+            run=run.key().name(),
+            model=kind,
+            shard=index,
+            oldest=oldest + step * index,
+            youngest=youngest)
+        if index < SHARDS - 1:
+            shard.youngest = oldest + step * (index + 1)
+        shard.put()
+        tasks.defer(backup_shard, key.name())
+    return run
+
+
+def backup_shard(key_name):
+    """
+    Task: write the next parts of one shard until RUN_SECONDS have
+    passed, then add a task to continue.
+    """
+    shard = BackupShard.get_by_key_name(key_name)
+    if shard is None or shard.done:
+        return
+    model = MODELS[shard.model]
+    deadline = time.time() + RUN_SECONDS
+    cursor = shard.cursor
+    part = PartWriter(shard)
+    while True:
+        query = backup_query(model, shard.oldest, shard.youngest, cursor)
+        entities = query.fetch(PAGE_SIZE)
+        added = 0
+        for entry in part.prepare(entities):
+            if not part.add(*entry):
+                break
+            added += 1
+        if added == len(entities):
+            cursor = query.cursor()
+        else:
+            if added == 0 and part.is_empty():
+                logging.error("Too large for backup: %s" %
+                              entities[0].key().name())
+                added = 1
+            # Find the cursor after the entities in this part.
+            query = backup_query(model, shard.oldest, shard.youngest, cursor)
+            query.fetch(added)
+            cursor = query.cursor()
+        finished = len(entities) < PAGE_SIZE and added == len(entities)
+        if not finished and added == len(entities) and \
+                time.time() < deadline:
+            continue
+        save_part(shard, part, cursor)
+        if finished:
+            finish_shard(shard)
+            return
+        if time.time() >= deadline:
+            tasks.defer(backup_shard, key_name)
+            return
+        part = PartWriter(shard)
+
+
+def save_part(shard, part, cursor):
+    """
+    Save a part and the index of its values, then the shard cursor
+    after it.
+    """
+    if not part.is_empty():
+        backup = part.finish()
+        for sha1 in backup.chunks:
+            Chunk.add_reference(sha1)
+        backup.put()
+        db.put([BackupValue(key_name=sha1, backup=backup.key().name())
+                for sha1 in part.values])
+        shard.parts += 1
+        shard.entities += len(backup.keys)
+    shard.cursor = cursor
+    shard.put()
+
+
+def finish_shard(shard):
+    """
+    Mark the shard as done, and the run when all shards are done.
+    """
+    shard.done = True
+    shard.put()
+    run = BackupRun.get_by_key_name(shard.run)
+    for other in db.get(run.shard_keys()):
+        if other is None or not other.done:
+            return
+    run.done = True
+    run.put()
+    logging.info("Finished backup run %s" % run.key().name())
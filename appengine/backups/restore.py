@@ -0,0 +1,247 @@
+"""
+Restore entities from backup runs.
+
+A restore reads the parts of one BackupRun in key order, and saves
+the entities of each part with batch puts. Values are read from the
+part itself, from the earlier part named in the BackupValue index,
+or from the Chunk store for large Blob values, which are never copied
+again. Entities that already have the backed up version are skipped,
+so a restore can be repeated, and the cursor is saved after every
+part, so a chain of tasks continues where the last task stopped.
+
+To rebuild the latest state, restore runs from oldest to newest.
+"""
+
+import time
+import zipfile
+import logging
+from StringIO import StringIO
+from datetime import datetime
+
+from django.utils import simplejson as json
+
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+from utils import tasks
+
+from blobs.models import Blob, NOT_LOADED, update_references
+from chunks.models import Chunk
+from backups.models import Backup, BackupRestore
+from backups.pipeline import MODELS, MANIFEST_FILENAME
+
+RUN_SECONDS = 20
+PUT_BATCH_SIZE = 200
+# Zip archives of other parts to keep open in each task.
+MAX_ARCHIVES = 10
+
+
+def parse_datetime(text):
+    """
+    Parse the output of datetime.isoformat.
+
+    >>> parse_datetime('2010-11-12T13:14:15.000123')
+    datetime.datetime(2010, 11, 12, 13, 14, 15, 123)
+    >>> parse_datetime('2010-11-12T13:14:15')
+    datetime.datetime(2010, 11, 12, 13, 14, 15)
+    """
+    seconds, dot, fraction = text.partition('.')
+    result = datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        result = result.replace(microsecond=int(fraction))
+    return result
+
+
+class ValueReader(object):
+    """
+    Read values from backup parts, and keep the zip archives that
+    were opened in this task.
+    """
+
+    def __init__(self):
+        self.archives = {}
+
+    def open(self, backup):
+        key_name = backup.key().name()
+        if key_name not in self.archives:
+            if len(self.archives) >= MAX_ARCHIVES:
+                self.archives.clear()
+            self.archives[key_name] = zipfile.ZipFile(
+                StringIO(backup.zipfile))
+        return self.archives[key_name]
+
+    def read(self, archive, sha1_list):
+        """
+        Return a dict of values by sha1. Values that are not in this
+        archive are found with the BackupValue index.
+        """
+        names = set(archive.namelist())
+        result = {}
+        missing = []
+        for sha1 in set(sha1_list):
+            if sha1 in names:
+                result[sha1] = archive.read(sha1)
+            else:
+                missing.append(sha1)
+        if not missing:
+            return result
+        locations = db.get([db.Key.from_path('BackupValue', sha1)
+                            for sha1 in missing])
+        part_names = set([location.backup for location in locations
+                          if location is not None])
+        part_names = [name for name in part_names
+                      if name not in self.archives]
+        for backup in Backup.get_by_key_name(part_names):
+            if backup is not None:
+                self.open(backup)
+        for sha1, location in zip(missing, locations):
+            if location is None or location.backup not in self.archives:
+                logging.error("Backup value not found: %s" % sha1)
+                continue
+            result[sha1] = self.archives[location.backup].read(sha1)
+        return result
+
+
+def restore_blob(key_name, entry, value, stored=NOT_LOADED):
+    """
+    Create a Blob from its manifest entry and value. Large values
+    are restored as references to their Chunk. The stored version of
+    the Blob (or None) can be passed if it was already loaded.
+    """
+    if entry['chunk']:
+        if not Chunk.exists(entry['sha1']):
+            logging.error("Backup chunk not found: %s (%s)" %
+                          (key_name, entry['sha1']))
+        blob = Blob(key_name=key_name,
+                    sha1=entry['sha1'],
+                    size=entry['size'],
+                    valid_json=entry.get('valid_json'),
+                    content_type=entry.get('content_type'),
+                    stored=stored)
+        if blob.content_type is None:
+            # Older backups: compute it from the Chunk on the next read.
+            blob.schema = 3
+    else:
+        blob = Blob(key_name=key_name, value=value, stored=stored)
+    blob.tags = entry['tags']
+    blob.modified = parse_datetime(entry['modified'])
+    return blob
+
+
+def is_restored(entity, kind, entry):
+    """
+    Check if the stored entity is already the backed up version.
+    """
+    if entity is None:
+        return False
+    if entity.modified != parse_datetime(entry['modified']):
+        return False
+    return kind != 'Blob' or entity.sha1 == entry['sha1']
+
+
+def restore_part(backup, reader, prefix=''):
+    """
+    Save the entities of one backup part with batch puts. Return the
+    number of restored and skipped entities.
+    """
+    archive = reader.open(backup)
+    manifest = json.loads(archive.read(MANIFEST_FILENAME))
+    kind = backup.model
+    model = MODELS[kind]
+    key_names = [key_name for key_name in sorted(manifest.keys())
+                 if key_name.startswith(prefix)]
+    restored = skipped = 0
+    for start in range(0, len(key_names), PUT_BATCH_SIZE):
+        batch = key_names[start:start + PUT_BATCH_SIZE]
+        stored = db.get([db.Key.from_path(kind, key_name)
+                         for key_name in batch])
+        todo = []
+        for key_name, entity in zip(batch, stored):
+            if is_restored(entity, kind, manifest[key_name]):
+                skipped += 1
+            else:
+                todo.append((key_name, entity))
+        values = reader.read(archive, [manifest[key_name]['sha1']
+                                       for key_name, entity in todo
+                                       if not manifest[key_name]['chunk']])
+        entities = []
+        for key_name, old in todo:
+            entry = manifest[key_name]
+            value = values.get(entry['sha1'])
+            if value is None and not entry['chunk']:
+                continue
+            if kind == 'Blob':
+                entities.append(restore_blob(key_name, entry, value, old))
+            else:
+                entities.append(model.from_protobuf(value))
+        db.put(entities)
+        cache_keys = []
+        for entity in entities:
+            cache_keys.extend(model.class_get_cache_keys(entity.key().name()))
+        memcache.delete_multi(cache_keys)
+        if kind == 'Blob':
+            for entity in entities:
+                update_references(entity.stored_chunk(),
+                                  entity.chunk_reference())
+        restored += len(entities)
+    return restored, skipped
+
+
+def start_restore(run_key_name, prefix=''):
+    """
+    Start restoring a backup run, unless the same restore is still in
+    progress. Return the restore state.
+    """
+    key_name = '%s/%s' % (run_key_name, prefix)
+    restore = BackupRestore.get_by_key_name(key_name)
+    if restore is None or restore.done:
+        restore = BackupRestore(key_name=key_name, run=run_key_name,
+                                prefix=prefix)
+        restore.put()
+        tasks.defer(restore_task, key_name)
+    return restore
+
+
+def restore_task(key_name):
+    """
+    Task: restore the next parts until RUN_SECONDS have passed, then
+    add a task to continue.
+    """
+    restore = BackupRestore.get_by_key_name(key_name)
+    if restore is None or restore.done:
+        return
+    if not continue_restore(restore, RUN_SECONDS):
+        tasks.defer(restore_task, key_name)
+
+
+def continue_restore(restore, seconds):
+    """
+    Restore one part at a time until the deadline, and save the
+    progress after each part. Return True when all parts are done.
+    """
+    deadline = time.time() + seconds
+    reader = ValueReader()
+    while True:
+        query = Backup.all().filter('run', restore.run).order('__key__')
+        if restore.cursor:
+            query.with_cursor(restore.cursor)
+        backups = query.fetch(1)
+        if not backups:
+            restore.done = True
+            restore.put()
+            logging.info("Restored %d entities from %s" %
+                         (restore.restored, restore.run))
+            return True
+        restored, skipped = restore_part(backups[0], reader, restore.prefix)
+        restore.cursor = query.cursor()
+        restore.parts += 1
+        restore.restored += restored
+        restore.skipped += skipped
+        restore.put()
+        if time.time() >= deadline:
+            return False
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,256 @@
+import doctest
+import zipfile
+from StringIO import StringIO
+
+from django.utils import simplejson as json
+
+from apps.tests import AppTestCase
+from utils import tasks
+
+from docs.models import Doc
+from blobs.models import Blob, MAX_INTERNAL_SIZE
+from chunks.models import Chunk
+from backups.models import Backup, BackupRun, BackupShard, BackupValue, \
+    BackupRestore
+from backups import pipeline, restore
+
+
+class BackupTestCase(AppTestCase):
+    """
+    Reusable TestCase with 20 blobs tagged for backup, and tasks
+    running in-process.
+    """
+
+    def setUp(self):
+        super(BackupTestCase, self).setUp()
+        self.max_zipfile_bytes = pipeline.MAX_ZIPFILE_BYTES
+        self.run_seconds = pipeline.RUN_SECONDS
+        for index in range(20):
+            blob = Blob(key_name='apps/myapp/file%02d.txt/' % index,
+                        value=('%02d' % index) * 200)
+            blob.tags.append('pf:backup')
+            blob.put()
+
+    def tearDown(self):
+        pipeline.MAX_ZIPFILE_BYTES = self.max_zipfile_bytes
+        pipeline.RUN_SECONDS = self.run_seconds
+        super(BackupTestCase, self).tearDown()
+
+    def backup(self, model=Blob):
+        """Run a backup of all entities of this model."""
+        run = pipeline.start_run(model)
+        tasks.run_local_tasks()
+        run = BackupRun.get_by_key_name(run.key().name())
+        self.assertTrue(run.done)
+        return run
+
+    def backup_blobs(self):
+        """Run a backup, return the values and the manifest."""
+        run = self.backup()
+        values = {}
+        manifest = {}
+        for backup in Backup.all().filter('run', run.key().name()):
+            self.assertTrue(len(backup.zipfile) < pipeline.MAX_ZIPFILE_BYTES)
+            archive = zipfile.ZipFile(StringIO(backup.zipfile))
+            for name in archive.namelist():
+                if name == pipeline.MANIFEST_FILENAME:
+                    manifest.update(json.loads(archive.read(name)))
+                    continue
+                self.assertFalse(name in values)
+                values[name] = archive.read(name)
+                value = BackupValue.get_by_key_name(name)
+                self.assertEqual(value.backup, backup.key().name())
+        return values, manifest
+
+
+class BackupTest(BackupTestCase):
+
+    def test_run(self):
+        """All tagged blobs are backed up once."""
+        values, manifest = self.backup_blobs()
+        self.assertEqual(len(values), 20)
+        self.assertEqual(len(manifest), 20)
+        entry = manifest['apps/myapp/file07.txt/']
+        self.assertEqual(values[entry['sha1']], '07' * 200)
+        self.assertEqual(entry['size'], 400)
+        self.assertEqual(entry['tags'], ['pf:backup'])
+        self.assertFalse(entry['chunk'])
+        self.assertEqual(Backup.all().count(), 1)
+
+    def test_same_value(self):
+        """Each value is stored once, even for many keys."""
+        for index in range(5):
+            blob = Blob(key_name='apps/myapp/copy%d.txt/' % index,
+                        value='03' * 200)
+            blob.tags.append('pf:backup')
+            blob.put()
+        values, manifest = self.backup_blobs()
+        self.assertEqual(len(values), 20)
+        self.assertEqual(len(manifest), 25)
+        self.assertEqual(manifest['apps/myapp/copy4.txt/']['sha1'],
+                         manifest['apps/myapp/file03.txt/']['sha1'])
+
+    def test_earlier_backup(self):
+        """Values from earlier backups are not stored again."""
+        self.backup_blobs()
+        shard = BackupShard(key_name='blobs-later-0', model='Blob')
+        part = pipeline.PartWriter(shard)
+        blobs = Blob.all().filter('tags', 'pf:backup').fetch(100)
+        entries = part.prepare(blobs)
+        self.assertEqual(len(entries), 20)
+        for entity, sha1, size, data in entries:
+            self.assertEqual(data, None)
+            self.assertTrue(part.add(entity, sha1, size, data))
+        archive = zipfile.ZipFile(StringIO(part.finish().zipfile))
+        self.assertEqual(archive.namelist(), [pipeline.MANIFEST_FILENAME])
+
+    def test_in_progress(self):
+        """The next cron job shows the progress of the current run."""
+        run = pipeline.start_run(Blob)
+        self.assertEqual(len(tasks.LOCAL_TASKS), pipeline.SHARDS)
+        again = pipeline.start_run(Blob)
+        self.assertEqual(again.key().name(), run.key().name())
+        self.assertEqual(len(tasks.LOCAL_TASKS), pipeline.SHARDS)
+
+    def test_parts(self):
+        """Large backups are split into parts."""
+        pipeline.MAX_ZIPFILE_BYTES = 3000
+        values, manifest = self.backup_blobs()
+        self.assertEqual(len(values), 20)
+        self.assertEqual(len(manifest), 20)
+        self.assertTrue(Backup.all().count() > 1)
+
+    def test_resume(self):
+        """Each task saves its cursor and continues in the next task."""
+        pipeline.MAX_ZIPFILE_BYTES = 3000
+        pipeline.RUN_SECONDS = 0
+        values, manifest = self.backup_blobs()
+        self.assertEqual(len(values), 20)
+        self.assertEqual(len(manifest), 20)
+
+    def test_chunks(self):
+        """Large values are stored as chunk references."""
+        value = 'x' * (MAX_INTERNAL_SIZE + 1)
+        blob = Blob(key_name='apps/myapp/large.txt/', value=value)
+        blob.tags.append('pf:backup')
+        blob.put()
+        values, manifest = self.backup_blobs()
+        self.assertFalse(blob.sha1 in values)
+        self.assertEqual(manifest['apps/myapp/large.txt/']['sha1'], blob.sha1)
+        self.assertTrue(manifest['apps/myapp/large.txt/']['chunk'])
+        self.assertEqual(manifest['apps/myapp/large.txt/']['size'], len(value))
+        self.assertEqual(manifest['apps/myapp/large.txt/']['content_type'],
+                         'text/plain; charset=utf-8')
+        self.assertEqual(Chunk.count_references(blob.sha1), 2)
+
+
+class RestoreTest(BackupTestCase):
+
+    def setUp(self):
+        super(RestoreTest, self).setUp()
+        self.run_seconds = restore.RUN_SECONDS
+        self.large = Blob(key_name='apps/myapp/large.txt/',
+                          value='x' * (MAX_INTERNAL_SIZE + 1))
+        self.large.tags.append('pf:backup')
+        self.large.put()
+
+    def tearDown(self):
+        restore.RUN_SECONDS = self.run_seconds
+        super(RestoreTest, self).tearDown()
+
+    def run_restore(self, run, prefix=''):
+        """Restore a backup run, return the restore state."""
+        state = restore.start_restore(run.key().name(), prefix)
+        tasks.run_local_tasks()
+        state = BackupRestore.get_by_key_name(state.key().name())
+        self.assertTrue(state.done)
+        return state
+
+    def delete_blobs(self, prefix='apps/myapp/'):
+        keys = [key for key in Blob.all(keys_only=True).filter(
+                'tags', 'pf:backup') if key.name().startswith(prefix)]
+        Blob.delete_keys(keys)
+        tasks.run_local_tasks()
+        return len(keys)
+
+    def test_doctest(self):
+        """Run doctest on the restore module."""
+        (failures, tests) = doctest.testmod(restore)
+        self.assertEqual(failures, 0)
+
+    def test_restore(self):
+        """Deleted and changed blobs are restored."""
+        run = self.backup()
+        self.delete_blobs('apps/myapp/file0')
+        Blob(key_name='apps/myapp/file15.txt/', value='changed').put()
+        state = self.run_restore(run)
+        self.assertEqual(state.restored, 11)
+        self.assertEqual(state.skipped, 10)
+        blob = Blob.get_by_key_name('apps/myapp/file03.txt/')
+        self.assertEqual(blob.value, '03' * 200)
+        self.assertEqual(blob.tags, ['pf:backup'])
+        blob = Blob.get_by_key_name('apps/myapp/file15.txt/')
+        self.assertEqual(blob.value, '15' * 200)
+
+    def test_repeat(self):
+        """A repeated restore skips entities that are up to date."""
+        run = self.backup()
+        self.delete_blobs()
+        self.assertEqual(self.run_restore(run).restored, 21)
+        state = self.run_restore(run)
+        self.assertEqual(state.restored, 0)
+        self.assertEqual(state.skipped, 21)
+
+    def test_chunk(self):
+        """Large values are restored from their chunk."""
+        run = self.backup()
+        self.delete_blobs('apps/myapp/large')
+        self.assertTrue(Chunk.exists(self.large.sha1))
+        self.run_restore(run)
+        blob = Blob.get_by_key_name('apps/myapp/large.txt/')
+        self.assertEqual(blob.value, self.large.value)
+        self.assertEqual(blob.size, MAX_INTERNAL_SIZE + 1)
+        self.assertEqual(Chunk.count_references(self.large.sha1), 2)
+
+    def test_resume(self):
+        """Each task restores parts and continues in the next task."""
+        pipeline.MAX_ZIPFILE_BYTES = 3000
+        restore.RUN_SECONDS = 0
+        run = self.backup()
+        self.delete_blobs()
+        state = self.run_restore(run)
+        self.assertEqual(state.parts,
+                         Backup.all().filter('run', run.key().name()).count())
+        self.assertTrue(state.parts > 1)
+        self.assertEqual(state.restored, 21)
+
+    def test_prefix(self):
+        """Only key names with the prefix are restored."""
+        run = self.backup()
+        self.delete_blobs()
+        state = self.run_restore(run, 'apps/myapp/file1')
+        self.assertEqual(state.restored, 10)
+        self.assertEqual(Blob.get_by_key_name('apps/myapp/file03.txt/'), None)
+
+    def test_doc(self):
+        """Other models are restored with all properties."""
+        run = self.backup(Doc)
+        Doc.delete_keys([self.doc.key()])
+        self.run_restore(run)
+        doc = Doc.get_by_key_name('myapp/mydoc')
+        self.assertEqual(doc.title, "My Document")
+        self.assertEqual(doc.readers, ['public'])
+
+    def test_view(self):
+        """POST starts a restore, GET shows the progress."""
+        run = self.backup()
+        url = '/backups/%s/restore/' % run.key().name()
+        response = self.www_client.get(url)
+        self.assertEqual(response.status_code, 404)
+        response = self.www_client.post(url)
+        self.assertContains(response, "Done: False")
+        tasks.run_local_tasks()
+        response = self.www_client.get(url)
+        self.assertContains(response, "Restored: 0")
+        self.assertContains(response, "Skipped: 21")
+        self.assertContains(response, "Done: True")
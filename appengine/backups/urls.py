@@ -3,7 +3,8 @@ from django.conf.urls.defaults import patterns, handler404, handler500
 urlpatterns = patterns(
     'backups.views',
     (r'^$', 'index'),
-    (r'^(\w+-\d+-\d+.zip)/$', 'download'),
+    (r'^(\w+-[\d-]+\.zip)/$', 'download'),
+    (r'^(\w+-\d+-\d+)/restore/$', 'restore'),
     (r'^users/cron/$', 'backup_users'),
     (r'^apps/cron/$', 'backup_apps'),
     (r'^docs/cron/$', 'backup_docs'),
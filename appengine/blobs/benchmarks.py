@@ -0,0 +1,197 @@
+"""
+Benchmark workloads for the blob storage hot paths.
+
+Each workload makes requests through the full Django middleware chain
+with the test client, in-process, and returns a summary with requests
+per second, latency percentiles and RPC counts per request (see
+utils.benchmark.summarize). The scale parameter multiplies the number
+of requests, so the unit tests can run every workload quickly.
+
+Run the full suite against fresh SDK stubs with:
+python manage.py benchmark --save baseline.json
+python manage.py benchmark --compare baseline.json
+"""
+
+import time
+import threading
+
+from django.test import Client
+from django.utils import simplejson as json
+
+from google.appengine.api import memcache
+
+from utils.benchmark import timed_request, summarize
+
+from auth.models import User
+from apps.models import App
+from docs.models import Doc
+from blobs.models import Blob
+
+APP_ID = 'bench'
+SMALL_VALUE = 'x' * 100
+CHUNKED_VALUE = 'y' * (100 * 1024)
+LIST_SIZE = 1000
+
+
+def create_fixtures():
+    """
+    Create an app and a public writable document for the benchmark.
+    """
+    User(key_name=APP_ID, username=APP_ID, email='bench@example.com').put()
+    App(key_name=APP_ID, url='http://%s.pageforest.com/' % APP_ID,
+        owner=APP_ID, readers=['public'], writers=['public'],
+        secret='bench_secret').put()
+    Doc(key_name=APP_ID + '/doc', doc_id='doc', title="Benchmark",
+        owner=APP_ID, readers=['public'], writers=['public']).put()
+
+
+def bench_client():
+    return Client(HTTP_HOST='%s.pageforest.com' % APP_ID,
+                  HTTP_REFERER='http://%s.pageforest.com/' % APP_ID)
+
+
+def run(requests):
+    """
+    Make a list of (method, args) requests with one client, and
+    return the summary.
+    """
+    client = bench_client()
+    profiles = []
+    errors = 0
+    start = time.time()
+    for method, args in requests:
+        response, profile = timed_request(getattr(client, method), *args)
+        if response.status_code >= 400:
+            errors += 1
+        profiles.append(profile)
+    return summarize(profiles, time.time() - start, errors)
+
+
+def put_requests(count, value, prefix='put'):
+    return [('put', ('/docs/doc/%s%d' % (prefix, index % 50), value,
+                     'text/plain'))
+            for index in range(count)]
+
+
+def get_requests(count, prefix='put'):
+    return [('get', ('/docs/doc/%s%d' % (prefix, index % 50), ))
+            for index in range(count)]
+
+
+def static_files(count):
+    """
+    GET static app files, with the fast path for public apps and then
+    with a query string that takes the full middleware chain.
+    """
+    for index in range(10):
+        Blob(key_name='apps/%s/static%d.js/' % (APP_ID, index),
+             value=SMALL_VALUE).put()
+    fast = run([('get', ('/static%d.js' % (index % 10), ))
+                for index in range(count)])
+    full = run([('get', ('/static%d.js?full=1' % (index % 10), ))
+                for index in range(count)])
+    return fast, full
+
+
+def put_get(value, count):
+    """
+    PUT and then GET blobs with this value.
+    """
+    put = run(put_requests(count, value))
+    get = run(get_requests(count))
+    return put, get
+
+
+def slice_array(count):
+    """
+    SLICE the end of a JSON array.
+    """
+    run([('put', ('/docs/doc/array', json.dumps(range(100)), 'text/plain'))])
+    return run([('get', ('/docs/doc/array?method=SLICE&start=-10', ))
+                for index in range(count)])
+
+
+def list_children(count, size=LIST_SIZE):
+    """
+    LIST a document with this many children.
+    """
+    run([('put', ('/docs/doc/item%d' % index, SMALL_VALUE, 'text/plain'))
+         for index in range(size)])
+    return run([('get', ('/docs/doc/?method=LIST&limit=%d' % size, ))
+                for index in range(count)])
+
+
+def cold_warm(count):
+    """
+    GET the same blobs with an empty memcache before each request,
+    then with a warm cache.
+    """
+    run(put_requests(50, SMALL_VALUE, 'cache'))
+    client = bench_client()
+    profiles = []
+    errors = 0
+    seconds = 0
+    for method, args in get_requests(count, 'cache'):
+        memcache.flush_all()
+        start = time.time()
+        response, profile = timed_request(client.get, *args)
+        seconds += time.time() - start
+        if response.status_code >= 400:
+            errors += 1
+        profiles.append(profile)
+    cold = summarize(profiles, seconds, errors)
+    warm = run(get_requests(count, 'cache'))
+    return cold, warm
+
+
+def push_contention(writers, count):
+    """
+    PUSH to the same blob from concurrent writers, each in its own
+    thread. Conflicts show up as more RPCs per request, and as errors
+    when a push gives up.
+    """
+    results = []
+
+    def writer(index):
+        client = bench_client()
+        for item in range(count):
+            results.append(timed_request(
+                    client.post, '/docs/doc/chat?method=PUSH',
+                    '"%d-%d"' % (index, item), 'text/plain'))
+
+    threads = [threading.Thread(target=writer, args=(index, ))
+               for index in range(writers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    errors = len([response for response, profile in results
+                  if response.status_code >= 400])
+    summary = summarize([profile for response, profile in results],
+                        seconds, errors)
+    summary['writers'] = writers
+    return summary
+
+
+def run_all(scale=1, writers=(1, 4, 16), list_size=LIST_SIZE):
+    """
+    Run all workloads, and return a dict of summaries by name.
+    """
+    create_fixtures()
+    results = {}
+    count = max(1, int(100 * scale))
+    results['put_small'], results['get_small'] = \
+        put_get(SMALL_VALUE, count)
+    results['put_chunked'], results['get_chunked'] = \
+        put_get(CHUNKED_VALUE, count)
+    results['slice'] = slice_array(count)
+    results['get_static'], results['get_static_full'] = static_files(count)
+    results['list_%d' % list_size] = list_children(max(1, count / 10),
+                                                   list_size)
+    results['get_cold'], results['get_warm'] = cold_warm(count)
+    for number in writers:
+        results['push_%d_writers' % number] = push_contention(
+            number, max(1, count / number))
+    return results
@@ -0,0 +1,71 @@
+"""
+Run the blob benchmark suite in-process, against fresh SDK stubs for
+the datastore and memcache, so that the local development datastore
+is not modified. Then run the micro-benchmarks listed in
+settings.MICRO_BENCHMARKS.
+"""
+
+import os
+import logging
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from google.appengine.api import apiproxy_stub_map, datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+
+from utils import tasks
+from utils.benchmark import save_baseline, load_baseline, compare, \
+    run_micro
+
+from blobs.benchmarks import run_all
+
+
+def install_stubs(app_id='pageforest'):
+    """
+    Replace the API proxy with in-memory datastore and memcache stubs.
+    """
+    os.environ['APPLICATION_ID'] = app_id
+    os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'datastore_v3',
+        datastore_file_stub.DatastoreFileStub(app_id, '/dev/null', '/dev/null'))
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'memcache', memcache_stub.MemcacheServiceStub())
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--scale', type='float', default=1.0,
+                    help="Multiply the number of requests per workload."),
+        make_option('--save', metavar='FILE',
+                    help="Save the results as a JSON baseline."),
+        make_option('--compare', metavar='FILE',
+                    help="Compare the results with a JSON baseline."),
+        )
+    help = "Benchmark blob requests through the Django middleware chain."
+
+    def handle(self, *args, **options):
+        install_stubs()
+        settings.TASKS_LOCAL = True
+        logging.getLogger().setLevel(logging.ERROR)
+        results = run_all(scale=options['scale'])
+        del tasks.LOCAL_TASKS[:]
+        baseline = {}
+        if options['compare']:
+            baseline = load_baseline(options['compare'])
+        for line in compare(results, baseline):
+            print line
+        for name in sorted(results.keys()):
+            result = results[name]
+            print '%s: p50 %dms p95 %dms p99 %dms, %.1f memcache and ' \
+                '%.1f datastore calls per request, %d errors' % (
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['memcache_calls'], result['datastore_calls'],
+                result['errors'])
+        if options['save']:
+            save_baseline(results, options['save'])
+        for line in run_micro():
+            print line
@@ -1,9 +1,18 @@
+import re
 import logging
 
 from django.http import HttpResponse
 from django.conf import settings
 
+from utils import profiler
+
 from chunks.models import MAX_CHUNK_SIZE
+from blobs.views import static_get, versioned_get
+
+# Paths on app domains that are not static files, see urls.py.
+NOT_STATIC_REGEX = re.compile(
+    r'^/app/(admin|auth|post|channel|docs|data|mirror)(/|$)')
+VERSIONED_REGEX = re.compile(r'^/app/_v/([0-9a-f]{40})/(.*)$')
 
 
 class PostMiddleware(object):
@@ -61,3 +70,39 @@ class PostMiddleware(object):
         if response['Content-Type'] == settings.JSON_MIMETYPE_CS:
             response['Content-Type'] = 'text/plain'
         return response
+
+
+class StaticMiddleware(object):
+    """
+    Serve GET and HEAD of static files in public apps right after
+    AppMiddleware, without the document, authentication and URL
+    dispatch steps. Requests with a query string or a session cookie
+    take the full path, because they may need the signed-in user,
+    JSONP, or the wait option.
+    """
+
+    def process_request(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return
+        if request.app.is_www() or request.subdomain is not None:
+            return
+        if request.META.get('QUERY_STRING'):
+            return
+        if settings.SESSION_COOKIE_NAME in request.COOKIES:
+            return
+        if NOT_STATIC_REGEX.match(request.path_info):
+            return
+        if not request.path_info.startswith('/app/'):
+            return
+        if not request.app.get_acl().public_read:
+            return
+        match = VERSIONED_REGEX.match(request.path_info)
+        if match:
+            profiler.set_endpoint(request.method + ' blobs.views.versioned_get')
+            return versioned_get(request, match.group(1), match.group(2))
+        key_name = '/'.join(
+            ('apps', request.app.get_app_id(), request.path_info[5:]))
+        if not key_name.endswith('/'):
+            key_name += '/'
+        profiler.set_endpoint(request.method + ' blobs.views.static_get')
+        return static_get(request, key_name)
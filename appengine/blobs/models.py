@@ -2,6 +2,7 @@ from hashlib import sha1
 import logging
 
 from google.appengine.ext import db
+from google.appengine.api import memcache
 
 from django.conf import settings
 from django.utils import simplejson as json
@@ -9,8 +10,9 @@ from django.utils import simplejson as json
 from utils.mixins import Timestamped, Migratable, Taggable, Cacheable, Hashable
 from utils.mime import guess_mimetype
 from utils.json import is_valid_json
+from utils import tasks, counters
 
-from chunks.models import Chunk
+from chunks.models import Chunk, RELEASE_SECONDS
 
 # Don't attempt json.loads if we already know it's not valid.
 CERTAINLY_NOT_JSON = ['text/html', 'text/css', 'application/pdf']
@@ -21,6 +23,85 @@ CERTAINLY_NOT_JSON = ['text/html', 'text/css', 'application/pdf']
 # use redundant storage instead of pointing to the same Chunk.
 MAX_INTERNAL_SIZE = 600  # bytes
 
+# The stored chunk reference of a new Blob instance is not known yet.
+NOT_LOADED = object()
+
+# Metadata records that one LIST request may add to memcache. Values
+# are never cached by LIST, so listings don't evict hotter entities.
+LIST_CACHE_LIMIT = 100
+
+
+def chunk_reference(sha1, size):
+    """
+    The key name of the Chunk that stores a value, or None if the
+    value is small enough to be stored in the Blob itself.
+    """
+    if sha1 is not None and size > MAX_INTERNAL_SIZE:
+        return sha1
+
+
+def guess_content_type(key_name, value, valid_json):
+    """
+    Content-Type header for a blob, with charset for text and JSON.
+    """
+    mimetype = guess_mimetype(key_name.rstrip('/'), value)
+    if mimetype == 'text/plain' and valid_json:
+        mimetype = settings.JSON_MIMETYPE
+    if mimetype.startswith('text') or \
+            mimetype == settings.JSON_MIMETYPE:
+        mimetype += '; charset=utf-8'
+    return mimetype
+
+
+def update_references(old_chunk, new_chunk):
+    """
+    Move one Blob reference from old_chunk to new_chunk (either can
+    be None). Inside a datastore transaction, the counters are updated
+    by a task after the transaction commits.
+    """
+    if old_chunk == new_chunk:
+        return
+    if db.is_in_transaction():
+        tasks.defer(update_references, old_chunk, new_chunk,
+                    _transactional=True)
+        return
+    if new_chunk is not None:
+        Chunk.add_reference(new_chunk)
+    if old_chunk is not None:
+        Chunk.add_reference(old_chunk, -1)
+        if Chunk.count_references(old_chunk) <= 0:
+            tasks.defer(release_chunk, old_chunk, _countdown=RELEASE_SECONDS)
+
+
+def release_chunk(sha1):
+    """
+    Task: delete a Chunk whose reference count dropped to zero, unless
+    it was referenced again during the grace period.
+    """
+    count = Chunk.count_references(sha1)
+    if count > 0:
+        return
+    # Blobs saved before reference counting are only found in the index.
+    found = Blob.all(keys_only=True).filter('sha1', sha1).count()
+    if found:
+        logging.warning("Repaired reference count for chunk %s: %d" %
+                        (sha1, found))
+        Chunk.add_reference(sha1, found - count)
+        return
+    Chunk.delete_chunks([sha1])
+    logging.info("Deleted unreferenced chunk %s" % sha1)
+
+
+def create_chunk(sha1, value):
+    """
+    Store a large value in a new Chunk. The Chunk is written before
+    the Blob that references it, so callers schedule release_chunk in
+    case that Blob is never saved.
+    """
+    Chunk(key_name=sha1, value=value).put()
+    counters.record('chunks_created')
+    counters.record('chunk_bytes', len(value))
+
 
 class Blob(Timestamped, Migratable, Taggable, Hashable, Cacheable):
     """
@@ -29,20 +110,34 @@ class Blob(Timestamped, Migratable, Taggable, Hashable, Cacheable):
     Entity key name format: app_id/doc_id/key/with/slashes/
     The directory in this case: app_id/doc_id/key/with/
 
-    The size, sha1, valid_json and directory properties are
-    automatically updated before datastore put.
+    The size, sha1, valid_json, content_type and directory properties
+    are automatically updated before datastore put. The content_type
+    is computed when the value is set, so that GET, HEAD and 304
+    responses don't have to load the value to pick their headers.
+
+    Blobs with large values count as references to their Chunk, and
+    the Chunk is deleted when the last reference is gone.
     """
+    stats_name = 'blobs'  # Count new entities for the dashboard.
+
     value = db.BlobProperty()
     valid_json = db.BooleanProperty(indexed=False)
+    content_type = db.StringProperty(indexed=False)
     directory = db.StringProperty()
 
     # TODO: Add owner - Ownable mixin with security checks?
 
     # Schema version for Migratable mixin:
-    current_schema = 3
+    current_schema = 4
 
     def __init__(self, *args, **kwargs):
         self._in_init = True
+        # Callers that already loaded the stored entity (or found none)
+        # can pass it, so put and delete don't read it again.
+        stored = kwargs.pop('stored', NOT_LOADED)
+        self._stored_chunk = self._stored_exists = NOT_LOADED
+        if stored is not NOT_LOADED:
+            self.set_stored(stored)
         super(Blob, self).__init__(*args, **kwargs)
         self._in_init = False
 
@@ -57,6 +152,140 @@ class Blob(Timestamped, Migratable, Taggable, Hashable, Cacheable):
         if 'value' in kwargs and self.sha1 is None:
             self.set_value(kwargs['value'])
 
+    @classmethod
+    def from_entity(cls, entity):
+        """
+        Remember the chunk reference of the stored entity.
+        """
+        instance = super(Blob, cls).from_entity(entity)
+        instance.set_stored(instance)
+        return instance
+
+    def set_stored(self, stored):
+        """
+        Remember the saved version of this Blob (None if there is none),
+        for reference counting and the count of new blobs.
+        """
+        self._stored_exists = stored is not None
+        self._stored_chunk = None
+        if stored is not None:
+            self._stored_chunk = chunk_reference(stored.sha1, stored.size)
+
+    def chunk_reference(self):
+        return chunk_reference(self.sha1, self.size)
+
+    @classmethod
+    def class_get_metadata_key(cls, key_name):
+        return cls.class_get_cache_key(key_name) + '~meta'
+
+    @classmethod
+    def class_get_cache_keys(cls, key_name):
+        return [cls.class_get_cache_key(key_name),
+                cls.class_get_metadata_key(key_name)]
+
+    def cache_mapping(self):
+        """
+        Save the metadata record together with the entity.
+        """
+        mapping = super(Blob, self).cache_mapping()
+        mapping[self.class_get_metadata_key(self.key().name())] = \
+            self.metadata()
+        return mapping
+
+    def metadata(self):
+        """
+        The properties that LIST returns, without the value.
+        """
+        result = {
+            'size': self.size,
+            'sha1': self.sha1,
+            'json': self.valid_json,
+            'modified': self.modified,
+            }
+        if self.tags:
+            result['tags'] = self.tags
+        return result
+
+    @classmethod
+    def get_metadata(cls, keys, cache_limit=LIST_CACHE_LIMIT):
+        """
+        Return a dict of metadata records by key name, from memcache,
+        or from the datastore for missing records. At most cache_limit
+        of the missing records are added to memcache.
+        """
+        cache_keys = [cls.class_get_metadata_key(key.name()) for key in keys]
+        from_memcache = memcache.get_multi(cache_keys)
+        result = {}
+        missing = []
+        for key, cache_key in zip(keys, cache_keys):
+            if cache_key in from_memcache:
+                result[key.name()] = from_memcache[cache_key]
+            else:
+                missing.append(key)
+        if not missing:
+            return result
+        to_memcache = {}
+        for blob in db.get(missing):
+            if blob is None:
+                continue
+            key_name = blob.key().name()
+            result[key_name] = blob.metadata()
+            if len(to_memcache) < cache_limit:
+                to_memcache[cls.class_get_metadata_key(key_name)] = \
+                    result[key_name]
+        if to_memcache:
+            memcache.set_multi(to_memcache)
+        return result
+
+    def stored_chunk(self):
+        """
+        The chunk reference of the saved version of this Blob. It is
+        only read from memcache or datastore if this instance was not
+        loaded from there, and no stored version was passed to __init__.
+        """
+        if self._stored_chunk is NOT_LOADED:
+            stored = Blob.cache_get_view(self.key().name())
+            if stored is None:
+                stored = db.get(self.key())
+            self.set_stored(stored)
+        return self._stored_chunk
+
+    def is_new(self):
+        """
+        True if no version of this Blob is saved. New instances often
+        overwrite a saved Blob, so this uses the stored version that
+        put reads for reference counting anyway.
+        """
+        self.stored_chunk()
+        return not self._stored_exists
+
+    def put(self, *args, **kwargs):
+        """
+        Save to memcache and datastore, and count the chunk reference.
+        """
+        old_chunk = self.stored_chunk()
+        result = super(Blob, self).put(*args, **kwargs)
+        self.set_stored(self)
+        update_references(old_chunk, self._stored_chunk)
+        return result
+
+    def delete(self):
+        old_chunk = self.stored_chunk()
+        super(Blob, self).delete()
+        self.set_stored(None)
+        update_references(old_chunk, None)
+
+    @classmethod
+    def delete_keys(cls, keys):
+        """
+        Delete blobs by key, and release their chunk references.
+        """
+        blobs = db.get(keys)
+        super(Blob, cls).delete_keys(keys)
+        for blob in blobs:
+            if blob is not None:
+                update_references(blob.stored_chunk(), None)
+
     def migrate(self):
         """
         Update entity to the current schema.
@@ -68,6 +297,10 @@ class Blob(Timestamped, Migratable, Taggable, Hashable, Cacheable):
         if self.schema < 3:
             # Datastore put will enable indexing for sha1 property.
             pass
+        if self.schema < 4:
+            # Compute the Content-Type header once, from the value.
+            self.content_type = guess_content_type(
+                self.key().name(), self.value, self.valid_json)
 
     def __getattribute__(self, name):
         """
@@ -92,6 +325,12 @@ class Blob(Timestamped, Migratable, Taggable, Hashable, Cacheable):
             raise Exception("Should never be called for Blob!")
         super(Blob, self).update_hash(value)
 
+    def changed_hash_props(self):
+        """
+        The hash of a Blob is updated by set_value, not by put.
+        """
+        return []
+
     def set_value(self, value):
         """
         Set value and update all computed properties that are not
@@ -108,11 +347,19 @@ class Blob(Timestamped, Migratable, Taggable, Hashable, Cacheable):
             self.valid_json = False
         else:
             self.valid_json = is_valid_json(value)
+        self.content_type = guess_content_type(
+            self.key().name(), value, self.valid_json)
 
         # Store value in a separate Chunk if it's large.
         if self.size > MAX_INTERNAL_SIZE:
-            if not Chunk.exists(self.sha1):
-                Chunk(key_name=self.sha1, value=value).put()
+            if Chunk.exists(self.sha1):
+                counters.record('chunks_deduped')
+            else:
+                create_chunk(self.sha1, value)
+                # Deleted after the grace period if this Blob is never
+                # saved, e.g. if the request fails before the put.
+                tasks.defer(release_chunk, self.sha1,
+                            _countdown=RELEASE_SECONDS)
             super(Blob, self).__setattr__('value', None)
         else:
             super(Blob, self).__setattr__('value', value)
@@ -156,7 +403,8 @@ class Blob(Timestamped, Migratable, Taggable, Hashable, Cacheable):
             key_name=key_name,
             size=self.size,
             sha1=self.sha1,
-            valid_json=self.valid_json)
+            valid_json=self.valid_json,
+            content_type=self.content_type)
         # Copy the internal value, but don't load Chunk from datastore.
         result._value = self._value
         return result
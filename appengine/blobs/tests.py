@@ -1,5 +1,11 @@
+import os
+import time
 import datetime
 import hashlib
+import threading
+import tempfile
+
+from mock import Mock
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
@@ -14,6 +20,10 @@ from apps.models import App
 from docs.models import Doc
 from blobs.models import Blob, MAX_INTERNAL_SIZE
 from chunks.models import Chunk
+from utils import changes
+from utils import tasks
+from utils import benchmark, profiler
+from blobs import benchmarks, views
 
 
 class BlobTest(AppTestCase):
@@ -33,7 +43,8 @@ class BlobTest(AppTestCase):
         self.assertEqual(self.blob.sha1,
                          '3aa522f52117d62d31bd2dce6607923aacf1902f')
         self.assertTrue(self.blob.valid_json)
-        self.assertEqual(len(self.blob.to_protobuf()), 327)
+        self.assertEqual(self.blob.content_type, settings.JSON_MIMETYPE_CS)
+        self.assertEqual(len(self.blob.to_protobuf()), 380)
 
     def test_clone(self):
         """A cloned Blob should be identical, except key name and directory."""
@@ -45,7 +56,8 @@ class BlobTest(AppTestCase):
         self.assertEqual(clone.sha1,
                          '3aa522f52117d62d31bd2dce6607923aacf1902f')
         self.assertTrue(clone.valid_json)
-        self.assertEqual(len(self.blob.to_protobuf()), 327)
+        self.assertEqual(clone.content_type, settings.JSON_MIMETYPE_CS)
+        self.assertEqual(len(self.blob.to_protobuf()), 380)
 
     def test_setattr(self):
         """Setting blob.value should update all attributes."""
@@ -56,8 +68,9 @@ class BlobTest(AppTestCase):
         self.assertEqual(self.blob.sha1,
                          'a9993e364706816aba3e25717850c26c9cd0d89d')
         self.assertFalse(self.blob.valid_json)
+        self.assertEqual(self.blob.content_type, 'text/plain; charset=utf-8')
         self.assertEqual(self.blob.directory, 'myapp/mydoc/')
-        self.assertEqual(len(self.blob.to_protobuf()), 316)
+        self.assertEqual(len(self.blob.to_protobuf()), 363)
 
     def test_setattr_chunk(self):
         """Setting blob.value should create a new Chunk."""
@@ -69,7 +82,7 @@ class BlobTest(AppTestCase):
                          '053b4dd5a9642608cc0b599e96f491154b37b2c6')
         self.assertFalse(self.blob.valid_json)
         self.assertEqual(self.blob.directory, 'myapp/mydoc/')
-        self.assertEqual(len(self.blob.to_protobuf()), 310)
+        self.assertEqual(len(self.blob.to_protobuf()), 357)
         self.assertTrue(Chunk.exists(self.blob.sha1))
         self.assertEqual(Chunk.get_by_key_name(self.blob.sha1).value,
                          'abc' * 1000)
@@ -522,7 +535,7 @@ class ListTest(AppTestCase):
             'myapp/1234/one/two/three/four/']
         # Delete keys from memcache.
         for key_name in four_keys:
-            memcache.delete(Blob.class_get_cache_key(key_name))
+            memcache.delete_multi(Blob.class_get_cache_keys(key_name))
             self.assertFalse(Blob.cache_get_by_key_name(key_name))
         for url in [
             '/docs/1234?method=list&depth=0',
@@ -534,9 +547,31 @@ class ListTest(AppTestCase):
             self.assertEqual(
                 set(decoded['items'].keys()),
                 set(('one', 'one/two', 'one/two/three', 'one/two/three/four')))
-        # Check that LIST has populated memcache again.
+        # Check that LIST has cached the metadata, but not the values.
         for key_name in four_keys:
-            self.assertTrue(Blob.cache_get_by_key_name(key_name))
+            self.assertFalse(Blob.cache_get_by_key_name(key_name))
+            self.assertTrue(memcache.get(Blob.class_get_metadata_key(key_name)))
+
+    def test_metadata(self):
+        """Metadata records are cached by put, and by LIST up to a limit."""
+        key_names = ['myapp/1234/one/', 'myapp/1234/one/two/',
+                     'myapp/1234/one/two/three/']
+        keys = [db.Key.from_path('Blob', key_name) for key_name in key_names]
+        meta_keys = [Blob.class_get_metadata_key(key_name)
+                     for key_name in key_names]
+        self.assertEqual(len(memcache.get_multi(meta_keys)), 3)
+        memcache.delete_multi(meta_keys)
+        metadata = Blob.get_metadata(keys, cache_limit=2)
+        self.assertEqual(metadata['myapp/1234/one/']['size'], 3)
+        self.assertEqual(metadata['myapp/1234/one/two/three/']['sha1'],
+                         hashlib.sha1('three').hexdigest())
+        self.assertEqual(len(memcache.get_multi(meta_keys)), 2)
+        # Updates replace the metadata record, deletes remove it.
+        Blob(key_name='myapp/1234/one/', value='uno!').put()
+        self.assertEqual(memcache.get(meta_keys[0])['size'], 4)
+        Blob.delete_keys(keys[:1])
+        self.assertEqual(memcache.get(meta_keys[0]), None)
+        self.assertEqual(Blob.get_metadata(keys[:1]), {})
 
     def test_keys_only_unlimited(self):
         """List method with depth=unlimited should return all sub-children."""
@@ -634,10 +669,164 @@ class PrefixTest(AppTestCase):
                          set(['pre', 'prefix', 'pro']))
 
 
+class ChangeBusTest(AppTestCase):
+
+    def setUp(self):
+        super(ChangeBusTest, self).setUp()
+        self.bus = changes.BUS
+        self.listener = Mock()
+        changes.BUS = changes.MemoryBus([self.listener])
+        self.sign_in(self.peter)
+
+    def tearDown(self):
+        changes.BUS = self.bus
+        super(ChangeBusTest, self).tearDown()
+
+    def test_publish_once(self):
+        """Each PUT and PUSH should publish exactly one change."""
+        self.app_client.put('/docs/mydoc/chat', '[]',
+                            content_type='application/json')
+        self.app_client.post('/docs/mydoc/chat?method=PUSH',
+                             data='bye', content_type="text/plain")
+        calls = [args for (args, kwargs) in self.listener.call_args_list]
+        self.assertEqual([(key, method) for (key, method, data) in calls],
+                         [('myapp/mydoc/chat/', 'PUT'),
+                          ('myapp/mydoc/chat/', 'PUSH')])
+        blob = Blob.get_by_key_name('myapp/mydoc/chat/')
+        self.assertEqual(calls[-1][2]['sha1'], blob.sha1)
+
+    def test_wait(self):
+        """A long-polling GET should return after the next change."""
+        Blob(key_name='myapp/mydoc/chat/', value='[]').put()
+
+        def push():
+            time.sleep(0.2)
+            client = Client(**self.app_client.defaults)
+            client.cookies = self.app_client.cookies
+            client.post('/docs/mydoc/chat?method=PUSH',
+                        data='bye', content_type="text/plain")
+
+        thread = threading.Thread(target=push)
+        started = time.time()
+        thread.start()
+        response = self.app_client.get('/docs/mydoc/chat?wait=10')
+        thread.join()
+        self.assertTrue(time.time() - started < 5)
+        self.assertContains(response, 'bye')
+
+    def test_wait_delete(self):
+        """A DELETE should publish a change and wake up waiting GETs."""
+        Blob(key_name='myapp/mydoc/chat/', value='[]').put()
+        etag = self.app_client.get('/docs/mydoc/chat')['ETag']
+
+        def delete():
+            time.sleep(0.2)
+            client = Client(**self.app_client.defaults)
+            client.cookies = self.app_client.cookies
+            client.delete('/docs/mydoc/chat')
+
+        thread = threading.Thread(target=delete)
+        started = time.time()
+        thread.start()
+        response = self.app_client.get('/docs/mydoc/chat?wait=10',
+                                       HTTP_IF_NONE_MATCH=etag)
+        thread.join()
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(response.status_code, 404)
+        calls = [args for (args, kwargs) in self.listener.call_args_list]
+        self.assertEqual(calls, [('myapp/mydoc/chat/', 'DELETE', {})])
+
+
+class ReferenceCountTest(AppTestCase):
+
+    def setUp(self):
+        super(ReferenceCountTest, self).setUp()
+        self.value = 'x' * (MAX_INTERNAL_SIZE + 1)
+        self.sha1 = hashlib.sha1(self.value).hexdigest()
+
+    def test_put_delete(self):
+        """Each Blob with a chunked value is counted once."""
+        Blob(key_name='myapp/mydoc/one/', value=self.value).put()
+        Blob(key_name='myapp/mydoc/two/', value=self.value).put()
+        self.assertEqual(Chunk.count_references(self.sha1), 2)
+        Blob(key_name='myapp/mydoc/one/', value=self.value).put()
+        self.assertEqual(Chunk.count_references(self.sha1), 2)
+        Blob(key_name='myapp/mydoc/one/', value='small').put()
+        self.assertEqual(Chunk.count_references(self.sha1), 1)
+        # Only the release task for the new chunk.
+        self.assertEqual(len(tasks.LOCAL_TASKS), 1)
+        Blob.get_by_key_name('myapp/mydoc/two/').delete()
+        self.assertEqual(Chunk.count_references(self.sha1), 0)
+        self.assertEqual(tasks.run_local_tasks(), 2)
+        self.assertFalse(Chunk.exists(self.sha1))
+
+    def test_referenced_again(self):
+        """A chunk that is used again in the grace period is kept."""
+        blob = Blob(key_name='myapp/mydoc/one/', value=self.value)
+        blob.put()
+        blob.delete()
+        self.assertEqual(len(tasks.LOCAL_TASKS), 2)
+        Blob(key_name='myapp/mydoc/two/', value=self.value).put()
+        tasks.run_local_tasks()
+        self.assertTrue(Chunk.exists(self.sha1))
+        self.assertEqual(Chunk.count_references(self.sha1), 1)
+
+    def test_uncounted(self):
+        """Blobs saved before reference counting repair the count."""
+        for key_name in ('myapp/mydoc/one/', 'myapp/mydoc/two/'):
+            blob = Blob(key_name=key_name, value=self.value)
+            db.Model.put(blob)
+        Blob.get_by_key_name('myapp/mydoc/one/').delete()
+        tasks.run_local_tasks()
+        self.assertTrue(Chunk.exists(self.sha1))
+        self.assertEqual(Chunk.count_references(self.sha1), 1)
+
+    def test_never_saved(self):
+        """A new chunk is released if its Blob is never saved."""
+        Blob(key_name='myapp/mydoc/one/', value=self.value)
+        self.assertTrue(Chunk.exists(self.sha1))
+        tasks.run_local_tasks()
+        self.assertFalse(Chunk.exists(self.sha1))
+
+    def test_known_stored(self):
+        """A stored version passed to the constructor saves a read."""
+        blob = Blob(key_name='myapp/mydoc/one/', value=self.value,
+                    stored=None)
+        Blob.cache_get_view = Mock(side_effect=Blob.cache_get_view)
+        try:
+            blob.put()
+            self.assertFalse(Blob.cache_get_view.called)
+        finally:
+            del Blob.cache_get_view
+        self.assertEqual(Chunk.count_references(self.sha1), 1)
+
+    def test_push(self):
+        """PUSH updates the counts after the transaction commits."""
+        self.sign_in(self.peter)
+        for word in ('hello', 'x' * MAX_INTERNAL_SIZE, 'bye'):
+            response = self.app_client.post(
+                '/docs/mydoc/chat?method=PUSH',
+                data=word, content_type="text/plain")
+            self.assertContains(response, '"statusText": "Pushed"')
+            tasks.run_local_tasks()
+        chat = Blob.get_by_key_name('myapp/mydoc/chat/')
+        self.assertEqual(chat.size, len(chat.value))
+        self.assertEqual(Chunk.count_references(chat.sha1), 1)
+
+    def test_delete_children(self):
+        """Deleting a document releases the chunks of its blobs."""
+        Blob(key_name='myapp/mydoc/one/', value=self.value).put()
+        self.sign_in(self.peter)
+        self.app_client.delete('/docs/mydoc')
+        tasks.run_local_tasks()
+        self.assertEqual(Chunk.count_references(self.sha1), 0)
+        self.assertFalse(Chunk.exists(self.sha1))
+
+
 class MigrationTest(AppTestCase):
 
-    def test_schema_1_to_3(self):
-        """The update_schema method should migrate from schema 1 to 3."""
+    def test_schema_1_to_4(self):
+        """The update_schema method should migrate from schema 1 to 4."""
         value = 'x' * 2048
         sha1 = hashlib.sha1(value).hexdigest()
         # Simulate a Blob with schema 1.
@@ -657,8 +846,253 @@ class MigrationTest(AppTestCase):
         chunk = Chunk.cache_get_by_key_name(sha1)
         self.assertEqual(chunk.value, value)
         # Check that the big entity was upgraded.
-        self.assertEqual(big.schema, 3)
+        self.assertEqual(big.schema, 4)
         self.assertEqual(big.size, 2048)
         self.assertEqual(big.sha1, sha1)
         self.assertEqual(big.value, value)
         self.assertEqual(db.Model.__getattribute__(big, 'value'), None)
+
+    def test_schema_3_to_4(self):
+        """Blobs with schema 3 get their Content-Type when loaded."""
+        blob = Blob(key_name='apps/myapp/page/', value='<html>\n</html>\n')
+        blob.content_type = None
+        blob.schema = 3
+        blob.put()
+        blob = Blob.get_by_key_name('apps/myapp/page/')
+        self.assertEqual(blob.schema, 4)
+        self.assertEqual(blob.content_type, 'text/html; charset=utf-8')
+        stored = db.get(db.Key.from_path('Blob', 'apps/myapp/page/'))
+        self.assertEqual(stored.content_type, 'text/html; charset=utf-8')
+
+
+class RevalidationTest(AppTestCase):
+
+    def setUp(self):
+        super(RevalidationTest, self).setUp()
+        self.value = json.dumps(range(1000))
+        Blob(key_name='myapp/mydoc/big/', value=self.value).put()
+        # Count Chunk reads, to check that 304 responses don't load values.
+        Chunk.get_by_key_name = Mock(side_effect=Chunk.get_by_key_name)
+
+    def tearDown(self):
+        del Chunk.get_by_key_name
+        super(RevalidationTest, self).tearDown()
+
+    def test_etag(self):
+        """A matching If-None-Match doesn't load the value."""
+        response = self.app_client.get('/docs/mydoc/big')
+        self.assertEqual(response.content, self.value)
+        self.assertEqual(Chunk.get_by_key_name.call_count, 1)
+        Chunk.get_by_key_name.reset_mock()
+        response = self.app_client.get('/docs/mydoc/big',
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(Chunk.get_by_key_name.call_count, 0)
+
+    def test_modified_since(self):
+        """If-Modified-Since is checked without If-None-Match."""
+        response = self.app_client.get('/docs/mydoc/big')
+        modified = response['Last-Modified']
+        Chunk.get_by_key_name.reset_mock()
+        response = self.app_client.get('/docs/mydoc/big',
+                                       HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(Chunk.get_by_key_name.call_count, 0)
+        response = self.app_client.get(
+            '/docs/mydoc/big',
+            HTTP_IF_MODIFIED_SINCE='Tue, 15 Nov 1994 12:45:26 GMT')
+        self.assertEqual(response.content, self.value)
+        # The ETag takes precedence.
+        response = self.app_client.get('/docs/mydoc/big',
+                                       HTTP_IF_MODIFIED_SINCE=modified,
+                                       HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_modified_since_wait(self):
+        """Only a matching If-None-Match waits for an update."""
+        response = self.app_client.get('/docs/mydoc/big')
+        wait_for_update = views.wait_for_update
+        views.wait_for_update = Mock(side_effect=wait_for_update)
+        try:
+            response = self.app_client.get(
+                '/docs/mydoc/big?wait=1',
+                HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+            self.assertFalse(views.wait_for_update.called)
+            response = self.app_client.get(
+                '/docs/mydoc/big?wait=1',
+                HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertTrue(views.wait_for_update.called)
+        finally:
+            views.wait_for_update = wait_for_update
+
+    def test_head(self):
+        """HEAD returns the headers without loading the value."""
+        response = self.app_client.head('/docs/mydoc/big')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['Content-Type'], settings.JSON_MIMETYPE_CS)
+        self.assertEqual(Chunk.get_by_key_name.call_count, 0)
+
+    def test_list(self):
+        """LIST doesn't load values."""
+        response = self.app_client.get('/docs/mydoc/?method=LIST')
+        self.assertEqual(json.loads(response.content)['items']['big']['size'],
+                         len(self.value))
+        self.assertEqual(Chunk.get_by_key_name.call_count, 0)
+
+    def test_slice(self):
+        """Slices are revalidated without loading the array."""
+        url = '/docs/mydoc/big?method=SLICE&start=-2'
+        response = self.app_client.get(url)
+        self.assertEqual(response.content, '[998, 999]')
+        etag = response['ETag']
+        self.assertTrue(etag.endswith('[-2:]"'))
+        Chunk.get_by_key_name.reset_mock()
+        response = self.app_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(Chunk.get_by_key_name.call_count, 0)
+        # The ETag of a different slice doesn't match.
+        response = self.app_client.get('/docs/mydoc/big?method=SLICE&end=2',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.content, '[0, 1]')
+
+
+class StaticTest(AppTestCase):
+
+    def test_fast_path(self):
+        """Public static files are served by the fast path."""
+        response = self.app_client.get('/index.html')
+        self.assertContains(response, '<html>')
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+        self.assertEqual(response['Cache-Control'],
+                         'public, max-age=%d' % views.STATIC_MAX_AGE)
+        self.assertEqual(profiler.CURRENT.last['endpoint'],
+                         'GET blobs.views.static_get')
+        # The app root is an alias for index.html.
+        response = self.app_client.get('/')
+        self.assertContains(response, '<html>')
+        self.assertEqual(profiler.CURRENT.last['endpoint'],
+                         'GET blobs.views.static_get')
+
+    def test_head(self):
+        """HEAD returns the headers without the content."""
+        response = self.app_client.head('/index.html')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+        self.assertTrue('ETag' in response)
+
+    def test_not_modified(self):
+        """A matching If-None-Match returns 304 Not Modified."""
+        etag = self.app_client.get('/index.html')['ETag']
+        response = self.app_client.get('/index.html', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_full_path(self):
+        """Other requests take the full middleware chain."""
+        response = self.app_client.get('/index.html?callback=f')
+        self.assertContains(response, 'f(')
+        self.assertEqual(profiler.CURRENT.last['endpoint'],
+                         'GET blobs.views.dispatch')
+        self.sign_in(self.peter)
+        response = self.app_client.get('/index.html')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        response = self.app_client.get('/missing.html')
+        self.assertEqual(response.status_code, 404)
+
+    def test_private_app(self):
+        """Files of private apps are checked by AuthMiddleware."""
+        self.app.readers = []
+        self.app.put()
+        response = self.app_client.get('/index.html')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse('Cache-Control' in response)
+
+
+class VersionedTest(AppTestCase):
+
+    def setUp(self):
+        super(VersionedTest, self).setUp()
+        self.sha1 = Blob.get_by_key_name('apps/myapp/index.html/').sha1
+        self.url = '/_v/%s/index.html' % self.sha1
+
+    def test_immutable(self):
+        """Versioned URLs may be cached forever."""
+        response = self.app_client.get(self.url)
+        self.assertContains(response, '<html>')
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+        self.assertEqual(response['Cache-Control'],
+                         'public, max-age=%d, immutable' %
+                         views.VERSIONED_MAX_AGE)
+        self.assertEqual(profiler.CURRENT.last['endpoint'],
+                         'GET blobs.views.versioned_get')
+        response = self.app_client.get(self.url,
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_stale(self):
+        """An old or unknown version redirects to the current file."""
+        response = self.app_client.get('/_v/%s/index.html' % ('0' * 40))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/index.html'))
+        response = self.app_client.get('/_v/%s/missing.js' % self.sha1)
+        self.assertEqual(response.status_code, 302)
+        self.sign_in(self.peter)
+        response = self.app_client.get('/admin/_v/%s/index.html' % ('0' * 40))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/admin/index.html'))
+
+    def test_private_app(self):
+        """Versioned files of private apps are checked and not shared."""
+        self.app.readers = []
+        self.app.put()
+        response = self.app_client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+        self.sign_in(self.peter)
+        response = self.app_client.get(self.url)
+        self.assertContains(response, '<html>')
+        self.assertEqual(response['Cache-Control'],
+                         'private, max-age=%d, immutable' %
+                         views.VERSIONED_MAX_AGE)
+
+
+class BenchmarkTest(AppTestCase):
+
+    def test_workloads(self):
+        """All benchmark workloads run without errors at a small scale."""
+        results = benchmarks.run_all(scale=0.05, writers=(1, 3), list_size=20)
+        for name in ('put_small', 'get_small', 'put_chunked', 'get_chunked',
+                     'slice', 'list_20', 'get_cold', 'get_warm',
+                     'get_static', 'get_static_full'):
+            self.assertEqual(results[name]['errors'], 0, name)
+            self.assertTrue(results[name]['requests_per_second'] > 0)
+        self.assertEqual(results['get_small']['requests'], 5)
+        self.assertTrue(results['get_cold']['datastore_calls'] >
+                        results['get_warm']['datastore_calls'])
+        self.assertEqual(results['push_3_writers']['writers'], 3)
+        self.assertEqual(results['push_3_writers']['requests'], 3)
+        chat = Blob.get_by_key_name('bench/doc/chat/')
+        self.assertEqual(len(json.loads(chat.value)),
+                         8 - results['push_1_writers']['errors'] -
+                         results['push_3_writers']['errors'])
+
+    def test_baseline(self):
+        """Results are saved as JSON and compared with the baseline."""
+        results = {'get': benchmark.summarize(
+                [{'ms': 10, 'memcache_calls': 2, 'datastore_calls': 1,
+                  'memcache_bytes': 100, 'datastore_bytes': 50,
+                  'response_bytes': 20}], 0.5)}
+        self.assertEqual(results['get']['requests_per_second'], 2.0)
+        (fd, filename) = tempfile.mkstemp('.json')
+        os.close(fd)
+        try:
+            benchmark.save_baseline(results, filename)
+            baseline = benchmark.load_baseline(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(baseline, results)
+        self.assertEqual(benchmark.compare(results, baseline),
+                         ['get: 2.0 req/s (1.00x baseline 2.0 req/s)'])
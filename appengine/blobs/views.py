@@ -2,35 +2,37 @@ import time
 import urllib
 import hashlib
 import logging
-import re
 
 from django.conf import settings
 from django.utils import simplejson as json
 from django.http import HttpResponse, Http404, \
     HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotModified, \
-    HttpResponseServerError
+    HttpResponseServerError, HttpResponseRedirect
 
 from google.appengine.ext import db
-from google.appengine.api import memcache
 from google.appengine.runtime import DeadlineExceededError
 
 from utils.decorators import jsonp, run_in_transaction, method_required, \
     no_cache
-from utils.http import http_datetime
-from utils.mime import guess_mimetype
+from utils.http import http_datetime, is_not_modified
 from utils.json import ModelEncoder, HttpJSONResponse, datetime_from_iso
 from utils.shortcuts import render_to_response, lookup_or_404, \
     get_int, get_bool
-from utils.channel import dispatch_subscriptions
+from utils import changes, counters, tasks
 from utils.models import prefix_filter
 
-from chunks.models import Chunk
-from blobs.models import Blob, MAX_INTERNAL_SIZE
+from chunks.models import RELEASE_SECONDS
+from blobs.models import Blob, MAX_INTERNAL_SIZE, guess_content_type, \
+    create_chunk, release_chunk
 from apps.views import app_json_get
 
 ROOT_METHODS = ('GET', 'HEAD', 'LIST')
 MAX_PUSH_ATTEMPTS = 5
 MAX_LIST = 1000
+# Browsers and edge caches may reuse public static files this long.
+STATIC_MAX_AGE = 60
+# Versioned URLs (/_v/sha1/path) never change, cache them for a year.
+VERSIONED_MAX_AGE = 365 * 24 * 3600
 
 ALLOWED_ORDER_PROPS = ('modified', '-modified')
 
@@ -71,11 +73,10 @@ def dispatch(request, doc_id, key):
 
 def blob_head(request):
     """
-    HTTP HEAD request handler.
+    HTTP HEAD request handler. The headers are computed from the
+    metadata, and the value is not loaded.
     """
-    response = blob_get(request)
-    response.content = ''
-    return response
+    return blob_get(request)
 
 
 def wait_for_update(request, blob):
@@ -89,24 +90,95 @@ def wait_for_update(request, blob):
     start = time.time()
     deadline = start + int(wait)
     original_sha1 = blob.sha1
+    token = changes.BUS.latest(request.key_name)
     try:
         while time.time() < deadline:
-            # Sleep one or two seconds.
-            elapsed = time.time() - start
-            time.sleep(1 if elapsed < 7 else 2)
-            # Try to read updated blob from memcache.
-            logging.info("Checking memcache for blob update after %.1fs",
-                         elapsed)
-            blob = Blob.cache_get_by_key_name(request.key_name)
+            # Wait for the next change published on the change bus.
+            latest = changes.BUS.wait(request.key_name, token,
+                                      deadline - time.time())
+            if latest == token:
+                break
+            token = latest
+            logging.info("Change published after %.1fs",
+                         time.time() - start)
+            blob = Blob.get_by_key_name(request.key_name)
             # Detect changes.
             if blob is None or blob.sha1 != original_sha1:
                 break
     except DeadlineExceededError:
         logging.info("Caught DeadlineExceededError after %.1fs" %
-                     time.time() - start)
+                     (time.time() - start))
     return blob
 
 
+def blob_response(request, blob, etag):
+    """
+    Response for GET or HEAD of a blob: 304 Not Modified for a
+    matching conditional request, empty content for HEAD, or the
+    value, which is only loaded here.
+    """
+    mimetype = blob.content_type
+    if is_not_modified(request, etag, blob.modified):
+        response = HttpResponseNotModified(mimetype=mimetype)
+    elif request.method == 'HEAD':
+        response = HttpResponse('', mimetype=mimetype)
+    else:
+        response = HttpResponse(blob.value, mimetype=mimetype)
+    response['Last-Modified'] = http_datetime(blob.modified)
+    response['X-Last-Modified-ISO'] = blob.modified.isoformat() + 'Z'
+    response['ETag'] = etag
+    return response
+
+
+def static_get(request, key_name):
+    """
+    Fast path for GET and HEAD of a static file in a public app,
+    called by StaticMiddleware before the document, authentication
+    and URL dispatch steps. The response may be cached by browsers
+    and edge caches for STATIC_MAX_AGE seconds. Return None if the
+    file is not found, so that the full request path can handle it.
+    """
+    blob = Blob.get_by_key_name(key_name)
+    if blob is None:
+        key_name += 'index.html/'
+        blob = Blob.get_by_key_name(key_name)
+        if blob is None:
+            return None
+    response = blob_response(request, blob, blob.get_etag())
+    response['Cache-Control'] = 'public, max-age=%d' % STATIC_MAX_AGE
+    return response
+
+
+@method_required('GET', 'HEAD')
+def versioned_get(request, sha1, key, admin=None):
+    """
+    GET a static app file at its versioned URL, /_v/sha1/path, as
+    generated by pf.py for references in HTML files. The content
+    for this sha1 never changes, so the response may be cached
+    without revalidation.
+
+    The file is looked up by its path, and served only if it still
+    has this sha1. It is not looked up by sha1 alone, because small
+    values have no Chunk, and Chunks are shared by all apps. If the
+    file has changed since the URL was generated, redirect to the
+    current version.
+    """
+    key_name = '/'.join(('apps', request.app.get_app_id(), key))
+    if not key_name.endswith('/'):
+        key_name += '/'
+    blob = Blob.get_by_key_name(key_name)
+    if blob is None or blob.sha1 != sha1:
+        return HttpResponseRedirect('/' + (admin or '') + key)
+    response = blob_response(request, blob, blob.get_etag())
+    if request.app.get_acl().public_read:
+        cache_control = 'public'
+    else:
+        cache_control = 'private'
+    response['Cache-Control'] = '%s, max-age=%d, immutable' % (
+        cache_control, VERSIONED_MAX_AGE)
+    return response
+
+
 @no_cache
 def blob_get(request):
     """
@@ -119,29 +191,17 @@ def blob_get(request):
         blob = Blob.get_by_key_name(request.key_name)
     if blob is None:
         raise Http404("Blob not found: " + original_key_name)
+    # Conditional requests are resolved from the metadata, so the
+    # value (and its Chunk) is only loaded for a full response.
     etag = blob.get_etag()
-    # The browser controls sendind HTTP_IF_MODIFIED_SINCE - so we can't
-    # rely on that since two writes can be made in a 1 second interval.
-    if (etag == request.META.get('HTTP_IF_NONE_MATCH', '')):
+    # Only an ETag match waits for an update: two writes can be made
+    # within the one second resolution of If-Modified-Since.
+    if etag == request.META.get('HTTP_IF_NONE_MATCH', ''):
         blob = wait_for_update(request, blob)
         if blob is None:
             raise Http404("Blob was deleted: " + request.key_name)
         etag = blob.get_etag()
-    mimetype = guess_mimetype(request.key_name.rstrip('/'), blob.value)
-    if mimetype == 'text/plain' and blob.valid_json:
-        mimetype = settings.JSON_MIMETYPE
-    if mimetype.startswith('text') or \
-            mimetype == settings.JSON_MIMETYPE:
-        mimetype += '; charset=utf-8'
-    if not hasattr(request, 'no_cache') and \
-        etag == request.META.get('HTTP_IF_NONE_MATCH', ''):
-        response = HttpResponseNotModified(mimetype=mimetype)
-    else:
-        response = HttpResponse(blob.value, mimetype=mimetype)
-    response['Last-Modified'] = http_datetime(blob.modified)
-    response['X-Last-Modified-ISO'] = blob.modified.isoformat() + 'Z'
-    response['ETag'] = etag
-    return response
+    return blob_response(request, blob, etag)
 
 
 @no_cache
@@ -173,7 +233,9 @@ def blob_list(request):
     except ValueError, error:
         return HttpJSONResponse({'statusText': error.message}, status=400)
 
-    query = Blob.all(keys_only=keys_only)
+    # The query only returns keys, and the metadata of the blobs is
+    # read from memcache, so listings don't move the values.
+    query = Blob.all(keys_only=True)
 
     # REVIEW: This doesn't seem to be working for multiple tag params.
     for tag in request.GET.getlist('tag'):
@@ -213,15 +275,9 @@ def blob_list(request):
         query.with_cursor(request.GET['cursor'])
     strip_levels = request.key_name.count('/')
 
-    order = []
-    blobs = {}
-    memcache_mapping = {}
+    children = []
     raw_results = query.fetch(limit)
-    for blob in raw_results:
-        if keys_only:
-            key = blob
-        else:
-            key = blob.key()
+    for key in raw_results:
         parts = key.name().split('/')
         parts = parts[strip_levels:-1]
         # TODO: If we add a key_depth field, we can get the store
@@ -230,30 +286,18 @@ def blob_list(request):
         if depth != 0 and len(parts) > depth:
             # Ignore blobs that are deeper than maximum depth.
             continue
-        rel_key = '/'.join(parts)
-        if keys_only:
+        children.append(('/'.join(parts), key))
+
+    blobs = {}
+    if keys_only:
+        for rel_key, key in children:
             blobs[rel_key] = {}
-            if has_order:
-                order.append(rel_key)
-            continue
-        item = {
-            'size': blob.size,
-            'sha1': blob.sha1,
-            'json': blob.valid_json,
-            'modified': blob.modified,
-            }
-        if blob.tags:
-            item['tags'] = blob.tags
-        blobs[rel_key] = item
-        if has_order:
-            order.append(rel_key)
-        # Might as well fill memcache with the small blobs we've read.
-        # REVIEW: Would be nice if this were a function in Cachable to
-        # preserve information hiding of that mixin.
-        if blob._value is None or len(blob._value) <= MAX_INTERNAL_SIZE:
-            memcache_mapping[blob.get_cache_key()] = blob.to_protobuf()
-
-    memcache.set_multi(memcache_mapping)
+    else:
+        metadata = Blob.get_metadata([key for rel_key, key in children])
+        for rel_key, key in children:
+            if key.name() in metadata:
+                blobs[rel_key] = metadata[key.name()]
+    order = [rel_key for rel_key, key in children if rel_key in blobs]
 
     # Add app.json at the top level of a Pageforest application.
     if (request.key_name == 'apps/' + request.app.get_app_id() + '/'
@@ -329,10 +373,11 @@ def blob_put(request):
                           for tag in request.GET['tags'].split(',')])
     # Save new blob to memcache and datastore.
     blob.put()
-    dispatch_subscriptions(blob.key().name(), 'PUT',
-                           {'sha1': blob.sha1,
-                            'size': blob.size,
-                            'modified': blob.modified})
+    counters.record('bytes_put', len(value))
+    changes.publish(blob.key().name(), 'PUT',
+                    {'sha1': blob.sha1,
+                     'size': blob.size,
+                     'modified': blob.modified})
     response = HttpJSONResponse({
             'statusText': "Saved",
             'sha1': blob.sha1})
@@ -351,6 +396,7 @@ def blob_delete(request):
     """
     blob = lookup_or_404(Blob, request.key_name)
     blob.delete()
+    changes.publish(request.key_name, 'DELETE', {})
     return HttpJSONResponse({"statusText": "Deleted"})
 
 
@@ -369,8 +415,7 @@ def json_push(old_value, value, max_length):
     new_sha1 = hashlib.sha1(new_value).hexdigest()
     # Create a new chunk if necessary.
     if len(new_value) > MAX_INTERNAL_SIZE:
-        chunk = Chunk(key_name=new_sha1, value=new_value)
-        chunk.put()
+        create_chunk(new_sha1, new_value)
     return new_length, new_value, new_sha1
 
 
@@ -387,22 +432,21 @@ def atomic_update(key_name, old_sha1, new_sha1, new_value):
     # Read the blob from memcache
     blob = Blob.get_by_key_name(key_name)
     if blob is None:
-        blob = Blob(key_name=key_name, valid_json=True)
+        blob = Blob(key_name=key_name, valid_json=True, stored=None)
     elif blob.sha1 != old_sha1:
         # The blob was updated by a different process after we read
         # it. We have to cancel this transaction, create a new chunk
         # from the updated data, then try again.
         return False, blob
     blob.sha1 = new_sha1
+    blob.size = len(new_value)
+    blob.content_type = guess_content_type(key_name, new_value,
+                                           blob.valid_json)
     if len(new_value) <= MAX_INTERNAL_SIZE:
         db.Model.__setattr__(blob, 'value', new_value)
     else:
         db.Model.__setattr__(blob, 'value', None)
     blob.put()
-    dispatch_subscriptions(blob.key().name(), 'PUSH',
-                           {'sha1': blob.sha1,
-                            'size': blob.size,
-                            'modified': blob.modified})
     # Update was successful, no need to try again.
     return True, blob
 
@@ -432,14 +476,29 @@ def blob_push(request):
         new_length, new_value, new_sha1 = json_push(
             old_value, value, max_length)
         # Update the blob value or point to the new Chunk.
-        success, blob = atomic_update(
-            request.key_name, old_sha1, new_sha1, new_value)
-        if success:
-            return HttpJSONResponse({
-                    "statusText": "Pushed",
-                    "newLength": new_length,
-                    "newSha1": new_sha1,
-                    })
+        try:
+            success, blob = atomic_update(
+                request.key_name, old_sha1, new_sha1, new_value)
+        finally:
+            if len(new_value) > MAX_INTERNAL_SIZE:
+                # Deleted after the grace period if the update failed.
+                tasks.defer(release_chunk, new_sha1,
+                            _countdown=RELEASE_SECONDS)
+        if not success:
+            counters.record('push_conflicts')
+            continue
+        if attempt:
+            counters.record('push_retries')
+        # Publish after the transaction, so retries don't repeat it.
+        changes.publish(blob.key().name(), 'PUSH',
+                        {'sha1': blob.sha1,
+                         'size': blob.size,
+                         'modified': blob.modified})
+        return HttpJSONResponse({
+                "statusText": "Pushed",
+                "newLength": new_length,
+                "newSha1": new_sha1,
+                })
     else:
         return HttpJSONResponse({
                 "statusText":
@@ -447,41 +506,42 @@ def blob_push(request):
                 MAX_PUSH_ATTEMPTS}, status=503)
 
 
-slice_etag_re = re.compile(r'^"(.*)\[.*\]"$')
-
-
 @no_cache
 def blob_slice(request):
     """
     SLICE method request handler.
+
+    The ETag of a slice is '"sha1[start:end]"', so a matching
+    If-None-Match returns 304 Not Modified (or waits for an update)
+    without loading and parsing the array.
     """
     start = get_int(request.GET, 'start', None)
     end = get_int(request.GET, 'end', None)
+    blob = Blob.get_by_key_name(request.key_name)
+    if blob is None:
+        raise Http404("Blob not found: " + request.key_name)
 
-    # Modify the etag from '"xxx[start:end]"' to '"xxx"'
-    etag_match = slice_etag_re.match(
-        request.META.get('HTTP_IF_NONE_MATCH', ''))
-    if etag_match:
-        request.META['HTTP_IF_NONE_MATCH'] = '"%s"' % etag_match.group(1)
-
-    # Force blob_get to return values - not a 304 Not Modified
-    request.no_cache = True
-    response = blob_get(request)
+    def slice_etag(blob):
+        return '"%s[%s:%s]"' % (blob.sha1, start or '', end or '')
 
-    try:
-        array = json.loads(response.content)
-        if end is not None:
-            array = array[:end]
-        if start is not None:
-            array = array[start:]
-    except:
-        return HttpResponseServerError("Blob is not a parsable array.")
-
-    # Modify the results of blob_get to return the slice (and matching ETag)
-    response.content = json.dumps(array)
-
-    etag = '"%s[%s:%s]"' % (response['Etag'][1:-1], start or '', end or '')
-    if etag == request.META.get('HTTP_IF_NONE_MATCH', ''):
+    if slice_etag(blob) == request.META.get('HTTP_IF_NONE_MATCH', ''):
+        blob = wait_for_update(request, blob)
+        if blob is None:
+            raise Http404("Blob was deleted: " + request.key_name)
+    if is_not_modified(request, slice_etag(blob), blob.modified):
         response = HttpResponseNotModified(mimetype=settings.JSON_MIMETYPE_CS)
-    response['ETag'] = etag
+    else:
+        try:
+            array = json.loads(blob.value)
+            if end is not None:
+                array = array[:end]
+            if start is not None:
+                array = array[start:]
+        except:
+            return HttpResponseServerError("Blob is not a parsable array.")
+        response = HttpResponse(json.dumps(array),
+                                mimetype=settings.JSON_MIMETYPE_CS)
+    response['Last-Modified'] = http_datetime(blob.modified)
+    response['X-Last-Modified-ISO'] = blob.modified.isoformat() + 'Z'
+    response['ETag'] = slice_etag(blob)
     return response
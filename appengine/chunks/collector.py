@@ -0,0 +1,238 @@
+"""
+Incremental mark-and-sweep audit for Chunks.
+
+Chunks are normally deleted when their reference count drops to zero
+(see blobs.models.update_references). This collector finds chunks
+that were never counted, e.g. written before reference counting, or
+orphaned by a failed request.
+
+Each run continues where the previous one stopped, for at most
+RUN_SECONDS, and collect_task chains runs until the cycle is done.
+The mark phase walks all Blobs in key order and saves the sha1s of
+chunked values as compact ChunkReferences per keyspace shard. The
+sweep phase walks Chunk keys in order, and deletes chunks that are
+not in the reference set, not written during the grace period, not
+counted by any Blob, and not referenced by any Blob in the sha1
+index. The final check protects Blobs written after the mark phase
+passed them.
+"""
+
+import time
+import logging
+from datetime import datetime, timedelta
+
+from google.appengine.ext import db
+
+from utils import tasks
+
+from chunks.models import Chunk, ChunkCollector, ChunkReferences
+from blobs.models import Blob, MAX_INTERNAL_SIZE
+
+RUN_SECONDS = 20
+PAGE_SIZE = 500
+DIGEST_BYTES = 8
+# Don't delete chunks written less than this long before the mark
+# phase started, e.g. a new Chunk whose Blob was not saved yet.
+GRACE_PERIOD = timedelta(hours=1)
+
+
+def shard_for_sha1(sha1):
+    """
+    The keyspace shard for a hex sha1.
+
+    >>> shard_for_sha1('235a7d')
+    2
+    >>> shard_for_sha1('f0')
+    15
+    """
+    return int(sha1[0], 16)
+
+
+def digest_for_sha1(sha1):
+    """
+    Compact binary prefix of a hex sha1.
+
+    >>> len(digest_for_sha1('235a7d3ce3a4c25d5a53dd76c4e7fd8df0d3ab2d'))
+    8
+    """
+    return sha1[:DIGEST_BYTES * 2].decode('hex')
+
+
+def get_collector():
+    collector = ChunkCollector.get_by_key_name('chunks')
+    if collector is None:
+        collector = ChunkCollector(key_name='chunks')
+    return collector
+
+
+def collect(seconds=RUN_SECONDS):
+    """
+    Run the collector for a limited time and save its progress.
+    Return the collector state.
+    """
+    collector = get_collector()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        if collector.phase == 'mark':
+            mark(collector, deadline)
+        elif collector.phase == 'sweep':
+            sweep(collector, deadline)
+        else:
+            clean(collector, deadline)
+            if collector.phase == 'mark':
+                # Start the next collection in the next cron run.
+                break
+    collector.put()
+    return collector
+
+
+def collect_task():
+    """
+    Task: continue the collection, and add another task until the
+    cycle is complete. Return the collector state.
+    """
+    collector = collect()
+    if collector.started is not None:
+        tasks.defer(collect_task)
+    return collector
+
+
+def next_phase(collector, phase):
+    collector.phase = phase
+    collector.cursor = None
+    if phase == 'mark':
+        collector.started = None
+        collector.marked = collector.checked = collector.deleted = 0
+        collector.cycles += 1
+    logging.info("Chunk collector phase: %s" % phase)
+
+
+def mark(collector, deadline):
+    """
+    Collect sha1s of chunked Blob values, one page at a time until
+    the deadline.
+    """
+    if collector.started is None:
+        collector.started = datetime.now()
+    shards = {}
+    query = Blob.all().order('__key__')
+    if collector.cursor:
+        query.with_cursor(collector.cursor)
+    while True:
+        blobs = query.fetch(PAGE_SIZE)
+        for blob in blobs:
+            if blob.sha1 and blob.size > MAX_INTERNAL_SIZE:
+                shards.setdefault(shard_for_sha1(blob.sha1), set()).add(
+                    digest_for_sha1(blob.sha1))
+        collector.cursor = query.cursor()
+        if len(blobs) < PAGE_SIZE:
+            next_phase(collector, 'sweep')
+            break
+        if time.time() >= deadline:
+            break
+        query = Blob.all().order('__key__').with_cursor(collector.cursor)
+    save_references(collector, shards)
+
+
+def save_references(collector, shards):
+    """
+    Append this run's digests to the reference set.
+    """
+    entities = []
+    for shard, digests in shards.items():
+        digests = list(digests)
+        digests.sort()
+        collector.marked += len(digests)
+        entities.append(ChunkReferences(shard=shard,
+                                        digests=''.join(digests)))
+    db.put(entities)
+
+
+def load_references(shard):
+    """
+    Load the referenced digests for one keyspace shard.
+    """
+    digests = set()
+    for references in ChunkReferences.all().filter('shard', shard):
+        data = references.digests
+        for start in range(0, len(data), DIGEST_BYTES):
+            digests.add(data[start:start + DIGEST_BYTES])
+    return digests
+
+
+def is_garbage(collector, sha1):
+    """
+    Check an unmarked chunk before deleting it.
+    """
+    # Don't load the chunk value into memcache.
+    chunk = db.get(db.Key.from_path('Chunk', sha1))
+    if chunk is None:
+        return False
+    if chunk.modified and chunk.modified > collector.started - GRACE_PERIOD:
+        return False
+    query = Blob.all(keys_only=True).filter('sha1', sha1)
+    if query.get() is not None:
+        return False
+    count = Chunk.count_references(sha1)
+    if count > 0:
+        logging.warning("Chunk %s has %d references but no Blobs" %
+                        (sha1, count))
+        return False
+    return True
+
+
+def sweep(collector, deadline):
+    """
+    Delete unreferenced chunks, one page at a time until the
+    deadline.
+    """
+    shard = None
+    references = None
+    query = Chunk.all(keys_only=True).order('__key__')
+    if collector.cursor:
+        query.with_cursor(collector.cursor)
+    while True:
+        keys = query.fetch(PAGE_SIZE)
+        garbage = []
+        for key in keys:
+            sha1 = key.name()
+            if shard_for_sha1(sha1) != shard:
+                shard = shard_for_sha1(sha1)
+                references = load_references(shard)
+            if digest_for_sha1(sha1) in references:
+                continue
+            if is_garbage(collector, sha1):
+                garbage.append(key)
+        collector.checked += len(keys)
+        if garbage:
+            Chunk.delete_chunks([key.name() for key in garbage])
+            collector.deleted += len(garbage)
+            logging.info("Deleted %d unreferenced chunks from %s to %s" % (
+                    len(garbage), garbage[0].name(), garbage[-1].name()))
+        collector.cursor = query.cursor()
+        if len(keys) < PAGE_SIZE:
+            next_phase(collector, 'clean')
+            break
+        if time.time() >= deadline:
+            break
+        query = Chunk.all(keys_only=True).order('__key__').with_cursor(
+            collector.cursor)
+
+
+def clean(collector, deadline):
+    """
+    Delete the reference set before the next mark phase.
+    """
+    while True:
+        keys = ChunkReferences.all(keys_only=True).fetch(PAGE_SIZE)
+        db.delete(keys)
+        if len(keys) < PAGE_SIZE:
+            next_phase(collector, 'mark')
+            break
+        if time.time() >= deadline:
+            break
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,13 +1,105 @@
+import random
+
 from google.appengine.ext import db
 
-from utils.mixins import Cacheable
+from utils.mixins import Timestamped, Cacheable
 
 # The maximum size for each datastore entity is 1048576 bytes.
 MAX_CHUNK_SIZE = 1000 * 1000  # bytes
 
+# Blobs with the same value share a Chunk, so its reference counter is
+# split into shards to avoid contention.
+COUNTER_SHARDS = 8
+# Delete an unreferenced Chunk only after this grace period, because
+# a new Blob may reuse it before its reference is counted.
+RELEASE_SECONDS = 60 * 60
+
 
 class Chunk(Cacheable):
     """
     The key name is the SHA-1 hash of the content.
     """
     value = db.BlobProperty()
+    modified = db.DateTimeProperty(auto_now=True)  # Last put.
+
+    @classmethod
+    def counter_keys(cls, sha1):
+        """
+        Datastore keys for all shards of the reference counter.
+        """
+        return [db.Key.from_path('ChunkCounter', '%s/%d' % (sha1, shard))
+                for shard in range(COUNTER_SHARDS)]
+
+    @classmethod
+    def add_reference(cls, sha1, delta=1):
+        """
+        Add delta to the reference count, in a random shard.
+        """
+        key = random.choice(cls.counter_keys(sha1))
+
+        def transaction():
+            counter = db.get(key)
+            if counter is None:
+                counter = ChunkCounter(key=key)
+            counter.count += delta
+            counter.put()
+        db.run_in_transaction(transaction)
+
+    @classmethod
+    def count_references(cls, sha1):
+        """
+        The number of Blobs that store their value in this Chunk.
+        """
+        counters = db.get(cls.counter_keys(sha1))
+        return sum([counter.count for counter in counters
+                    if counter is not None])
+
+    @classmethod
+    def delete_chunks(cls, sha1_list):
+        """
+        Delete Chunks from memcache and datastore, together with their
+        reference counters.
+        """
+        keys = [db.Key.from_path('Chunk', sha1) for sha1 in sha1_list]
+        cls.delete_keys(keys)
+        counter_keys = []
+        for sha1 in sha1_list:
+            counter_keys.extend(cls.counter_keys(sha1))
+        db.delete(counter_keys)
+
+
+class ChunkCounter(db.Model):
+    """
+    One shard of the reference counter for a Chunk. The key name is
+    the SHA-1 hash of the chunk, a slash, and the shard number.
+    """
+    count = db.IntegerProperty(default=0)
+
+
+class ChunkCollector(Timestamped):
+    """
+    Persistent state of the chunk garbage collector, saved between
+    cron runs. The key name is 'chunks'.
+
+    The phase is 'mark' (collect referenced sha1s from all Blobs),
+    'sweep' (delete unreferenced Chunks), or 'clean' (delete the
+    ChunkReferences for the next mark phase).
+    """
+    phase = db.StringProperty(default='mark')
+    started = db.DateTimeProperty()      # Start of the mark phase.
+    cursor = db.TextProperty()           # Query cursor in this phase.
+    marked = db.IntegerProperty(default=0)
+    checked = db.IntegerProperty(default=0)
+    deleted = db.IntegerProperty(default=0)
+    cycles = db.IntegerProperty(default=0)  # Completed collections.
+
+
+class ChunkReferences(Timestamped):
+    """
+    Referenced chunks found in one cron run of the mark phase, for
+    one shard of the sha1 keyspace (first hex digit). Digests are the
+    first bytes of each binary sha1, sorted and concatenated. Prefix
+    collisions can only keep garbage, never delete a live chunk.
+    """
+    shard = db.IntegerProperty()
+    digests = db.BlobProperty()
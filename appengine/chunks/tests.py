@@ -1,5 +1,6 @@
 import datetime
 import hashlib
+import doctest
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
@@ -13,7 +14,8 @@ from apps.tests import AppTestCase
 from apps.models import App
 from docs.models import Doc
 from blobs.models import Blob, MAX_INTERNAL_SIZE
-from chunks.models import Chunk
+from chunks.models import Chunk, ChunkReferences
+from chunks import collector
 
 
 class ChunkTest(AppTestCase):
@@ -47,3 +49,63 @@ class ChunkTest(AppTestCase):
         self.assertContains(response, 'Found 1 chunks')
         self.assertContains(response, 'and 4 blobs')
         self.assertNotContains(response, 'Blobs without Chunks')
+
+
+class CollectorTest(AppTestCase):
+
+    def setUp(self):
+        super(CollectorTest, self).setUp()
+        self.live = Blob(key_name='myapp/mydoc/live/',
+                         value='a' * MAX_INTERNAL_SIZE + 'live')
+        self.live.put()
+        self.orphan_sha1 = hashlib.sha1('orphan').hexdigest()
+        Chunk(key_name=self.orphan_sha1, value='orphan').put()
+        self.grace_period = collector.GRACE_PERIOD
+        collector.GRACE_PERIOD = datetime.timedelta(0)
+        self.page_size = collector.PAGE_SIZE
+
+    def tearDown(self):
+        collector.GRACE_PERIOD = self.grace_period
+        collector.PAGE_SIZE = self.page_size
+        super(CollectorTest, self).tearDown()
+
+    def test_doctest(self):
+        """Run doctest on the collector module."""
+        (failures, tests) = doctest.testmod(collector)
+        self.assertEqual(failures, 0)
+
+    def test_collect(self):
+        """A full cycle deletes only unreferenced chunks."""
+        state = collector.collect()
+        self.assertEqual(state.phase, 'mark')
+        self.assertEqual(state.cycles, 1)
+        self.assertTrue(Chunk.exists(self.live.sha1))
+        self.assertFalse(Chunk.exists(self.orphan_sha1))
+        self.assertEqual(ChunkReferences.all().count(), 0)
+
+    def test_grace_period(self):
+        """Recently written chunks are not deleted."""
+        collector.GRACE_PERIOD = datetime.timedelta(hours=1)
+        collector.collect()
+        self.assertTrue(Chunk.exists(self.orphan_sha1))
+
+    def test_resume(self):
+        """Progress is saved between runs, one page at a time."""
+        collector.PAGE_SIZE = 1
+        state = collector.get_collector()
+        collector.mark(state, 0)
+        state.put()
+        self.assertEqual(state.phase, 'mark')
+        self.assertTrue(state.cursor)
+        # A blob written after the mark phase passed its key.
+        blob = Blob(key_name='apps/myapp/new.html/',
+                    value='b' * MAX_INTERNAL_SIZE + 'new')
+        blob.put()
+        state = collector.get_collector()
+        while state.phase != 'clean':
+            collector.collect(0)
+            state = collector.get_collector()
+        self.assertTrue(state.deleted >= 1)
+        self.assertTrue(Chunk.exists(blob.sha1))
+        self.assertTrue(Chunk.exists(self.live.sha1))
+        self.assertFalse(Chunk.exists(self.orphan_sha1))
@@ -4,4 +4,5 @@ urlpatterns = patterns(
     'chunks.views',
     (r'^([0-9a-f]+)/?$', 'chunk_get'),
     (r'^cron/vacuum/([0-9a-f]*)/?$', 'vacuum'),
+    (r'^cron/collect/$', 'collect_garbage'),
 )
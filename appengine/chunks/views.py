@@ -9,6 +9,7 @@ from google.appengine.ext import db
 from utils.shortcuts import render_to_response, lookup_or_404
 
 from chunks.models import Chunk
+from chunks.collector import collect_task
 from blobs.models import Blob, MAX_INTERNAL_SIZE
 
 MAX_VACUUM_CHUNKS = 100
@@ -22,6 +23,19 @@ def chunk_get(request, key_name):
     return HttpResponse(chunk.value, mimetype='text/plain')
 
 
+def collect_garbage(request):
+    """
+    Start or continue a full audit of unreferenced chunks, in a chain
+    of background tasks.
+    """
+    collector = collect_task()
+    return HttpResponse(
+        "Phase: %s\nMarked: %d\nChecked: %d\nDeleted: %d\nCycles: %d\n" % (
+            collector.phase, collector.marked, collector.checked,
+            collector.deleted, collector.cycles),
+        content_type='text/plain')
+
+
 def vacuum(request, start):
     """
     Delete Chunks that are no longer referenced by any Blobs.
@@ -35,9 +49,9 @@ def vacuum(request, start):
     REVIEW: The method of sweeping does not scale as the store gets
     larger - the reason being that the starting point will only hit
     points at random based on the time of day.  There may also be
-    more than 1,000 entries between start points.  This should be
-    changed to use task queues to pick up the sweep from the point
-    left off by the previous sweep.
+    more than 1,000 entries between start points.  Chunks are deleted
+    when their reference count drops to zero, and collect_garbage
+    (chunks/collector.py) audits the whole store.
     """
     if not start:
         # Calculate fraction of the current day.
@@ -3,6 +3,8 @@ from datetime import datetime, timedelta
 from google.appengine.ext import db
 
 from utils.mixins import Migratable, Cacheable
+from utils import counters
+from utils.counters import CACHED_KINDS
 
 from auth.models import User
 from apps.models import App
@@ -10,6 +12,12 @@ from docs.models import Doc
 from blobs.models import Blob
 
 PROPERTIES = ['users', 'apps', 'docs', 'blobs']
+METRICS = ['bytes_put', 'chunks_created', 'chunks_deduped', 'chunk_bytes',
+           'push_conflicts', 'push_retries', 'hot_writes',
+           'channel_messages'] + \
+    [kind + suffix for kind in CACHED_KINDS for suffix in ('_hits', '_misses')]
+# Names of all counters that are saved in the statistics.
+STATS = PROPERTIES + METRICS
 
 
 def count_entities(model, property_name, start, stop):
@@ -28,10 +36,29 @@ class StatsHour(Migratable, Cacheable):
     Collect statistics for one hour.
     The key name is YYYYMMDDHH.
     """
-    users = db.IntegerProperty()
-    apps = db.IntegerProperty()
-    docs = db.IntegerProperty()
-    blobs = db.IntegerProperty()
+    users = db.IntegerProperty(default=0)
+    apps = db.IntegerProperty(default=0)
+    docs = db.IntegerProperty(default=0)
+    blobs = db.IntegerProperty(default=0)
+    # Operational metrics, from counters.record.
+    bytes_put = db.IntegerProperty(default=0)
+    chunks_created = db.IntegerProperty(default=0)
+    chunks_deduped = db.IntegerProperty(default=0)
+    chunk_bytes = db.IntegerProperty(default=0)
+    push_conflicts = db.IntegerProperty(default=0)
+    push_retries = db.IntegerProperty(default=0)
+    hot_writes = db.IntegerProperty(default=0)
+    channel_messages = db.IntegerProperty(default=0)
+    user_hits = db.IntegerProperty(default=0)
+    user_misses = db.IntegerProperty(default=0)
+    app_hits = db.IntegerProperty(default=0)
+    app_misses = db.IntegerProperty(default=0)
+    doc_hits = db.IntegerProperty(default=0)
+    doc_misses = db.IntegerProperty(default=0)
+    blob_hits = db.IntegerProperty(default=0)
+    blob_misses = db.IntegerProperty(default=0)
+    chunk_hits = db.IntegerProperty(default=0)
+    chunk_misses = db.IntegerProperty(default=0)
 
     def start_time(self):
         key_name = self.key().name()
@@ -41,7 +68,27 @@ class StatsHour(Migratable, Cacheable):
         hour = int(key_name[8:10])
         return datetime(year, month, day, hour)
 
+    def cache_hit_percent(self, kinds=CACHED_KINDS):
+        """
+        Percentage of memcache lookups that were hits.
+        """
+        hits = sum([getattr(self, kind + '_hits') or 0 for kind in kinds])
+        misses = sum([getattr(self, kind + '_misses') or 0 for kind in kinds])
+        if not hits + misses:
+            return 0
+        return 100 * hits / (hits + misses)
+
+    def add_counts(self, counts):
+        for property_name in STATS:
+            setattr(self, property_name,
+                    (getattr(self, property_name) or 0) +
+                    counts.get(property_name, 0))
+
     def update(self):
+        """
+        Recount with queries. The cost grows with the number of
+        entities, so this is only used to backfill statistics.
+        """
         start = self.start_time()
         stop = start + timedelta(hours=1)
         self.users = count_entities(User, 'created', start, stop)
@@ -71,11 +118,11 @@ class StatsDay(StatsHour):
 
     def update(self):
         parts = self.get_parts()
-        for property_name in PROPERTIES:
+        for property_name in STATS:
             count = 0
             for part in parts:
                 if part:
-                    count += getattr(part, property_name)
+                    count += getattr(part, property_name) or 0
             setattr(self, property_name, count)
 
 
@@ -90,3 +137,36 @@ class StatsMonth(StatsDay):
         keys = [db.Key.from_path('StatsDay', key_name + '%02d' % day)
                 for day in range(1, 32)]
         return db.get(keys)
+
+
+def add_stats(hour_name, counts):
+    """
+    Add counts to the statistics for one hour, and its day and month.
+    Return the updated (hour, day, month).
+    """
+    result = []
+    for model, key_name in ((StatsHour, hour_name),
+                            (StatsDay, hour_name[:8]),
+                            (StatsMonth, hour_name[:6])):
+        stats = model.get_by_key_name(key_name)
+        if stats is None:
+            stats = model(key_name=key_name)
+        if sum(counts.values()):
+            stats.add_counts(counts)
+            stats.put(write_through=True)
+        result.append(stats)
+    return result
+
+
+def flush_stats(now=None):
+    """
+    Move the buffered counters for the previous and the current hour
+    to the statistics. The cost doesn't depend on the number of
+    entities. Return (hour, day, month) for the current hour.
+    """
+    if now is None:
+        now = datetime.now()
+    previous = counters.hour_name(now - timedelta(hours=1))
+    add_stats(previous, counters.flush(previous, STATS))
+    current = counters.hour_name(now)
+    return add_stats(current, counters.flush(current, STATS))
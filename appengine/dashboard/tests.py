@@ -1,5 +1,16 @@
+import datetime
+import doctest
+
+from google.appengine.api import memcache
+
 from django.test import TestCase
 
+from utils import counters, profiler
+
+from apps.tests import AppTestCase
+from blobs.models import Blob
+from dashboard.models import StatsHour, StatsDay, StatsMonth, flush_stats
+
 
 class ClientTest(TestCase):
 
@@ -13,3 +24,189 @@ class ClientTest(TestCase):
         response = self.client.get('/dashboard')
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, '<title>Dashboard')
+
+
+class CounterTest(AppTestCase):
+
+    def setUp(self):
+        memcache.flush_all()
+        super(CounterTest, self).setUp()
+        self.now = datetime.datetime.now()
+
+    def test_flush(self):
+        """New entities are counted in the hour, day and month."""
+        (hour, day, month) = flush_stats(self.now)
+        self.assertEqual(hour.key().name(), '2010111213')
+        self.assertEqual(hour.users, 2)
+        self.assertEqual(hour.docs, 2)
+        blobs = hour.blobs
+        self.assertTrue(blobs >= 3)
+        for stats in (day, month):
+            self.assertEqual(stats.users, 2)
+            self.assertEqual(stats.blobs, blobs)
+        # Counters are moved, not copied.
+        (hour, day, month) = flush_stats(self.now)
+        self.assertEqual(hour.users, 2)
+        self.assertEqual(month.blobs, blobs)
+
+    def test_incremental(self):
+        """Later counts are added, updates are not counted."""
+        blobs = flush_stats(self.now)[0].blobs
+        Blob(key_name='myapp/mydoc/another/', value='[]').put()
+        self.blob.value = '["changed"]'
+        self.blob.put()
+        (hour, day, month) = flush_stats(self.now)
+        self.assertEqual(hour.blobs, blobs + 1)
+        blobs += 1
+        self.assertEqual(StatsHour.get_by_key_name('2010111213').blobs, blobs)
+        self.assertEqual(StatsDay.get_by_key_name('20101112').blobs, blobs)
+        self.assertEqual(StatsMonth.get_by_key_name('201011').blobs, blobs)
+        self.assertEqual(hour.users, 2)
+
+    def test_overwrite(self):
+        """Blobs overwritten with PUT are not counted as new."""
+        blobs = flush_stats(self.now)[0].blobs
+        self.sign_in(self.peter)
+        for value in ('one', 'two'):
+            response = self.app_client.put('/docs/mydoc/newblob', value,
+                                           content_type='text/plain')
+            self.assertContains(response, '"Saved"')
+        response = self.app_client.put('/docs/mydoc/myblob', 'changed',
+                                       content_type='text/plain')
+        self.assertContains(response, '"Saved"')
+        self.assertEqual(flush_stats(self.now)[0].blobs, blobs + 1)
+
+
+class MetricsTest(AppTestCase):
+
+    def setUp(self):
+        memcache.flush_all()
+        super(MetricsTest, self).setUp()
+        self.now = datetime.datetime.now()
+        flush_stats(self.now)
+
+    def test_request(self):
+        """Metrics of a request are sent at the end of the request."""
+        self.sign_in(self.peter)
+        response = self.app_client.put('/docs/mydoc/newblob', 'x' * 1000,
+                                       content_type='text/plain')
+        self.assertContains(response, '"Saved"')
+        self.assertEqual(counters.PENDING.counts, None)
+        response = self.app_client.put('/docs/mydoc/other', 'x' * 1000,
+                                       content_type='text/plain')
+        (hour, day, month) = flush_stats(self.now)
+        self.assertEqual(hour.bytes_put, 2000)
+        self.assertEqual(hour.chunks_created, 1)
+        self.assertEqual(hour.chunk_bytes, 1000)
+        self.assertEqual(hour.chunks_deduped, 1)
+        self.assertEqual(month.bytes_put, 2000)
+        self.assertTrue(hour.doc_hits + hour.doc_misses > 0)
+
+    def test_cache(self):
+        """Memcache hits and misses are counted per kind."""
+        memcache.flush_all()
+        Blob.get_by_key_name('myapp/mydoc/')
+        Blob.get_by_key_name('myapp/mydoc/')
+        Blob.get_by_key_name_list(['myapp/mydoc/', 'myapp/mydoc/myblob/'])
+        (hour, day, month) = flush_stats(self.now)
+        self.assertEqual(hour.blob_hits, 2)
+        self.assertEqual(hour.blob_misses, 2)
+        self.assertEqual(hour.cache_hit_percent(['blob']), 50)
+
+    def test_batched(self):
+        """All counts of a request are sent with one memcache call."""
+        self.app_client.get('/index.html')
+        response = self.app_client.get('/index.html')
+        self.assertEqual(response.status_code, 200)
+        profile = profiler.CURRENT.last
+        rpcs = profile['rpcs']
+        self.assertFalse('memcache.Increment' in rpcs)
+        self.assertEqual(rpcs['memcache.BatchIncrement'], 1)
+        self.assertEqual(profile['memcache_calls'],
+                         rpcs.get('memcache.Get', 0) + 1)
+        (hour, day, month) = flush_stats(self.now)
+        self.assertTrue(hour.app_hits > 0)
+
+    def test_uncounted_kinds(self):
+        """Only the kinds on the dashboard have cache counters."""
+        counters.PENDING.counts = {}
+        try:
+            StatsHour.record_cache(hits=1)
+            Blob.record_cache(hits=1)
+            self.assertEqual(counters.PENDING.counts, {'blob_hits': 1})
+        finally:
+            counters.PENDING.counts = None
+
+    def test_bounded(self):
+        """A request sends its counts early if it records many names."""
+        counters.PENDING.counts = {}
+        try:
+            for index in range(counters.MAX_PENDING_NAMES + 1):
+                counters.record('test%d' % index)
+            self.assertEqual(counters.PENDING.counts, {})
+            counters.record('bytes_put', 10)
+            counters.record('bytes_put', 20)
+            self.assertEqual(counters.PENDING.counts, {'bytes_put': 30})
+            counters.send_pending()
+        finally:
+            counters.PENDING.counts = None
+        hour = flush_stats(self.now)[0]
+        self.assertEqual(hour.bytes_put, 30)
+
+
+class ProfileTest(AppTestCase):
+
+    def setUp(self):
+        memcache.flush_all()
+        super(ProfileTest, self).setUp()
+        self.slow_request_ms = profiler.SLOW_REQUEST_MS
+
+    def tearDown(self):
+        profiler.SLOW_REQUEST_MS = self.slow_request_ms
+        super(ProfileTest, self).tearDown()
+
+    def test_doctest(self):
+        """Run doctest on the profiler module."""
+        (failures, tests) = doctest.testmod(profiler)
+        self.assertEqual(failures, 0)
+
+    def test_rpc_hook(self):
+        """Memcache and datastore calls are counted with their bytes."""
+        profiler.start()
+        memcache.get('profiler-test')
+        memcache.get('profiler-test')
+        Blob.get_by_key_name('myapp/mydoc/myblob/')
+        profile = profiler.finish(123)
+        self.assertTrue(profile['memcache_calls'] >= 2)
+        self.assertTrue(profile['memcache_bytes'] > 0)
+        self.assertEqual(profile['rpcs']['memcache.Get'],
+                         profile['memcache_calls'])
+        self.assertEqual(profile['response_bytes'], 123)
+        self.assertEqual(profiler.finish(0), None)
+
+    def test_endpoints(self):
+        """Requests are aggregated per method and view function."""
+        self.sign_in(self.peter)
+        for index in range(3):
+            self.app_client.put('/docs/mydoc/blob%d' % index, 'data',
+                                content_type='text/plain')
+        self.app_client.get('/docs/mydoc/blob1')
+        stats = dict([(stats['endpoint'], stats)
+                      for stats in profiler.endpoint_stats()])
+        put = stats['PUT blobs.views.dispatch']
+        self.assertEqual(put['requests'], 3)
+        self.assertTrue(put['datastore_calls'] >= 3)
+        self.assertTrue(put['avg_response_bytes'] > 0)
+        self.assertTrue(put['p50'] <= put['p95'] <= put['p99'])
+        self.assertEqual(stats['GET blobs.views.dispatch']['requests'], 1)
+
+    def test_slow(self):
+        """Slow requests are logged with their RPC breakdown."""
+        profiler.SLOW_REQUEST_MS = -1
+        self.app_client.get('/docs/mydoc/myblob')
+        slow = profiler.slow_requests()
+        self.assertEqual(len(slow), 1)
+        self.assertEqual(slow[0]['endpoint'], 'GET blobs.views.dispatch')
+        self.assertTrue('memcache.Get=' in slow[0]['rpcs'])
+        response = self.www_client.get('/dashboard/profile/')
+        self.assertContains(response, 'GET blobs.views.dispatch')
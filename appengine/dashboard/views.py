@@ -5,10 +5,26 @@ from datetime import datetime, timedelta
 from google.appengine.ext import db
 
 from utils.shortcuts import render_to_response
+from utils import profiler
 
-from dashboard.models import StatsHour, StatsDay, StatsMonth
+from dashboard.models import StatsHour, StatsDay, StatsMonth, flush_stats
 
 SPARKLINE_HOURS = 14 * 24  # Two weeks.
+
+# Property name, color, and label for each sparkline.
+CHARTS = [
+    ('users', '00FF00', "New users per hour"),
+    ('apps', '0080FF', "New apps per hour"),
+    ('docs', 'FFFF00', "New docs per hour"),
+    ('blobs', 'FF0000', "New blobs per hour"),
+    ('bytes_put', 'FF8000', "Bytes PUT per hour"),
+    ('chunk_bytes', 'FF00FF', "New chunk bytes per hour"),
+    ('chunks_deduped', '8080FF', "Deduplicated chunks per hour"),
+    ('push_conflicts', 'FF4040', "PUSH conflicts per hour"),
+    ('hot_writes', 'FFFFFF', "Hot writes (memcache only) per hour"),
+    ('cache_hit_percent', '00FFFF', "Memcache hit percentage"),
+    ('channel_messages', '80FF80', "Channel messages per hour"),
+    ]
 ENCODING = string.uppercase + string.lowercase + string.digits + '.-'
 
 # Output sizes in pixels.
@@ -26,7 +42,10 @@ def sparkline(hours, property_name):
         if hour is None:
             values.append(0)
         else:
-            values.append(getattr(hour, property_name, None))
+            value = getattr(hour, property_name, None)
+            if callable(value):
+                value = value()
+            values.append(value)
     maximum = max(values)
     divider = max(10, maximum)
     chars = []
@@ -80,10 +99,10 @@ def dashboard(request):
     today = datetime.now()
     start = today - timedelta(hours=SPARKLINE_HOURS)
     dictionary = {
-        'users_chart': chart(hours, 'users', '00FF00'),
-        'apps_chart': chart(hours, 'apps', '0080FF'),
-        'docs_chart': chart(hours, 'docs', 'FFFF00'),
-        'blobs_chart': chart(hours, 'blobs', 'FF0000'),
+        'charts': [{'url': chart(hours, property_name, color),
+                    'color': color,
+                    'label': label}
+                   for property_name, color, label in CHARTS],
         'start_date': simple_date(start),
         'today_date': simple_date(today),
         'now': now.strftime('%Y-%m-%d %H:%M:%S UTC'),
@@ -92,19 +111,36 @@ def dashboard(request):
     return render_to_response(request, 'dashboard/index.html', dictionary)
 
 
+def profile(request):
+    """
+    Latency percentiles and RPC counts per endpoint, for the last
+    hour, and recent slow requests.
+    """
+    return render_to_response(request, 'dashboard/profile.html', {
+            'endpoints': profiler.endpoint_stats(),
+            'slow_requests': profiler.slow_requests(),
+            'minutes': profiler.WINDOWS * profiler.WINDOW_SECONDS / 60,
+            'slow_request_ms': profiler.SLOW_REQUEST_MS,
+            })
+
+
 def cron(request, date=None):
     """
-    Update statistics for the current hour, day, month.
+    Update statistics for the current hour, day, month from the
+    buffered counters. With a date, recount that hour with queries,
+    to backfill statistics from before the counters.
     """
     if date is None:
-        now = datetime.now() - timedelta(minutes=30)
-    else:
-        date = date.strip('/')
-        while len(date) < 10:
-            date += '01'
-        now = datetime.strptime(date, '%Y%m%d%H')
-    # Update current hour.
-    hour = StatsHour(key_name=now.strftime('%Y%m%d%H'))
+        (hour, day, month) = flush_stats()
+        return render_to_response(request, 'dashboard/cron.html', {
+                'hour': hour, 'day': day, 'month': month})
+    date = date.strip('/')
+    while len(date) < 10:
+        date += '01'
+    now = datetime.strptime(date, '%Y%m%d%H')
+    # Update current hour, keep the counted metrics.
+    key_name = now.strftime('%Y%m%d%H')
+    hour = StatsHour.get_by_key_name(key_name) or StatsHour(key_name=key_name)
     hour.update()
     hour.put()
     # Update current day.
@@ -0,0 +1,78 @@
+from django.conf import settings
+
+# Compiled access lists, keyed by (kind, key_name, sha1).
+ACL_CACHE = {}
+MAX_ACL_CACHE = 1000
+
+
+class AccessList(object):
+    """
+    Precomputed read and write permissions for an App or Doc.
+
+    The readers and writers lists are converted to sets, and the
+    virtual usernames 'public' and 'authenticated' are converted to
+    flags, so that each permission check is O(1) regardless of the
+    length of the lists.
+
+    AccessList.for_entity caches the compiled lists by the sha1 of the
+    entity, which includes owner, readers and writers. A new version
+    of the entity gets a new AccessList.
+    """
+
+    def __init__(self, owner, readers, writers):
+        self.owner = owner
+        self.readers = frozenset(readers)
+        self.writers = frozenset(writers)
+        self.super_users = frozenset(settings.SUPER_USERS)
+        self.public_read = 'public' in self.readers
+        self.authenticated_read = 'authenticated' in self.readers
+        self.public_write = 'public' in self.writers
+        self.authenticated_write = 'authenticated' in self.writers
+
+    @classmethod
+    def for_entity(cls, entity):
+        """
+        Get the compiled access list for this App or Doc, from the
+        process cache if possible.
+        """
+        sha1 = entity.sha1
+        if sha1 is None:
+            # Modified since the last hash, don't cache.
+            return cls(entity.owner, entity.readers, entity.writers)
+        cache_key = (entity.kind(), entity.key().name(), sha1)
+        acl = ACL_CACHE.get(cache_key)
+        if acl is None:
+            acl = cls(entity.owner, entity.readers, entity.writers)
+            if len(ACL_CACHE) >= MAX_ACL_CACHE:
+                ACL_CACHE.clear()
+            ACL_CACHE[cache_key] = acl
+        return acl
+
+    def is_member(self, username, usernames):
+        return (username == self.owner or
+                username in usernames or
+                username in self.super_users)
+
+    def is_readable(self, user=None):
+        """
+        Does this user have read permissions?
+        """
+        if self.public_read:
+            return True
+        if user is None:
+            return False
+        if self.authenticated_read:
+            return True
+        return self.is_member(user.get_username(), self.readers)
+
+    def is_writable(self, user=None):
+        """
+        Does this user have write permissions?
+        """
+        if self.public_write:
+            return True
+        if user is None:
+            return False
+        if self.authenticated_write:
+            return True
+        return self.is_member(user.get_username(), self.writers)
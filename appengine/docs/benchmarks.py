@@ -0,0 +1,67 @@
+"""
+Micro-benchmarks for documents, run by "manage.py benchmark" (see
+settings.MICRO_BENCHMARKS).
+"""
+
+from django.utils import simplejson as json
+
+from utils.benchmark import time_calls, report
+
+from apps.models import App
+from auth.models import User
+from docs.models import Doc
+from blobs.models import Blob
+
+APP_ID = 'micro'
+
+
+def create_fixtures(readers):
+    """
+    Create an app and a document with these readers.
+    """
+    app = App(key_name=APP_ID, url='http://%s.pageforest.com/' % APP_ID,
+              title="Micro", owner=APP_ID, readers=readers,
+              secret='micro_secret')
+    app.put()
+    doc = Doc(key_name=APP_ID + '/doc', doc_id='doc', title="Micro",
+              owner=APP_ID, readers=readers)
+    doc.put()
+    return app, doc
+
+
+def update_hash():
+    """
+    Incremental hashing after a title change, against full
+    serialization, for entities with long lists.
+    """
+    readers = ['user%d' % index for index in range(2000)]
+    app, doc = create_fixtures(readers)
+    Blob(key_name=doc.blob_key_prefix() + '/',
+         value=json.dumps({'items': readers})).put()
+    lines = []
+    for entity in (app, doc):
+        exclude = entity.nohash_props()
+        full = time_calls(lambda: entity.to_json(exclude=exclude), 20)
+        entity.update_hash()
+
+        def update_title():
+            entity.title = entity.title + 'x'
+            entity.update_hash()
+        incremental = time_calls(update_title, 20)
+        lines.append(report(entity.kind() + ' PUT update_hash',
+                            incremental, full))
+    return lines
+
+
+def large_lists():
+    """
+    Permission checks with long reader lists, against a linear scan.
+    """
+    readers = ['user%d' % index for index in range(10000)]
+    create_fixtures(readers)
+    user = User(key_name='user9999', username='user9999',
+                email='user@example.com')
+    doc = Doc.get_view_by_key_name(APP_ID + '/doc')
+    linear = time_calls(lambda: 'user9999' in readers, 200)
+    compiled = time_calls(lambda: doc.is_readable(user), 200)
+    return [report('is_readable with 10k readers', compiled, linear)]
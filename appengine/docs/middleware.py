@@ -43,12 +43,16 @@ class DocMiddleware(object):
         # Try to load the document for this request.
         doc_id = match.group(1)
         key_name = '/'.join((request.app.get_app_id(), doc_id.lower()))
-        request.doc = Doc.get_by_key_name(key_name)
+        request.doc = Doc.get_view_by_key_name(key_name)
 
         if request.doc:
             if not request.doc.deleted:
                 # Found
                 return
+            elif request.method == 'DELETE' and \
+                    DOC_REGEX.match(request.path_info):
+                # Tombstone - DELETE again returns the progress.
+                return
             else:
                 # Tombstone - treat as not found.
                 request.doc = None
@@ -15,6 +15,8 @@ class Doc(SuperDoc):
     Metadata for each PageForest document (saved application state).
     Entity key name format: app_id/doc_id (all lower case).
     """
+    stats_name = 'docs'  # Count new entities for the dashboard.
+
     doc_id = db.StringProperty()  # May contain uppercase letters.
 
     """
@@ -78,6 +80,18 @@ class Doc(SuperDoc):
         props = super(Doc, cls).nohash_props()
         return props + ('doc_id',)
 
+    def extra_hash_snapshots(self, exclude):
+        """
+        The root blob is part of the hash. Its sha1 identifies the
+        value, so the JSON is only parsed again if the blob changed.
+        """
+        if 'blob' in exclude:
+            return {}
+        blob = blobs.models.Blob.get_by_key_name(self.blob_key_prefix() + '/')
+        if blob is None:
+            return {}
+        return {'blob': (('Blob', blob.sha1), lambda: json.loads(blob.value))}
+
     def to_json(self, exclude=None):
         """
         Standard json formatted string for the document.
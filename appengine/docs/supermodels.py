@@ -4,12 +4,12 @@ from google.appengine.ext import db
 
 from django.conf import settings
 
-from google.appengine.runtime import DeadlineExceededError
-
+from utils import tasks
 from utils.mixins import Timestamped, Migratable, Taggable, Cacheable, Hashable
 from utils.json import assert_boolean, assert_string, assert_string_list
 
 from blobs.models import Blob
+from docs.acl import AccessList
 
 PAGING_SIZE = 500
 
@@ -30,10 +30,16 @@ class SuperDoc(Timestamped, Migratable, Taggable, Hashable, Cacheable):
     writers = db.StringListProperty()  # Usernames that have write access.
     readers = db.StringListProperty()  # Usernames that have read access.
     deleted = db.BooleanProperty(default=False)
+    deleted_blobs = db.IntegerProperty(default=0)  # Progress of delete.
 
     current_schema = 200               # Migratable schema should be
                                        # added to SuperDoc.schema
 
+    # Read-only methods that can be called on a CachedView.
+    view_methods = Cacheable.view_methods + (
+        'get_acl', 'is_readable', 'is_writable', 'blob_key_prefix',
+        'get_etag', 'delete_status')
+
     @classmethod
     def json_props(cls):
         props = super(SuperDoc, cls).json_props()
@@ -53,35 +59,23 @@ class SuperDoc(Timestamped, Migratable, Taggable, Hashable, Cacheable):
         self.readers = [username.lower() for username in self.readers]
         self.writers = [username.lower() for username in self.writers]
 
+    def get_acl(self):
+        """
+        Compiled permissions for the current version of this document.
+        """
+        return AccessList.for_entity(self)
+
     def is_readable(self, user=None):
         """
         Does this user have read permissions on this document?
         """
-        if 'public' in self.readers:
-            return True
-        if user is None:
-            return False
-        if 'authenticated' in self.readers:
-            return True
-        username = user.get_username()
-        return username == self.owner or \
-            username in self.readers or \
-            username in settings.SUPER_USERS
+        return self.get_acl().is_readable(user)
 
     def is_writable(self, user=None):
         """
         Does this user have write permissions on this document?
         """
-        if 'public' in self.writers:
-            return True
-        if user is None:
-            return False
-        if 'authenticated' in self.writers:
-            return True
-        username = user.get_username()
-        return username == self.owner or \
-            username in self.writers or \
-            username in settings.SUPER_USERS
+        return self.get_acl().is_writable(user)
 
     def update_writers(self, writers, **kwargs):
         """
@@ -129,53 +123,30 @@ class SuperDoc(Timestamped, Migratable, Taggable, Hashable, Cacheable):
         query.filter('__key__ <', db.Key.from_path('Blob', key_prefix + '0'))
         return query
 
-    def delete_blobs(self):
-        """
-        A document (or app) can contain child blobs.  If it's a small number,
-        we try to delete them here.  If not, we mark the doc as deleted and
-        will clean up the child blobs in the background (TBD).
-
-        Note that each call to delete_blobs() will attempt to delete more of the
-        blobs until it succeeds.
-
-        Returns:
-           True - document and all child blobs were successfully deleted,
-           False - document just marked as deleted - but children still exist
-        """
-        query = self.all_blobs(keys_only=True)
-        keys = None
-        count = 0
-        try:
-            while True:
-                keys = query.fetch(PAGING_SIZE)
-                if len(keys) == 0:
-                    break
-                Blob.delete_keys(keys)
-                count += len(keys)
-                if len(keys) < PAGING_SIZE:
-                    break
-                query.with_cursor(query.cursor())
-        except DeadlineExceededError:
-            logging.info("Deadline Exceeded for %s.delete(%s) - %d confirmed." %
-                         (self.kind(), self.key().name(), count))
-            return False
-
-        logging.info("Deleted %d child blobs of %s:%s." %
-                     (count, self.kind(), self.key().name()))
-        return True
-
     def delete(self):
         """
-        Override delete operation - tries to delete all child blobs as well.
-
-        The document will either be marked as deleted or actually deleted if
-        all it's child blobs can be deleted before the request deadline is
-        exceeded.
+        Override delete operation - marks the document (or app) as
+        deleted and returns immediately. Child blobs, and then the
+        entity itself, are deleted by a chain of background tasks.
         """
         self.deleted = True
+        self.deleted_blobs = 0
         self.put()
-        if self.delete_blobs():
-            super(SuperDoc, self).delete()
+        tasks.defer(delete_children, self.__class__, self.key().name(),
+                    before=self.modified)
+
+    def purge(self):
+        """
+        Delete the entity itself, after all child blobs are gone.
+        """
+        super(SuperDoc, self).delete()
+
+    def delete_status(self):
+        """
+        Progress of a background delete, for JSON responses.
+        """
+        return {'deleting': self.deleted,
+                'deletedBlobs': self.deleted_blobs}
 
     def update_boolean_property(self, parsed, key, pykey=None):
         # TODO: Merge update_*_property methods into one and detect
@@ -215,3 +186,43 @@ class SuperDoc(Timestamped, Migratable, Taggable, Hashable, Cacheable):
             self.update_string_list_property(parsed, key, **kwargs)
         self.normalize_lists()
         self.invalidate_hash()
+
+
+def delete_children(model_class, key_name, cursor=None, before=None):
+    """
+    Task: delete one page of child blobs of a deleted App or Doc, then
+    add a task for the next page. When no children are left, delete
+    the entity itself.
+
+    If the entity was created again in the meantime, the task keeps
+    going, but only deletes blobs that were modified before the
+    delete, so the new children are kept.
+    """
+    entity = model_class.get_by_key_name(key_name)
+    if entity is None:
+        # Already purged.
+        return
+    recreated = not entity.deleted
+    if recreated and before is None:
+        return
+    query = entity.all_blobs(keys_only=not recreated)
+    if cursor:
+        query.with_cursor(cursor)
+    results = query.fetch(PAGING_SIZE)
+    if recreated:
+        keys = [blob.key() for blob in results if blob.modified <= before]
+    else:
+        keys = results
+    Blob.delete_keys(keys)
+    if len(results) < PAGING_SIZE:
+        if not recreated:
+            logging.info("Deleted %d child blobs of %s:%s." %
+                         (entity.deleted_blobs + len(keys), entity.kind(),
+                          key_name))
+            entity.purge()
+        return
+    if not recreated:
+        entity.deleted_blobs += len(keys)
+        entity.put()
+    tasks.defer(delete_children, model_class, key_name, query.cursor(),
+                before)
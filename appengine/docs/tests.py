@@ -1,12 +1,20 @@
 import datetime
 import logging
 
+from mock import Mock
+
 from django.conf import settings
 from django.utils import simplejson as json
 
 from apps.tests import AppTestCase
+from utils import tasks
 
+from auth.models import User
 from docs.models import Doc
+from docs import supermodels
+from docs.acl import AccessList
+from blobs.models import Blob
+from chunks.models import Chunk
 
 
 class DocumentTest(AppTestCase):
@@ -57,6 +65,20 @@ class DocumentTest(AppTestCase):
         response = self.app_client.get('/docs/MYDOC')
         self.assertEqual(response.content, canonical_content)
 
+    def test_not_modified(self):
+        """Revalidation doesn't load the root blob of the document."""
+        Blob(key_name='myapp/mydoc/', value=json.dumps(range(1000))).put()
+        self.doc.put()
+        etag = self.app_client.get('/docs/mydoc')['ETag']
+        Chunk.get_by_key_name = Mock(side_effect=Chunk.get_by_key_name)
+        try:
+            response = self.app_client.get('/docs/mydoc',
+                                           HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(Chunk.get_by_key_name.call_count, 0)
+        finally:
+            del Chunk.get_by_key_name
+
     def test_404(self):
         """Test that missing document prevents blob access."""
         response = self.app_client.get('/docs/unknown/')
@@ -110,8 +132,72 @@ class DocumentTest(AppTestCase):
         blobs = self.doc.all_blobs().fetch(100)
         self.assertEqual(len(blobs), 3)
         self.doc.delete()
+        tasks.run_local_tasks()
         blobs = self.doc.all_blobs().fetch(100)
         self.assertEqual(len(blobs), 0)
+        self.assertEqual(Doc.get_by_key_name('myapp/mydoc'), None)
+
+
+class BackgroundDeleteTest(AppTestCase):
+
+    def setUp(self):
+        super(BackgroundDeleteTest, self).setUp()
+        self.paging_size = supermodels.PAGING_SIZE
+        supermodels.PAGING_SIZE = 2
+        for index in range(5):
+            Blob(key_name='myapp/mydoc/child%d/' % index, value='x').put()
+        self.sign_in(self.peter)
+
+    def tearDown(self):
+        supermodels.PAGING_SIZE = self.paging_size
+        super(BackgroundDeleteTest, self).tearDown()
+
+    def run_one_task(self):
+        func, args, kwargs = tasks.LOCAL_TASKS.pop(0)
+        func(*args, **kwargs)
+
+    def test_task_chain(self):
+        """DELETE returns at once, and tasks delete a page at a time."""
+        response = self.app_client.delete('/docs/mydoc')
+        self.assertContains(response, '"statusText": "Deleted"')
+        self.assertContains(response, '"deleting": true')
+        # The blobs are still there, but hidden by the tombstone.
+        self.assertEqual(self.doc.all_blobs().count(), 7)
+        self.assertEqual(self.app_client.get('/docs/mydoc').status_code, 404)
+        self.run_one_task()
+        self.assertEqual(self.doc.all_blobs().count(), 5)
+        # Repeated DELETE reports the progress.
+        response = self.app_client.delete('/docs/mydoc')
+        self.assertContains(response, '"statusText": "Deleting"')
+        self.assertContains(response, '"deletedBlobs": 2')
+        self.assertEqual(tasks.run_local_tasks(), 3)
+        self.assertEqual(self.doc.all_blobs().count(), 0)
+        self.assertEqual(Doc.get_by_key_name('myapp/mydoc'), None)
+        response = self.app_client.delete('/docs/mydoc')
+        self.assertEqual(response.status_code, 404)
+
+    def test_recreated(self):
+        """A document created again keeps only its new blobs."""
+        self.app_client.delete('/docs/mydoc')
+        datetime.datetime.advance_time(1)
+        response = self.app_client.put(
+            '/docs/mydoc', '{"title": "New", "blob": {"new": true}}',
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertContains(
+            self.app_client.put('/docs/mydoc/child9', 'new',
+                                content_type='text/plain'), '"Saved"')
+        tasks.run_local_tasks()
+        for index in range(5):
+            self.assertEqual(
+                Blob.get_by_key_name('myapp/mydoc/child%d/' % index), None)
+        self.assertEqual(Blob.get_by_key_name('myapp/mydoc/myblob/'), None)
+        self.assertEqual(Blob.get_by_key_name('myapp/mydoc/child9/').value,
+                         'new')
+        self.assertEqual(self.doc.all_blobs().count(), 2)
+        response = self.app_client.get('/docs/mydoc')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '"new": true')
 
 
 class PermissionTest(AppTestCase):
@@ -170,6 +256,49 @@ class PermissionTest(AppTestCase):
                             status_code=403)
 
 
+class AccessListTest(AppTestCase):
+
+    def test_flags(self):
+        """Virtual usernames should be compiled to flags."""
+        acl = AccessList('peter', ['public'], ['authenticated'])
+        self.assertTrue(acl.public_read)
+        self.assertFalse(acl.authenticated_read)
+        self.assertTrue(acl.is_readable(None))
+        self.assertFalse(acl.is_writable(None))
+        self.assertTrue(acl.is_writable(self.paul))
+        acl = AccessList('peter', ['paul'], [])
+        self.assertFalse(acl.is_readable(None))
+        self.assertTrue(acl.is_readable(self.peter))
+        self.assertTrue(acl.is_readable(self.paul))
+        self.assertFalse(acl.is_writable(self.paul))
+        self.assertTrue(acl.is_writable(self.peter))
+
+    def test_cache(self):
+        """The compiled list should be cached by sha1."""
+        acl = self.private_doc.get_acl()
+        self.assertTrue(self.private_doc.get_acl() is acl)
+        self.assertFalse(self.private_doc.is_readable(self.paul))
+        self.private_doc.readers = ['paul']
+        self.private_doc.put()
+        self.assertFalse(self.private_doc.get_acl() is acl)
+        self.assertTrue(self.private_doc.is_readable(self.paul))
+        doc = Doc.get_view_by_key_name('myapp/private')
+        self.assertTrue(doc.is_readable(self.paul))
+
+    def test_large_lists(self):
+        """Permission checks should work with long reader lists."""
+        readers = ['user%d' % index for index in range(10000)]
+        self.private_doc.readers = readers
+        self.private_doc.writers = readers
+        self.private_doc.put()
+        user = User(key_name='user9999', username='user9999',
+                    email='user@example.com')
+        doc = Doc.get_view_by_key_name('myapp/private')
+        self.assertTrue(doc.is_readable(user))
+        self.assertTrue(doc.is_writable(user))
+        self.assertFalse(doc.is_writable(self.paul))
+
+
 class TimestampedTest(AppTestCase):
 
     def test_timestamped_mixin(self):
@@ -208,3 +337,36 @@ class HashableTest(AppTestCase):
         self.assertTrue(hasattr(self.doc, 'sha1'))
         self.assertTrue(hasattr(self.doc, 'size'))
         self.assertTrue(self.doc.size > 5, self.doc.size)
+
+    def test_canonical_json(self):
+        """The cached fragments should produce the same JSON as to_json."""
+        for entity in (self.doc, self.app, self.private_doc):
+            self.assertEqual(entity.canonical_json(),
+                             entity.to_json(exclude=entity.nohash_props()))
+
+    def test_changed_hash_props(self):
+        """Changes since the last hash should be tracked."""
+        self.doc.update_hash()
+        sha1 = self.doc.sha1
+        self.assertEqual(self.doc.changed_hash_props(), [])
+        self.doc.title = "Changed"
+        self.doc.tags.append('four')
+        self.assertEqual(self.doc.changed_hash_props(), ['tags', 'title'])
+        self.doc.update_hash()
+        self.assertNotEqual(self.doc.sha1, sha1)
+        self.assertEqual(self.doc.changed_hash_props(), [])
+        # Root blob changes are detected by sha1.
+        Blob(key_name='myapp/mydoc/', value='{"int": 456}').put()
+        self.assertEqual(self.doc.changed_hash_props(), ['blob'])
+
+    def test_put_unchanged(self):
+        """A loaded entity is stored without hashing if unchanged."""
+        doc = Doc.get_by_key_name('myapp/mydoc')
+        self.assertEqual(doc.changed_hash_props(), [])
+        doc.update_hash = Mock()
+        doc.put()
+        self.assertFalse(doc.update_hash.called)
+        doc.title = "Changed"
+        self.assertEqual(doc.changed_hash_props(), ['title'])
+        doc.put()
+        self.assertTrue(doc.update_hash.called)
@@ -13,8 +13,8 @@ from google.appengine.ext import db
 from utils.json import ModelEncoder
 from utils.decorators import jsonp, method_required, no_cache
 from utils.shortcuts import render_to_response
-from utils.http import http_datetime
-from utils.channel import dispatch_subscriptions
+from utils.http import http_datetime, is_not_modified
+from utils import changes
 from auth.decorators import login_required
 from auth.middleware import AccessDenied
 
@@ -137,10 +137,10 @@ def dispatch(request, doc_id):
 @no_cache
 def doc_get(request, doc_id):
     """
-    Return JSON formatted representation of a Doc.
+    Return JSON formatted representation of a Doc. Conditional
+    requests are checked before the root blob is loaded.
     """
-    etag = request.doc.get_etag()
-    if etag == request.META.get('HTTP_IF_NONE_MATCH', ''):
+    if is_not_modified(request, request.doc.get_etag(), request.doc.modified):
         response = HttpResponseNotModified(mimetype=settings.JSON_MIMETYPE_CS)
     else:
         response = HttpResponse(request.doc.to_json(), mimetype=settings.JSON_MIMETYPE_CS)
@@ -182,10 +182,10 @@ def doc_put(request, doc_id):
     # Write document after blob updated - for sha1 calculation
     request.doc.put()
 
-    dispatch_subscriptions(key_name, 'PUT',
-                           {'sha1': request.doc.sha1,
-                            'size': request.doc.size,
-                            'modified': request.doc.modified})
+    changes.publish(key_name, 'PUT',
+                    {'sha1': request.doc.sha1,
+                     'size': request.doc.size,
+                     'modified': request.doc.modified})
 
     response = HttpJSONResponse({
         'statusText': status == 200 and "Saved" or "Created",
@@ -201,14 +201,20 @@ def doc_put(request, doc_id):
 
 def doc_delete(request, docid):
     """
-    HTTP DELETE request handler.
+    HTTP DELETE request handler. The document is marked as deleted,
+    and its blobs are deleted in the background. Repeated DELETE
+    requests return the progress until the document is gone.
 
     TODO: Have an if-modified and return 409 Conflict if
     the passed in hash or modified date is incorrect.
     """
+    if request.doc.deleted:
+        return HttpJSONResponse(dict(statusText="Deleting",
+                                     **request.doc.delete_status()))
     request.doc.delete()
+    status = request.doc.delete_status()
     request.doc = None
-    return HttpJSONResponse({'statusText': "Deleted"})
+    return HttpJSONResponse(dict(statusText="Deleted", **status))
 
 
 @no_cache
@@ -31,6 +31,10 @@ DEBUG = DEV_APPSERVER
 TEMPLATE_DEBUG = DEBUG
 
 USE_APPSTATS = not DEBUG
+# Per-endpoint latency and RPC counts on /dashboard/profile/. This adds
+# one memcache call to each request, so it's off in production unless
+# enabled here for a while.
+USE_PROFILER = not RUNNING_ON_GAE
 
 ADMINS = (
     ('Mike Koss', 'mckoss@pageforest.com'),
@@ -57,6 +61,28 @@ CHANNEL_PREFIX = 'CH1'
 # Cacheable mixin: show memcache and datastore hits in the server log.
 CACHEABLE_LOGGING = False
 
+# Functions called with (key, method, data) for each change published
+# on the change bus (utils.changes).
+CHANGE_LISTENERS = (
+    'utils.channel.dispatch_subscriptions',
+    )
+
+# Micro-benchmarks run by "manage.py benchmark" after the request
+# workloads. Each function returns a list of utils.benchmark.report
+# lines.
+MICRO_BENCHMARKS = (
+    'docs.benchmarks.update_hash',
+    'docs.benchmarks.large_lists',
+    'auth.benchmarks.referers',
+    'auth.benchmarks.verify_session',
+    'utils.benchmarks.bus_latency',
+    'backups.benchmarks.restore_throughput',
+    )
+
+# Run deferred tasks in-process with utils.tasks.run_local_tasks
+# instead of the task queue, e.g. for "manage.py test".
+TASKS_LOCAL = sys.argv[1:2] == ['test']
+
 # Use appengine database backend for "manage.py test" etc.
 if os.path.basename(sys.argv[0]) == 'manage.py':
     DATABASE_ENGINE = 'appengine'
@@ -249,16 +275,22 @@ MIDDLEWARE_CLASSES = [
     'utils.middleware.ResponseNotFoundMiddleware',  # Render HTML for 404.
     'utils.middleware.ApiProxyErrorMiddleware',  # Return 503 for read-only.
     'utils.middleware.RequestMiddleware',    # Save request in threading.local.
+    'utils.counters.CounterMiddleware',      # Send dashboard counts.
     'utils.middleware.WwwMiddleware',        # Prepend www if needed.
     'utils.middleware.SlashMiddleware',      # Add trailing slash if needed.
     'mirror.middleware.MirrorMiddleware',    # Cross-domain aliases.
     'apps.middleware.AppMiddleware',         # Get the app.
+    'blobs.middleware.StaticMiddleware',     # Fast path for public files.
     'blobs.middleware.PostMiddleware',       # Rewrite POST to PUT for blobs.
     'docs.middleware.DocMiddleware',         # Get the document.
     'auth.middleware.AuthMiddleware',        # Check access permissions.
+    'utils.channel.ChannelMiddleware',       # Dispatch change messages.
     'utils.cookies.HttpOnlyMiddleware',      # Adjust cookies to HttpOnly.
 ]
 
+if USE_PROFILER:
+    MIDDLEWARE_CLASSES.insert(0, 'utils.profiler.ProfileMiddleware')
+
 if USE_APPSTATS:
     MIDDLEWARE_CLASSES.insert(0,
         'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware')
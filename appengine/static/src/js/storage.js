@@ -178,6 +178,18 @@ namespace.lookup('com.pageforest.storage').defineOnce(function (ns) {
             //
             // TODO: Change key to docid:, blobid:
             var message = JSON.parse(evt.data);
+
+            // Coalesced changes: {method: 'BATCH', changes: [message, ...]}
+            if (message.method == 'BATCH') {
+                for (var i = 0; i < message.changes.length; i++) {
+                    this.onMessage(message.changes[i]);
+                }
+                return;
+            }
+            this.onMessage(message);
+        },
+
+        onMessage: function(message) {
             var sub;
             var fSent = false;
 
@@ -226,6 +238,8 @@ namespace.lookup('com.pageforest.storage').defineOnce(function (ns) {
 
             options = options || {};
             options.enabled = (fn != undefined);
+            // We can receive coalesced BATCH messages.
+            options.batch = true;
             options.fn = fn;
 
             var key = docid + '/';
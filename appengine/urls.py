@@ -36,6 +36,9 @@ urlpatterns = patterns(
 
     # Static hosting for Pageforest apps.
     (r'^app/admin/app.json/$', 'apps.views.app_json'),
+    # Versioned URLs for static app files, generated by pf.py.
+    (r'^app/(?P<admin>admin/)?_v/(?P<sha1>[0-9a-f]{40})/(?P<key>.*)$',
+     'blobs.views.versioned_get'),
     # Static app blob resources (files) - docid will be empty
     (r'^app/(admin/)?(?P<doc_id>)(?P<key>.*)$',
      'blobs.views.dispatch'),
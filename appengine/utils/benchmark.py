@@ -0,0 +1,146 @@
+import time
+import logging
+
+from django.conf import settings
+from django.utils import simplejson as json
+from django.utils.importlib import import_module
+
+from utils import profiler
+
+
+def time_calls(func, repeat=100):
+    """
+    Call func repeatedly and return the average wall time per call,
+    in seconds.
+
+    >>> time_calls(lambda: None, 10) < 0.01
+    True
+    """
+    start = time.time()
+    for count in xrange(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def report(name, seconds, baseline=None):
+    """
+    Log the result of a micro-benchmark, with the speedup over the
+    baseline if specified.
+    """
+    message = "Benchmark %s: %.1f us per call" % (name, seconds * 1e6)
+    if baseline:
+        message += " (%.1fx faster than %.1f us)" % (
+            baseline / max(seconds, 1e-9), baseline * 1e6)
+    logging.info(message)
+    return message
+
+
+def run_micro(paths=None):
+    """
+    Run the micro-benchmark functions named in settings.MICRO_BENCHMARKS,
+    and return their report lines.
+    """
+    if paths is None:
+        paths = settings.MICRO_BENCHMARKS
+    lines = []
+    for path in paths:
+        module, name = path.rsplit('.', 1)
+        lines.extend(getattr(import_module(module), name)())
+    return lines
+
+
+def percentile(values, fraction):
+    """
+    The value at this fraction of the sorted values.
+
+    >>> percentile(range(1, 101), 0.5), percentile(range(1, 101), 0.99)
+    (50, 99)
+    >>> percentile([], 0.5)
+    0
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    index = max(0, int(round(fraction * len(values))) - 1)
+    return values[index]
+
+
+def timed_request(func, *args, **kwargs):
+    """
+    Make a Django test client request, and return the response and
+    its profile from utils.profiler, with the wall time in ms and the
+    memcache and datastore call counts.
+    """
+    profiler.start()
+    response = func(*args, **kwargs)
+    # ProfileMiddleware replaces the profile if it is active.
+    profile = profiler.finish(len(response.content)) or profiler.CURRENT.last
+    return response, profile
+
+
+def summarize(profiles, seconds, errors=0):
+    """
+    Requests per second, latency percentiles and average RPC counts
+    for a list of request profiles, as a dict for JSON output.
+    """
+    count = len(profiles)
+    latencies = [profile['ms'] for profile in profiles]
+    result = {
+        'requests': count,
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(count / max(seconds, 1e-9), 1),
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        }
+    for field in ('memcache_calls', 'datastore_calls',
+                  'memcache_bytes', 'datastore_bytes', 'response_bytes'):
+        total = sum([profile[field] for profile in profiles])
+        result[field] = round(float(total) / max(count, 1), 1)
+    return result
+
+
+def save_baseline(results, filename):
+    """
+    Save benchmark results as JSON, for comparison with later runs.
+    """
+    output = open(filename, 'w')
+    try:
+        output.write(json.dumps(results, sort_keys=True, indent=2))
+    finally:
+        output.close()
+
+
+def load_baseline(filename):
+    input = open(filename)
+    try:
+        return json.loads(input.read())
+    finally:
+        input.close()
+
+
+def compare(results, baseline):
+    """
+    Compare the throughput of each workload with the baseline, and
+    return a list of lines for the report.
+
+    >>> compare({'get': {'requests_per_second': 50.0}},
+    ...         {'get': {'requests_per_second': 100.0}})
+    ['get: 50.0 req/s (0.50x baseline 100.0 req/s)']
+    """
+    lines = []
+    for name in sorted(results.keys()):
+        current = results[name]['requests_per_second']
+        line = '%s: %.1f req/s' % (name, current)
+        if name in baseline:
+            previous = baseline[name]['requests_per_second']
+            line += ' (%.2fx baseline %.1f req/s)' % (
+                current / max(previous, 1e-9), previous)
+        lines.append(line)
+    return lines
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,34 @@
+"""
+Micro-benchmarks for utilities, run by "manage.py benchmark" (see
+settings.MICRO_BENCHMARKS).
+"""
+
+import time
+import threading
+
+from utils import changes
+from utils.benchmark import report
+
+
+def bus_latency():
+    """
+    Notify-to-delivery latency of MemoryBus for a waiting thread.
+    """
+    delivered = []
+    latencies = []
+    for attempt in range(20):
+        del delivered[:]
+        bus = changes.MemoryBus([])
+
+        def waiter():
+            bus.wait('myapp/mydoc/', None, 10)
+            delivered.append(time.time())
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.01)
+        published = time.time()
+        bus.publish('myapp/mydoc/', 'PUT', {'sha1': 'x'})
+        thread.join()
+        latencies.append(delivered[0] - published)
+    return [report('MemoryBus notify-to-delivery',
+                   sum(latencies) / len(latencies))]
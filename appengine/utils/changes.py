@@ -0,0 +1,130 @@
+"""
+Change bus for storage keys.
+
+Views that write a blob or document publish each change exactly once,
+after the write is committed. Consumers are the listeners named in
+settings.CHANGE_LISTENERS (e.g. channel subscriptions), called with
+(key, method, data), and long-polling requests that wait for the next
+change to a key.
+
+ChangeBus shares changes between instances through memcache. MemoryBus
+keeps them in this process and wakes up waiting threads directly, for
+tests and benchmarks.
+"""
+
+import time
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from google.appengine.api import memcache
+
+CHANGE_PREFIX = 'CB1'
+# Keep the latest change to each key in memcache for this long.
+CHANGE_LIFETIME = 60 * 60
+
+
+class ChangeBus(object):
+    """
+    Publish changes to storage keys, and wait for them. The tokens
+    are kept in memcache, so changes are shared between instances,
+    and waiting requests poll a small memcache entry for each key.
+    """
+
+    def __init__(self, listeners=None):
+        self.listeners = listeners
+
+    def get_listeners(self):
+        """
+        Import the listener functions from settings on first use.
+        """
+        if self.listeners is None:
+            listeners = []
+            for path in settings.CHANGE_LISTENERS:
+                module, name = path.rsplit('.', 1)
+                listeners.append(getattr(import_module(module), name))
+            self.listeners = listeners
+        return self.listeners
+
+    def publish(self, key, method, data):
+        """
+        Record the change to appid/key, then call all listeners.
+        """
+        self.record(key, (time.time(), data.get('sha1')))
+        for listener in self.get_listeners():
+            listener(key, method, data)
+
+    def change_key(self, key):
+        return '~'.join((CHANGE_PREFIX, key))
+
+    def record(self, key, token):
+        memcache.set(self.change_key(key), token, CHANGE_LIFETIME)
+
+    def latest(self, key):
+        """
+        Return a token for the latest change to appid/key, or None.
+        """
+        return memcache.get(self.change_key(key))
+
+    def wait(self, key, token, seconds):
+        """
+        Wait until the latest change to appid/key is no longer token.
+        Return the new token, or token again after the timeout.
+        """
+        start = time.time()
+        deadline = start + seconds
+        while time.time() < deadline:
+            # Sleep half a second, or one second after a while.
+            elapsed = time.time() - start
+            time.sleep(min(0.5 if elapsed < 7 else 1,
+                           max(0, deadline - time.time())))
+            latest = self.latest(key)
+            if latest != token:
+                return latest
+        return token
+
+
+class MemoryBus(ChangeBus):
+    """
+    Change bus for this process only.
+    """
+
+    def __init__(self, listeners=None):
+        super(MemoryBus, self).__init__(listeners)
+        self.tokens = {}
+        self.condition = threading.Condition()
+
+    def record(self, key, token):
+        self.condition.acquire()
+        try:
+            self.tokens[key] = token
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def latest(self, key):
+        return self.tokens.get(key)
+
+    def wait(self, key, token, seconds):
+        deadline = time.time() + seconds
+        self.condition.acquire()
+        try:
+            while self.tokens.get(key) == token:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.tokens.get(key)
+        finally:
+            self.condition.release()
+
+
+BUS = ChangeBus()
+
+
+def publish(key, method, data):
+    """
+    Publish a change to appid/key on the current change bus.
+    """
+    BUS.publish(key, method, data)
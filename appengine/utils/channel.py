@@ -1,6 +1,8 @@
 import datetime
 import time
 import logging
+import hashlib
+import threading
 
 from django.conf import settings
 from django.utils import simplejson as json
@@ -12,11 +14,28 @@ from utils.decorators import jsonp, method_required
 from utils.json import ModelEncoder, HttpJSONResponse
 from utils.shortcuts import project
 from utils import crypto
+from utils import tasks
+from utils import counters
 
 from auth.decorators import login_required
 
 CHANNEL_LIFETIME = 60 * 60 * 2
-MAX_SUBSCRIBERS = 30
+# Number of channels each fan-out task sends a message to.
+FAN_OUT_BATCH_SIZE = 50
+# Subscribers to each key are spread over memcache shards, so that
+# concurrent subscribes rarely touch the same shard.
+SUBSCRIPTION_SHARDS = 8
+MAX_CAS_RETRIES = 10
+# Apps known to have no subscriptions in this process: app_id => time
+# checked. Subscriptions made on other instances are noticed after
+# at most NO_SUBSCRIBERS_SECONDS.
+NO_SUBSCRIBERS = {}
+NO_SUBSCRIBERS_SECONDS = 5
+# Channels that accept BATCH messages get at most MAX_CHANNEL_MESSAGES
+# per COALESCE_SECONDS. Further changes are merged into one message
+# that is sent at the end of the window.
+MAX_CHANNEL_MESSAGES = 5
+COALESCE_SECONDS = 2
 
 
 @jsonp
@@ -69,7 +88,8 @@ def subscriptions(request, extra):
         if sub['enabled'] == False:
             expires = 0
             del subs[key]
-        add_subscription(key, channel_key, expires, project(sub, ['children']))
+        add_subscription(key, channel_key, expires,
+                         project(sub, ['children', 'batch']))
 
     channel_data['subscriptions'] = subs
     m_key = '~'.join((settings.CHANNEL_PREFIX, 'channel', channel_key))
@@ -85,89 +105,348 @@ def subscriptions(request, extra):
 
 def add_subscription(key, channel_key, expires, options=None):
     """
-    For each storage key, we store a dictionary of subscribers:
+    For each storage key, we store dictionaries of subscribers:
        {channel_key: {'expires': expires_time}, ...
+    sharded by hash of the channel key.
 
     options is an (optional) dictionary that can contain:
 
         children: True - For a document key, subscribe to all
         child blobs.
+        batch: True - The client accepts BATCH messages with a list
+        of changes.
+
+    The key is also added to the app's subscription index.
     """
     # Keys are paths normalized to end in trailing slash
     if not key.endswith('/'):
         key += '/'
-    sub_key = '~'.join((settings.CHANNEL_PREFIX, 'sub', key))
-    subscriptions = memcache.get(sub_key) or {}
-    subscriptions[channel_key] = {'expires': expires}
+    sub = {'expires': expires}
     if options:
-        subscriptions[channel_key].update(options)
-    save_subscriptions(sub_key, subscriptions)
+        sub.update(options)
+
+    def update(subscriptions):
+        subscriptions[channel_key] = sub
+
+    update_subscriptions(subscription_shard_key(key, channel_key), update)
+    if expires > time.time():
+        update_index(key, expires, 'children' in sub)
+
+
+def subscription_shard_key(key, channel_key):
+    """
+    Memcache key for the shard that holds this channel's subscription.
+    """
+    shard = int(hashlib.sha1(channel_key).hexdigest()[:8], 16)
+    return subscription_shard_keys(key)[shard % SUBSCRIPTION_SHARDS]
+
+
+def subscription_shard_keys(key):
+    """
+    Memcache keys for all subscription shards of a storage key.
+    """
+    return ['~'.join((settings.CHANNEL_PREFIX, 'sub', key, str(shard)))
+            for shard in range(SUBSCRIPTION_SHARDS)]
+
+
+def subscription_index_key(app_id):
+    """
+    Memcache key for the index of subscribed keys in this app.
+    """
+    return '~'.join((settings.CHANNEL_PREFIX, 'index', app_id))
+
+
+def cas_update(m_key, update, expire):
+    """
+    Read-modify-write a dictionary in memcache with compare-and-set,
+    retrying when another request changed it first. The expire
+    function removes stale entries and returns the memcache
+    expiration time.
+    """
+    client = memcache.Client()
+    for attempt in range(MAX_CAS_RETRIES):
+        value = client.gets(m_key)
+        if value is None:
+            value = {}
+            update(value)
+            if client.add(m_key, value, expire(value)):
+                return True
+        else:
+            update(value)
+            if client.cas(m_key, value, expire(value)):
+                return True
+    logging.warning("Too many conflicts updating %s." % m_key)
+    return False
+
+
+def update_subscriptions(shard_key, update):
+    """
+    Update one subscription shard. Expired subscriptions are removed.
+    """
+    return cas_update(shard_key, update, expire_subscriptions)
+
+
+def update_index(key, expires, children=False):
+    """
+    Record that appid/key has subscribers until the expiration time.
+    Children subscriptions are also indexed as appid/docid/*.
+    """
+    app_id, docid, path = key.split('/', 2)
+    keys = [key]
+    if children:
+        keys.append(key + '*')
+
+    def update(index):
+        for key in keys:
+            index[key] = max(index.get(key, 0), expires)
+
+    cas_update(subscription_index_key(app_id), update, expire_index)
+    NO_SUBSCRIBERS.pop(app_id, None)
 
 
-def save_subscriptions(sub_key, subscriptions):
+def expire_subscriptions(subscriptions):
     """
-    Remove any expired subscriptions and save the rest to memcache.
+    Remove expired subscriptions and return the memcache expiration
+    time for the rest.
     """
     now = time.time()
-    max_expires = 0
+    max_expires = int(now) + 60
     for channel_key, sub in subscriptions.items():
-        max_expires = max(max_expires, sub['expires'])
         if sub['expires'] < now:
             del subscriptions[channel_key]
+        else:
+            max_expires = max(max_expires, sub['expires'])
+    return max_expires
+
+
+def expire_index(index):
+    """
+    Remove expired keys from a subscription index and return the
+    memcache expiration time for the rest.
+    """
+    now = time.time()
+    max_expires = int(now) + 60
+    for key, expires in index.items():
+        if expires < now:
+            del index[key]
+        else:
+            max_expires = max(max_expires, expires)
+    return max_expires
+
+
+def has_subscribers(key):
+    """
+    Check the app's subscription index for appid/key, and for
+    children subscriptions on the parent document. The index may
+    include keys whose subscribers have all unsubscribed.
+    """
+    app_id, docid, path = key.split('/', 2)
+    now = time.time()
+    checked = NO_SUBSCRIBERS.get(app_id)
+    if checked is not None and now < checked + NO_SUBSCRIBERS_SECONDS:
+        return False
+    index = memcache.get(subscription_index_key(app_id))
+    if not index:
+        if len(NO_SUBSCRIBERS) >= 1000:
+            NO_SUBSCRIBERS.clear()
+        NO_SUBSCRIBERS[app_id] = now
+        return False
+    if index.get(key, 0) >= now:
+        return True
+    return path != '' and index.get('%s/%s/*' % (app_id, docid), 0) >= now
+
+
+class ChannelMiddleware(object):
+    """
+    Collect change notifications during each request, and dispatch
+    them together after the response is ready.
+    """
+
+    def process_request(self, request):
+        PENDING.changes = []
+
+    def process_response(self, request, response):
+        changes = getattr(PENDING, 'changes', None)
+        PENDING.changes = None
+        if changes:
+            queue_changes(changes)
+        return response
+
 
-    logging.info("subscription saved for %s: %r" % (sub_key, subscriptions))
-    memcache.set(sub_key, subscriptions, max_expires)
+# Changes made by the current request, if ChannelMiddleware is active.
+PENDING = threading.local()
 
 
-def dispatch_subscriptions(key, method, data, original_key=None):
+def dispatch_subscriptions(key, method, data):
     """
     Dispatch messages for appid/key.
 
-    For blob keys, we also dispatch children subscriptions on the parent
-    document.
+    The message is serialized once, and sent to subscribers from a
+    task queue request, so the writer doesn't wait for the fan-out.
+    Keys without subscribers in the app's index are skipped. Changes
+    made in the same request are sent together.
     """
+    if not has_subscribers(key):
+        return
     app_id, docid, path = key.split('/', 2)
+    message = json.dumps({'key': '/'.join((docid, path)),
+                          'app': app_id,
+                          'method': method,
+                          'data': data},
+                         cls=ModelEncoder)
+    changes = getattr(PENDING, 'changes', None)
+    if changes is None:
+        queue_changes([(key, message)])
+    else:
+        changes.append((key, message))
 
-    # Blob changed - also dispatch for parent document.
-    if path != '':
-        dispatch_subscriptions('%s/%s/' % (app_id, docid), method, data, key)
 
-    sub_key = '~'.join((settings.CHANNEL_PREFIX, 'sub', key))
-    subscriptions = memcache.get(sub_key)
-    if subscriptions is None:
+def queue_changes(changes):
+    """
+    Add a task to send a list of (appid/key, message) changes to
+    their subscribers.
+    """
+    tasks.defer(fan_out, changes)
+
+
+def fan_out(changes):
+    """
+    Task: send each message to the channels subscribed to its key.
+
+    Channels that accept BATCH messages get one message for all the
+    changes, subject to the per-channel rate limit. Large fan-outs are
+    split into batches, each sent from its own task.
+    """
+    messages = {}
+    batch = set()
+    for key, message in changes:
+        for channel_key, sub in get_subscribers(key).items():
+            messages.setdefault(channel_key, []).append((key, message))
+            if sub.get('batch'):
+                batch.add(channel_key)
+    deliveries = []
+    for channel_key in rate_limit(batch):
+        coalesce(channel_key, messages.pop(channel_key))
+    for channel_key, channel_messages in messages.items():
+        if channel_key in batch:
+            deliveries.append((channel_key,
+                               batch_message(dict(channel_messages))))
+            continue
+        for key, message in channel_messages:
+            deliveries.append((channel_key, message))
+    if len(deliveries) <= FAN_OUT_BATCH_SIZE:
+        send_messages(deliveries)
         return
+    logging.info("Fan-out of %d messages." % len(deliveries))
+    for start in range(0, len(deliveries), FAN_OUT_BATCH_SIZE):
+        tasks.defer(send_messages,
+                    deliveries[start:start + FAN_OUT_BATCH_SIZE])
+
+
+def batch_message(messages):
+    """
+    Combine serialized messages, given as {appid/key: message}, into
+    one BATCH message. A single message is sent as is.
+    """
+    if len(messages) == 1:
+        return messages.values()[0]
+    keys = messages.keys()
+    keys.sort()
+    return '{"method": "BATCH", "changes": [%s]}' % ', '.join(
+        [messages[key] for key in keys])
+
+
+def rate_limit(channel_keys):
+    """
+    Count a message for each channel in the current window, and
+    return the channels that went over MAX_CHANNEL_MESSAGES.
+    """
+    if not channel_keys:
+        return []
+    window = int(time.time() / COALESCE_SECONDS)
+    prefix = '~'.join((settings.CHANNEL_PREFIX, 'rate', str(window), ''))
+    counts = memcache.offset_multi(dict.fromkeys(channel_keys, 1),
+                                   key_prefix=prefix, initial_value=0)
+    return [channel_key for channel_key, count in counts.items()
+            if count is not None and count > MAX_CHANNEL_MESSAGES]
+
+
+def coalesce(channel_key, messages):
+    """
+    Save changes for a rate-limited channel, and make sure that a task
+    will send them at the end of the window. Later changes to the same
+    key replace earlier ones.
+    """
+    pending_key = '~'.join((settings.CHANNEL_PREFIX, 'pending', channel_key))
+
+    def update(pending):
+        pending.update(dict(messages))
+
+    cas_update(pending_key, update,
+               lambda pending: int(time.time()) + 10 * COALESCE_SECONDS)
+    flush_key = '~'.join((settings.CHANNEL_PREFIX, 'flush', channel_key))
+    if memcache.add(flush_key, 1, COALESCE_SECONDS):
+        tasks.defer(send_pending, channel_key, _countdown=COALESCE_SECONDS)
+
+
+def send_pending(channel_key):
+    """
+    Task: send all coalesced changes for a channel in one message.
+    """
+    pending_key = '~'.join((settings.CHANNEL_PREFIX, 'pending', channel_key))
+    messages = {}
+
+    def update(pending):
+        messages.update(pending)
+        pending.clear()
+
+    cas_update(pending_key, update, lambda pending: COALESCE_SECONDS)
+    if messages:
+        send_messages([(channel_key, batch_message(messages))])
 
-    # Update path to be original one for children subscriptions
-    if original_key:
-        path = original_key.split('/', 2)[2]
-    else:
-        original_key = key
 
+def get_subscribers(key):
+    """
+    Return {channel_key: options} for channels subscribed to
+    appid/key. For blob keys, this includes children subscriptions on
+    the parent document. All shards are read with one get_multi, and
+    shards with expired subscriptions are cleaned up.
+    """
+    app_id, docid, path = key.split('/', 2)
+    shard_keys = subscription_shard_keys(key)
+    parent_keys = []
+    # Blob changed - also dispatch for parent document.
+    if path != '':
+        parent_keys = subscription_shard_keys('%s/%s/' % (app_id, docid))
+    shards = memcache.get_multi(shard_keys + parent_keys)
     now = time.time()
-    fan_out = 0
-    save = False
-    for channel_key, sub in subscriptions.items():
-        if sub['expires'] < now:
-            save = True
-            continue
-        if original_key != key and 'children' not in sub:
+    subscribers = {}
+    for shard_key in shard_keys + parent_keys:
+        subscriptions = shards.get(shard_key)
+        if subscriptions is None:
             continue
-        fan_out += 1
-        # TODO: Use task queues to increase fan_out
-        if fan_out > MAX_SUBSCRIBERS:
-            logging.info("Too many subscribers (%d) on %s." %
-                         (len(subscriptions), key))
-            break
-        message = json.dumps({'key': '/'.join((docid, path)),
-                              'app': app_id,
-                              'method': method,
-                              'data': data},
-                             cls=ModelEncoder)
+        children = shard_key in parent_keys
+        expired = False
+        for channel_key, sub in subscriptions.items():
+            if sub['expires'] < now:
+                expired = True
+                continue
+            if children and 'children' not in sub:
+                continue
+            subscribers.setdefault(channel_key, sub)
+        if expired:
+            update_subscriptions(shard_key, lambda subscriptions: None)
+    return subscribers
+
+
+def send_messages(deliveries):
+    """
+    Task: send a batch of (channel_key, message) pairs.
+    """
+    for channel_key, message in deliveries:
         logging.info("Sending: %s->%s" % (channel_key, message))
         channel.send_message(channel_key, message)
-
-    if save:
-        save_subscriptions(key, subscriptions)
+    counters.record('channel_messages', len(deliveries))
 
 
 def get_session_channel(channel_key):
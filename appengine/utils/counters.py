@@ -0,0 +1,133 @@
+"""
+Event counters per hour, buffered in memcache.
+
+Requests increment a counter in memcache, in one of COUNTER_SHARDS
+keys so that busy counters are spread over memcache servers. A cron
+job moves the buffered counts to the datastore with flush, so the
+cost of statistics doesn't depend on the number of entities.
+
+With CounterMiddleware, record adds to a dict in memory, and all
+counts of a request are sent with one memcache call at the end.
+"""
+
+import random
+import datetime
+import threading
+
+from google.appengine.api import memcache
+
+COUNTER_PREFIX = 'CTR1'
+COUNTER_SHARDS = 4
+# Cacheable kinds with memcache hit and miss counters on the dashboard.
+CACHED_KINDS = ['user', 'app', 'doc', 'blob', 'chunk']
+# Send the counts early if a request records more names than this.
+MAX_PENDING_NAMES = 50
+
+
+def hour_name(when=None):
+    """
+    The hour of a datetime (default now), as YYYYMMDDHH.
+
+    >>> hour_name(datetime.datetime(2010, 11, 12, 13, 14, 15))
+    '2010111213'
+    """
+    if when is None:
+        when = datetime.datetime.now()
+    return when.strftime('%Y%m%d%H')
+
+
+def counter_keys(hour, name):
+    """
+    Memcache keys for all shards of a counter.
+
+    >>> counter_keys('2010111213', 'users')[-1]
+    'CTR1~2010111213~users~3'
+    """
+    return ['~'.join((COUNTER_PREFIX, hour, name, str(shard)))
+            for shard in range(COUNTER_SHARDS)]
+
+
+def increment(name, delta=1, when=None):
+    """
+    Add delta to the counter for the current hour.
+    """
+    key = random.choice(counter_keys(hour_name(when), name))
+    memcache.incr(key, delta, initial_value=0)
+
+
+def flush(hour, names):
+    """
+    Move the buffered counts for one hour out of memcache, and return
+    a dict with the count for each name.
+    """
+    key_names = {}
+    for name in names:
+        for key in counter_keys(hour, name):
+            key_names[key] = name
+    result = dict.fromkeys(names, 0)
+    offsets = {}
+    for key, value in memcache.get_multi(key_names.keys()).items():
+        value = int(value)
+        if value > 0:
+            offsets[key] = -value
+            result[key_names[key]] += value
+    if offsets:
+        memcache.offset_multi(offsets)
+    return result
+
+
+def record(name, delta=1):
+    """
+    Count an event. Inside a request with CounterMiddleware, the
+    count is kept in memory until the response is ready.
+    """
+    pending = getattr(PENDING, 'counts', None)
+    if pending is None:
+        increment(name, delta)
+        return
+    pending[name] = pending.get(name, 0) + delta
+    if len(pending) > MAX_PENDING_NAMES:
+        send_pending()
+
+
+def send_pending():
+    """
+    Add the counts of the current request to one shard of each
+    counter, with a single memcache call.
+    """
+    pending = getattr(PENDING, 'counts', None)
+    if not pending:
+        return
+    shard = random.randrange(COUNTER_SHARDS)
+    hour = hour_name()
+    offsets = {}
+    for name, delta in pending.items():
+        if delta:
+            offsets[counter_keys(hour, name)[shard]] = delta
+    pending.clear()
+    if offsets:
+        memcache.offset_multi(offsets, initial_value=0)
+
+
+class CounterMiddleware(object):
+    """
+    Collect counts during each request, and send them together after
+    the response is ready.
+    """
+
+    def process_request(self, request):
+        PENDING.counts = {}
+
+    def process_response(self, request, response):
+        send_pending()
+        PENDING.counts = None
+        return response
+
+
+# Counts recorded by the current request, if CounterMiddleware is active.
+PENDING = threading.local()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
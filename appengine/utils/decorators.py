@@ -2,6 +2,7 @@ import logging
 import time
 import email
 import httplib
+from functools import wraps
 
 from django.conf import settings
 from django.http import HttpResponse, Http404, HttpResponseNotFound, \
@@ -23,6 +24,7 @@ def run_in_transaction(func):
     the transaction handler. Avoid side effects!
     http://code.google.com/appengine/docs/python/datastore/functions.html
     """
+    @wraps(func)
     def wrapper(*args, **kwargs):
         return db.run_in_transaction(func, *args, **kwargs)
     return wrapper
@@ -36,6 +38,7 @@ def cache_expires(seconds):
     validated with the origin server.
     """
     def decorate(func):
+        @wraps(func)
         def wrapper(*args, **kwargs):
             response = func(*args, **kwargs)
             if isinstance(response, HttpResponse):
@@ -51,6 +54,7 @@ def no_cache(func):
     """
     Disable caching of the response.
     """
+    @wraps(func)
     def wrapper(*args, **kwargs):
         response = func(*args, **kwargs)
         if isinstance(response, HttpResponse):
@@ -64,6 +68,7 @@ def jsonp(func):
     View function decorator to wrap successful JSON response in a
     callback for JSONP.
     """
+    @wraps(func)
     def wrapper(request, *args, **kwargs):
         # Check if the query string contains a callback parameter.
         callback = request.GET.get('callback', None)
@@ -99,6 +104,7 @@ def method_required(*methods):
     405 Method Not Allowed with a list of allowed methods.
     """
     def decorate(func):
+        @wraps(func)
         def wrapper(request, *args, **kwargs):
             if request.method not in methods:
                 methods_list = list(methods)
@@ -1,5 +1,6 @@
 from calendar import timegm
-from email.Utils import formatdate
+from datetime import datetime
+from email.Utils import formatdate, parsedate
 
 from django.http import HttpResponse
 
@@ -19,6 +20,36 @@ def http_datetime(timestamp):
     return formatdate(timegm(timestamp.utctimetuple()))[:26] + 'GMT'
 
 
+def parse_http_datetime(text):
+    """
+    Parse an HTTP date header, or return None if it's not valid.
+
+    >>> parse_http_datetime('Tue, 15 Nov 1994 12:45:26 GMT')
+    datetime.datetime(1994, 11, 15, 12, 45, 26)
+    >>> parse_http_datetime('yesterday')
+    """
+    parsed = parsedate(text)
+    if parsed is None:
+        return None
+    return datetime(*parsed[:6])
+
+
+def is_not_modified(request, etag, modified):
+    """
+    Check the conditional GET headers against the ETag and modification
+    time of a resource, so that 304 Not Modified can be returned
+    without loading the content. If-Modified-Since is only used without
+    If-None-Match, because two updates can happen in the same second.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return if_none_match == etag
+    since = parse_http_datetime(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if since is None or modified is None:
+        return False
+    return modified.replace(microsecond=0) <= since
+
+
 class HttpResponseCreated(HttpResponse):
     """HTTP PUT response class."""
     status_code = 201
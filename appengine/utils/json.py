@@ -19,6 +19,43 @@ class ModelEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def json_fragment(key, value):
+    """
+    Canonical JSON for a single item of a top-level object, as it
+    appears in the sorted and indented output of Serializable.to_json.
+
+    >>> print json_fragment('title', 'Hello')
+      "title": "Hello"
+    >>> print json_fragment('readers', ['public'])
+      "readers": [
+        "public"
+      ]
+    """
+    return json.dumps({key: value}, sort_keys=True, cls=ModelEncoder,
+                      indent=2, separators=(',', ': '))[2:-2]
+
+
+def join_fragments(fragments):
+    """
+    Combine a dictionary of json_fragment strings into the same
+    output as json.dumps(..., sort_keys=True, indent=2) + newline.
+
+    >>> print join_fragments({'b': json_fragment('b', 2),
+    ...                       'a': json_fragment('a', 1)}),
+    {
+      "a": 1,
+      "b": 2
+    }
+    >>> join_fragments({})
+    '{}\\n'
+    """
+    if not fragments:
+        return '{}\n'
+    keys = fragments.keys()
+    keys.sort()
+    return '{\n' + ',\n'.join([fragments[key] for key in keys]) + '\n}\n'
+
+
 def update_jsonp_response(request, response):
     """
     Force a JSON formatted response if callback is used
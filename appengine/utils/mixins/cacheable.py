@@ -1,14 +1,16 @@
 import time
+import types
 import random
 import logging
 
 from django.conf import settings
 
 from google.appengine.ext import db
-from google.appengine.api import memcache
+from google.appengine.api import memcache, datastore_types
 from google.appengine.datastore import entity_pb
 
 from utils.mixins.serializable import Serializable
+from utils import counters
 
 COMMIT_INTERVAL = 1.0     # seconds
 JIGGLE_INTERVAL = 0.25
@@ -51,6 +53,131 @@ class CacheHistory(object):
         return {self.chm_key: ' '.join(timestamps)}
 
 
+class CachedView(object):
+    """
+    Read-only view of a cached entity, decoded lazily from the
+    protocol buffer that Cacheable stores in memcache.
+
+    Most requests only read a handful of properties (e.g. the readers
+    and writers of an App), so we don't build and validate a complete
+    model instance on every memcache hit. Instead, each property is
+    decoded the first time it is read.
+
+    Methods listed in the view_methods of the model class are bound to
+    the view directly; they must only read properties. Any other
+    attribute access, assignment, put() or delete() promotes the view
+    to a full model instance first: after that, the object is an
+    ordinary instance of the model class.
+    """
+
+    def __init__(self, model_class, binary):
+        protobuf = entity_pb.EntityProto(binary)
+        raw = {}
+        for prop in protobuf.property_list() + protobuf.raw_property_list():
+            raw.setdefault(prop.name(), []).append(prop)
+        self.__dict__.update({
+            '_view_class': model_class,
+            '_view_binary': binary,
+            '_view_protobuf': protobuf,
+            '_view_raw': raw,
+            '_view_decoded': {},
+            '_view_key': None,
+            })
+
+    def __repr__(self):
+        return '<CachedView %s %r>' % (self._view_class.kind(),
+                                       self.key().name())
+
+    def key(self):
+        if self._view_key is None:
+            self.__dict__['_view_key'] = db.Key._FromPb(
+                self._view_protobuf.key())
+        return self._view_key
+
+    def is_saved(self):
+        return True
+
+    def to_protobuf(self):
+        """The view is read-only, so the cached binary is still valid."""
+        return self._view_binary
+
+    def put(self, *args, **kwargs):
+        self._promote()
+        return self.put(*args, **kwargs)
+
+    def delete(self):
+        self._promote()
+        return self.delete()
+
+    def _decode(self, name):
+        """
+        Convert the stored protocol buffer values for one property.
+        """
+        model_prop = self._view_class.properties().get(name)
+        prop_list = self._view_raw.get(name)
+        if prop_list is None:
+            if model_prop is None:
+                raise AttributeError(name)
+            # Empty lists and missing values are not stored.
+            return model_prop.default_value()
+        values = [datastore_types.FromPropertyPb(prop) for prop in prop_list]
+        if prop_list[0].multiple():
+            value = values
+        else:
+            value = values[0]
+        if model_prop is not None:
+            value = model_prop.make_value_from_datastore(value)
+        return value
+
+    def __getattr__(self, name):
+        # Only called if the attribute is not in self.__dict__.
+        model_class = self._view_class
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in model_class.view_properties():
+            value = self._decode(name)
+            self._view_decoded[name] = value
+            # Store it so that __getattr__ isn't called again.
+            self.__dict__[name] = value
+            return value
+        if name in model_class.view_methods:
+            method = types.MethodType(
+                getattr(model_class, name).im_func, self, model_class)
+            self.__dict__[name] = method
+            return method
+        attr = getattr(model_class, name, None)
+        if isinstance(attr, types.MethodType) and attr.im_self is model_class:
+            # Classmethods like kind() don't need the instance.
+            return attr
+        if name in self._view_raw:
+            # Dynamic property of an Expando model.
+            value = self._decode(name)
+            self._view_decoded[name] = value
+            self.__dict__[name] = value
+            return value
+        self._promote()
+        return getattr(self, name)
+
+    def __setattr__(self, name, value):
+        self._promote()
+        setattr(self, name, value)
+
+    def _promote(self):
+        """
+        Turn this view into a full model instance, in place. Values
+        that were already decoded are copied to the new instance, to
+        keep changes to mutable values like lists.
+        """
+        instance = db.model_from_protobuf(self._view_protobuf)
+        for name, value in self._view_decoded.items():
+            setattr(instance, name, value)
+        if settings.CACHEABLE_LOGGING:
+            logging.info("CachedView promoted: " + instance.get_cache_key())
+        self.__dict__.clear()
+        self.__dict__.update(instance.__dict__)
+        self.__class__ = instance.__class__
+
+
 class Cacheable(Serializable):
     """
     Memcache mixin for App Engine datastore models.
@@ -71,8 +198,17 @@ class Cacheable(Serializable):
     * cache_delete()
     * @classmethod cache_get_by_key_name()
     * @classmethod class_get_cache_key(key_name)
+    * @classmethod class_get_cache_keys(key_name)
+    * @classmethod cache_get_view(key_name)
+    * @classmethod get_view_by_key_name(key_name)
+    * @classmethod record_cache(hits, misses)
     * get_cache_key()
+    * cache_mapping()
+
+    Subclasses can add read-only methods to view_methods, so they can
+    be called on a CachedView without promoting it to a full instance.
     """
+    view_methods = ('get_cache_key', )
 
     def __init__(self, *args, **kwargs):
         if not settings.RUNNING_ON_GAE:
@@ -130,7 +266,7 @@ class Cacheable(Serializable):
         elif history.average_put_interval() > commit_interval:
             commit = True  # Infrequent updates or not enough confidence.
         # Save entity and history to memcache.
-        mapping = {self.get_cache_key(): self.to_protobuf()}
+        mapping = self.cache_mapping()
         mapping.update(history.serialize_memcache_puts())
         if commit or write_through:
             history.datastore_put = now
@@ -141,11 +277,12 @@ class Cacheable(Serializable):
             return super(Cacheable, self).put()
         else:
             logging.warning("Hot write - memcache only: %s" % self.get_cache_key())
+            counters.record('hot_writes')
 
     def cache_delete(self):
         """Remove this entity from memcache."""
-        cache_key = self.get_cache_key()
-        return memcache.delete(cache_key)
+        cache_keys = self.class_get_cache_keys(self.key().name())
+        return memcache.delete_multi(cache_keys)
 
     def delete(self):
         """Remove this entity from datastore and memcache."""
@@ -159,7 +296,9 @@ class Cacheable(Serializable):
 
         Removed from memcache first, and then deletes from database.
         """
-        cache_keys = [cls.class_get_cache_key(key.name()) for key in keys]
+        cache_keys = []
+        for key in keys:
+            cache_keys.extend(cls.class_get_cache_keys(key.name()))
         memcache.delete_multi(cache_keys)
         db.delete(keys)
 
@@ -189,6 +328,43 @@ class Cacheable(Serializable):
             logging.info("get_by_key_name used memcache: " + cache_key)
         return instance
 
+    @classmethod
+    def view_properties(cls):
+        """
+        Names of the datastore properties of this model, cached on the
+        class because db.Model.properties() returns a new dict.
+        """
+        if '_view_properties' not in cls.__dict__:
+            cls._view_properties = frozenset(cls.properties())
+        return cls._view_properties
+
+    @classmethod
+    def cache_get_view(cls, key_name):
+        """
+        Get a read-only CachedView from memcache, without decoding
+        any properties yet. Return None if not found in memcache.
+        """
+        cache_key = cls.class_get_cache_key(key_name)
+        binary = memcache.get(cache_key)
+        if binary is None:
+            return None
+        if settings.CACHEABLE_LOGGING:
+            logging.info("get_view_by_key_name used memcache: " + cache_key)
+        return CachedView(cls, binary)
+
+    @classmethod
+    def get_view_by_key_name(cls, key_name):
+        """
+        Like get_by_key_name, but return a CachedView for memcache
+        hits. Use this on the request path when the entity is mostly
+        read. The result behaves like a full model instance.
+        """
+        view = cls.cache_get_view(key_name)
+        if view is not None:
+            cls.record_cache(hits=1)
+            return view
+        return cls.get_by_key_name(key_name)
+
     @classmethod
     def get_by_key_name_list(cls, key_name_list, parent=None):
         """
@@ -206,6 +382,7 @@ class Cacheable(Serializable):
                 result[key_name] = cls.from_protobuf(from_memcache[cache_key])
             else:
                 missing.append(key_name)
+        cls.record_cache(len(key_name_list) - len(missing), len(missing))
         # Load missing entities from datastore.
         if missing:
             from_datastore = super(Cacheable, cls).get_by_key_name(
@@ -229,7 +406,9 @@ class Cacheable(Serializable):
             return cls.get_by_key_name_list(key_name, parent=parent)
         instance = cls.cache_get_by_key_name(key_name)
         if instance is not None:
+            cls.record_cache(hits=1)
             return instance
+        cls.record_cache(misses=1)
         # Fetch from datastore.
         instance = super(Cacheable, cls).get_by_key_name(key_name, parent)
         if instance is not None:
@@ -248,7 +427,9 @@ class Cacheable(Serializable):
         assert isinstance(key_name, basestring)
         instance = cls.cache_get_by_key_name(key_name)
         if instance is not None:
+            cls.record_cache(hits=1)
             return instance
+        cls.record_cache(misses=1)
         # Fetch from datastore.
         instance = super(Cacheable, cls).get_or_insert(key_name, **kwargs)
         if instance is not None:
@@ -284,6 +465,37 @@ class Cacheable(Serializable):
         """
         return '~'.join((settings.CACHEABLE_PREFIX, cls.kind(), key_name))
 
+    @classmethod
+    def record_cache(cls, hits=0, misses=0):
+        """
+        Count memcache hits and misses for the dashboard, e.g. as
+        blob_hits and blob_misses. Other kinds are not counted, because
+        only counters.CACHED_KINDS are flushed to the statistics.
+        """
+        kind = cls.kind().lower()
+        if kind not in counters.CACHED_KINDS:
+            return
+        if hits:
+            counters.record(kind + '_hits', hits)
+        if misses:
+            counters.record(kind + '_misses', misses)
+
     def get_cache_key(self):
         """Generate a cache key for this model instance."""
         return self.class_get_cache_key(self.key().name())
+
+    @classmethod
+    def class_get_cache_keys(cls, key_name):
+        """
+        All memcache keys for this key_name, including the records
+        that subclasses add in cache_mapping. They are removed together
+        when the entity is deleted.
+        """
+        return [cls.class_get_cache_key(key_name)]
+
+    def cache_mapping(self):
+        """
+        Memcache records for this entity, saved together by put.
+        Subclasses can add records that are derived from the entity.
+        """
+        return {self.get_cache_key(): self.to_protobuf()}
@@ -43,6 +43,17 @@ class Migratable(db.Model):
             cls.update_schema_list(result, write_to_memcache=True)
         return result
 
+    @classmethod
+    def get_view_by_key_name(cls, key_name):
+        """
+        Cached views are read-only, so an entity with an old schema is
+        promoted to a full instance and migrated.
+        """
+        result = super(Migratable, cls).get_view_by_key_name(key_name)
+        if result is not None and result.schema < cls.current_schema:
+            result.update_schema()
+        return result
+
     @classmethod
     def get_or_insert(cls, key_name, **kwargs):
         """
@@ -9,7 +9,47 @@ from django.utils import simplejson as json
 from google.appengine.ext import db
 from google.appengine.datastore import entity_pb
 
-from utils.json import ModelEncoder
+from utils.json import ModelEncoder, json_fragment, join_fragments
+
+# Canonical JSON fragments of hashed properties, shared by all
+# entities in this process: (alias, snapshot) => fragment.
+FRAGMENT_CACHE = {}
+MAX_FRAGMENT_CACHE = 2000
+
+
+def value_snapshot(value):
+    """
+    Immutable copy of a property value that can be used as a cache
+    key for its JSON fragment, or None if the value can't be cached.
+    The type is included because True == 1 but they serialize
+    differently.
+    """
+    if isinstance(value, (basestring, bool, int, long, float)):
+        return (type(value), value)
+    if isinstance(value, list):
+        for item in value:
+            if not isinstance(item, basestring):
+                return None
+        return (list, tuple(value))
+    return None
+
+
+def cached_fragment(alias, snapshot, get_value):
+    """
+    Return the canonical JSON fragment for a top-level item, using
+    the process-wide cache if the snapshot is known. The get_value
+    function is only called on a cache miss.
+    """
+    if snapshot is None:
+        return json_fragment(alias, get_value())
+    cache_key = (alias, snapshot)
+    fragment = FRAGMENT_CACHE.get(cache_key)
+    if fragment is None:
+        fragment = json_fragment(alias, get_value())
+        if len(FRAGMENT_CACHE) >= MAX_FRAGMENT_CACHE:
+            FRAGMENT_CACHE.clear()
+        FRAGMENT_CACHE[cache_key] = fragment
+    return fragment
 
 
 class Serializable(db.Model):
@@ -96,15 +136,102 @@ class Hashable(Serializable):
         """
         return ('sha1', 'size')
 
+    @classmethod
+    def from_entity(cls, entity):
+        """
+        Remember the hashed properties of the stored entity, so that
+        put() can tell if they changed without hashing them again.
+        Computed values (extra_hash_snapshots) are not loaded here;
+        they are trusted to match the stored sha1.
+        """
+        instance = super(Hashable, cls).from_entity(entity)
+        if instance.sha1 is not None:
+            state = dict([(alias, snapshot) for alias, (snapshot, get_value)
+                          in instance.hash_snapshots(extra=False).items()])
+            instance._hash_state = (state, instance.sha1, instance.size,
+                                    False)
+        return instance
+
+    def hash_snapshots(self, extra=True):
+        """
+        Snapshots of all hashed values, as a dictionary of
+        alias: (snapshot, get_value). The snapshot is None for values
+        that can't be cached. If extra is False, computed values are
+        left out.
+        """
+        exclude = self.nohash_props()
+        snapshots = {}
+        for name, alias in self.json_props().items():
+            if name in exclude:
+                continue
+            value = getattr(self, name)
+            if value is None:
+                continue
+            snapshots[alias or name] = (value_snapshot(value),
+                                        lambda value=value: value)
+        if extra:
+            snapshots.update(self.extra_hash_snapshots(exclude))
+        return snapshots
+
+    def extra_hash_snapshots(self, exclude):
+        """
+        Snapshots for computed values that to_json adds with extra=.
+        Subclasses override this if the extra values are hashed.
+        """
+        return {}
+
+    def canonical_json(self, snapshots=None):
+        """
+        Same result as self.to_json(exclude=self.nohash_props()), but
+        built from cached fragments so that unchanged values are not
+        serialized again.
+        """
+        if snapshots is None:
+            snapshots = self.hash_snapshots()
+        fragments = {}
+        for alias, (snapshot, get_value) in snapshots.items():
+            fragments[alias] = cached_fragment(alias, snapshot, get_value)
+        return join_fragments(fragments)
+
+    def changed_hash_props(self):
+        """
+        Aliases of the hashed values that changed since the last call
+        to update_hash, or None if there is no previous hash.
+        """
+        previous = getattr(self, '_hash_state', None)
+        if previous is None:
+            return None
+        old, extra = previous[0], previous[3]
+        new = dict([(alias, snapshot) for alias, (snapshot, get_value)
+                    in self.hash_snapshots(extra).items()])
+        changed = [alias for alias in set(old) | set(new)
+                   if old.get(alias) is None or old.get(alias) != new.get(alias)]
+        changed.sort()
+        return changed
+
     def update_hash(self, value=None):
         """
         Update the hash value of the model.
+
+        If none of the hashed values changed since the last call, the
+        previous hash is reused without serializing anything.
         """
-        exclude = self.nohash_props()
-        if value is None:
-            value = self.to_json(exclude=exclude)
+        if value is not None:
+            self.sha1 = sha1(value).hexdigest()
+            self.size = len(value)
+            return
+        snapshots = self.hash_snapshots()
+        state = dict([(alias, snapshot) for alias, (snapshot, get_value)
+                      in snapshots.items()])
+        previous = getattr(self, '_hash_state', None)
+        if (previous is not None and previous[0] == state
+            and None not in state.values()):
+            (self.sha1, self.size) = previous[1:3]
+            return
+        value = self.canonical_json(snapshots)
         self.sha1 = sha1(value).hexdigest()
         self.size = len(value)
+        self._hash_state = (state, self.sha1, self.size, True)
 
     def update_headers(self, response):
         response['ETag'] = self.get_etag()
@@ -121,9 +248,12 @@ class Hashable(Serializable):
 
         Note that subclasses can either call update_hash() when they
         modify an object, or invalidate_hash() to force it to
-        be recalculated when stored.
+        be recalculated when stored. Hashed properties that were
+        changed since the entity was loaded or last hashed are also
+        detected here, so the stored sha1 matches the stored values,
+        and an unchanged entity is stored without hashing.
         """
-        if self.sha1 is None:
+        if self.sha1 is None or self.changed_hash_props():
             self.update_hash()
         super(Hashable, self).put()
 
@@ -3,12 +3,16 @@ import datetime
 
 from utils.middleware import RequestMiddleware
 from utils.http import http_datetime
+from utils import counters
 
 
 class Timestamped(db.Model):
     """
     Standardized timestamp information for models.
+
+    If stats_name is set, new entities are counted for the dashboard.
     """
+    stats_name = None
 
     created = db.DateTimeProperty(auto_now_add=True)
     created_ip = db.StringProperty()
@@ -43,8 +47,17 @@ class Timestamped(db.Model):
         # time since it does not seem to be over-written in the model
         # after a put().
         self.modified = datetime.datetime.now()
+        if self.stats_name and self.is_new():
+            counters.record(self.stats_name)
         super(Timestamped, self).put(*args, **kwargs)
 
+    def is_new(self):
+        """
+        True if this entity was not saved before. Subclasses that
+        create new instances to overwrite saved entities override it.
+        """
+        return not self.is_saved()
+
     def update_headers(self, response):
         response['Last-Modified'] = http_datetime(self.modified)
         response['X-Last-Modified-ISO'] = self.modified.isoformat() + 'Z'
@@ -0,0 +1,290 @@
+"""
+Request profiling per endpoint, without the Appstats runtime.
+
+ProfileMiddleware measures the wall time and response size of each
+request, and a post-call hook on the API proxy counts memcache and
+datastore calls and their protocol buffer bytes. The results are
+added to memcache counters for the endpoint (request method and view
+function) in rolling windows of WINDOW_SECONDS, with a histogram of
+wall times for percentiles. Requests slower than SLOW_REQUEST_MS are
+logged with their RPC breakdown.
+"""
+
+import time
+import logging
+import threading
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+PROFILE_PREFIX = 'PRF1'
+WINDOW_SECONDS = 600
+WINDOWS = 6  # Rolling statistics for the last hour.
+SLOW_REQUEST_MS = 1000
+MAX_SLOW_REQUESTS = 20
+# Upper bounds of histogram buckets in milliseconds, the last bucket
+# is for slower requests.
+BUCKETS = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+TOTALS = ['requests', 'ms', 'response_bytes',
+          'memcache_calls', 'memcache_bytes',
+          'datastore_calls', 'datastore_bytes']
+SERVICES = {'memcache': 'memcache', 'datastore_v3': 'datastore'}
+MAX_CAS_RETRIES = 5
+
+# Endpoints that this instance added to the index of each window.
+INDEXED = {}
+
+
+def bucket_index(ms):
+    """
+    Histogram bucket for a wall time in milliseconds.
+
+    >>> bucket_index(5), bucket_index(10), bucket_index(11)
+    (0, 0, 1)
+    >>> bucket_index(1e6) == len(BUCKETS)
+    True
+    """
+    for index, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            return index
+    return len(BUCKETS)
+
+
+def percentile(buckets, fraction):
+    """
+    Upper bound of the bucket that contains this fraction of all
+    requests, or None for the last bucket.
+
+    >>> percentile([5, 4, 1] + [0] * 9, 0.5)
+    10
+    >>> percentile([5, 4, 1] + [0] * 9, 0.95)
+    50
+    >>> percentile([0] * 11 + [1], 0.99)
+    """
+    total = sum(buckets)
+    if not total:
+        return 0
+    count = 0
+    for index, value in enumerate(buckets):
+        count += value
+        if count >= total * fraction:
+            break
+    if index < len(BUCKETS):
+        return BUCKETS[index]
+
+
+def window_name(now=None):
+    if now is None:
+        now = time.time()
+    return str(int(now / WINDOW_SECONDS))
+
+
+def profile_key(window, endpoint, field):
+    return '~'.join((PROFILE_PREFIX, window, endpoint, field))
+
+
+def index_key(window):
+    return '~'.join((PROFILE_PREFIX, window, 'index'))
+
+
+def slow_key():
+    return '~'.join((PROFILE_PREFIX, 'slow'))
+
+
+def rpc_hook(service, call, request, response):
+    """
+    Count API calls of the current request, and their bytes.
+    """
+    profile = getattr(CURRENT, 'profile', None)
+    if profile is None:
+        return
+    name = SERVICES.get(service)
+    if name is None:
+        return
+    profile[name + '_calls'] += 1
+    profile[name + '_bytes'] += request.ByteSize() + response.ByteSize()
+    profile['rpcs'][service + '.' + call] = \
+        profile['rpcs'].get(service + '.' + call, 0) + 1
+
+
+def install_hook():
+    """
+    Add rpc_hook to the API proxy. Test runners may replace the API
+    proxy, so this is checked for every request; Append doesn't add
+    the same key twice.
+    """
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'profiler', rpc_hook)
+
+
+def start():
+    """
+    Start profiling the current request.
+    """
+    install_hook()
+    CURRENT.profile = {
+        'start': time.time(),
+        'endpoint': 'middleware',
+        'rpcs': {},
+        }
+    for name in SERVICES.values():
+        CURRENT.profile[name + '_calls'] = 0
+        CURRENT.profile[name + '_bytes'] = 0
+    return CURRENT.profile
+
+
+def finish(response_bytes):
+    """
+    Stop profiling the current request, and return its profile. The
+    profile is also kept in CURRENT.last for tests and benchmarks.
+    """
+    profile = getattr(CURRENT, 'profile', None)
+    CURRENT.profile = None
+    if profile is None:
+        return None
+    profile['ms'] = int(1000 * (time.time() - profile['start']))
+    profile['response_bytes'] = response_bytes
+    profile['requests'] = 1
+    CURRENT.last = profile
+    return profile
+
+
+def set_endpoint(endpoint):
+    """
+    Name the endpoint of the current request, for requests that are
+    handled without a view function.
+    """
+    profile = getattr(CURRENT, 'profile', None)
+    if profile is not None:
+        profile['endpoint'] = endpoint
+
+
+def add_to_index(window, endpoint):
+    """
+    Add the endpoint to the index of this window, once per instance.
+    """
+    indexed = INDEXED.setdefault(window, set())
+    if endpoint in indexed:
+        return
+    if len(INDEXED) > 1:
+        for other in INDEXED.keys():
+            if other != window:
+                del INDEXED[other]
+    client = memcache.Client()
+    m_key = index_key(window)
+    expires = int(time.time()) + 2 * WINDOW_SECONDS * WINDOWS
+    for attempt in range(MAX_CAS_RETRIES):
+        endpoints = client.gets(m_key)
+        if endpoints is None:
+            if client.add(m_key, [endpoint], expires):
+                break
+        elif endpoint in endpoints:
+            break
+        elif client.cas(m_key, endpoints + [endpoint], expires):
+            break
+    indexed.add(endpoint)
+
+
+def save(profile, now=None):
+    """
+    Add a request profile to the rolling statistics of its endpoint.
+    """
+    window = window_name(now)
+    endpoint = profile['endpoint']
+    add_to_index(window, endpoint)
+    offsets = {}
+    for field in TOTALS:
+        offsets[profile_key(window, endpoint, field)] = profile[field]
+    bucket = 'b%d' % bucket_index(profile['ms'])
+    offsets[profile_key(window, endpoint, bucket)] = 1
+    memcache.offset_multi(offsets, initial_value=0)
+    if profile['ms'] > SLOW_REQUEST_MS:
+        log_slow(profile)
+
+
+def log_slow(profile):
+    """
+    Log a slow request with its RPC breakdown, and keep it in the list
+    of recent slow requests.
+    """
+    rpcs = ', '.join(['%s=%d' % item for item in sorted(profile['rpcs'].items())])
+    logging.warning("Slow request: %s %s %dms (%s)" % (
+            profile['endpoint'], profile.get('path', ''), profile['ms'], rpcs))
+    slow = memcache.get(slow_key()) or []
+    entry = dict(profile)
+    entry['rpcs'] = rpcs
+    slow.insert(0, entry)
+    memcache.set(slow_key(), slow[:MAX_SLOW_REQUESTS])
+
+
+def endpoint_stats(now=None):
+    """
+    Statistics for each endpoint in the last WINDOWS windows, sorted
+    by total wall time.
+    """
+    if now is None:
+        now = time.time()
+    windows = [window_name(now - ago * WINDOW_SECONDS)
+               for ago in range(WINDOWS)]
+    indexes = memcache.get_multi([index_key(window) for window in windows])
+    endpoints = set()
+    for index in indexes.values():
+        endpoints.update(index)
+    fields = TOTALS + ['b%d' % index for index in range(len(BUCKETS) + 1)]
+    keys = [profile_key(window, endpoint, field)
+            for window in windows
+            for endpoint in endpoints
+            for field in fields]
+    values = memcache.get_multi(keys)
+    result = []
+    for endpoint in endpoints:
+        stats = dict.fromkeys(fields, 0)
+        stats['endpoint'] = endpoint
+        for window in windows:
+            for field in fields:
+                key = profile_key(window, endpoint, field)
+                stats[field] += int(values.get(key, 0))
+        if not stats['requests']:
+            continue
+        buckets = [stats['b%d' % index] for index in range(len(BUCKETS) + 1)]
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats[name] = percentile(buckets, fraction)
+        for field in TOTALS[1:]:
+            stats['avg_' + field] = stats[field] / stats['requests']
+        result.append(stats)
+    result.sort(key=lambda stats: -stats['ms'])
+    return result
+
+
+def slow_requests():
+    return memcache.get(slow_key()) or []
+
+
+class ProfileMiddleware(object):
+    """
+    Profile each request, and save the results after the response is
+    ready. This should be the first middleware, so that the profile
+    includes all others.
+    """
+
+    def process_request(self, request):
+        start()['path'] = request.path
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        set_endpoint('%s %s.%s' % (
+                request.method, view_func.__module__, view_func.__name__))
+
+    def process_response(self, request, response):
+        profile = finish(len(response.content))
+        if profile is not None:
+            save(profile)
+        return response
+
+
+# Profile of the current request, if ProfileMiddleware is active.
+CURRENT = threading.local()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
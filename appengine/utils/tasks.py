@@ -0,0 +1,47 @@
+"""
+Run work in the background with the App Engine task queue.
+
+Functions are deferred with google.appengine.ext.deferred, so they
+must be importable at module level and their arguments picklable.
+Task requests are handled by deferred_main.py with Django settings.
+When settings.TASKS_LOCAL is true (e.g. for "manage.py test"), tasks
+are kept in an in-process queue instead, and run_local_tasks executes
+them in order.
+"""
+
+import logging
+
+from django.conf import settings
+
+from google.appengine.ext import deferred
+
+# Pending (func, args, kwargs) when running tasks in-process.
+LOCAL_TASKS = []
+
+
+def defer(func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) later, in a task queue request.
+    Keyword arguments starting with an underscore, e.g. _countdown,
+    are task options.
+    """
+    if settings.TASKS_LOCAL:
+        kwargs = dict([(name, value) for name, value in kwargs.items()
+                       if not name.startswith('_')])
+        LOCAL_TASKS.append((func, args, kwargs))
+        return
+    deferred.defer(func, *args, **kwargs)
+
+
+def run_local_tasks():
+    """
+    Execute tasks from the in-process queue, including any tasks they
+    add, until it is empty. Return the number of tasks executed.
+    """
+    count = 0
+    while LOCAL_TASKS:
+        func, args, kwargs = LOCAL_TASKS.pop(0)
+        logging.info("Running task %s.%s" % (func.__module__, func.__name__))
+        func(*args, **kwargs)
+        count += 1
+    return count
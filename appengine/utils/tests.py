@@ -1,23 +1,37 @@
 import os
 import imp
+import time
 import doctest
+import threading
+
+from mock import Mock
 
 from django.test import TestCase
+from django.utils import simplejson as json
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
 from google.appengine.runtime import apiproxy_errors
 
 from utils.mixins import Timestamped, Migratable, Cacheable
-from utils.mixins.cacheable import CacheHistory
+from utils.mixins.cacheable import CacheHistory, CachedView
 
 from utils.shortcuts import dict_from_attrs
+from utils import channel
+from utils import tasks
+from utils import changes
 
 
 class TestModel(Timestamped, Migratable, Cacheable):
     """Simple datastore model for testing mixins."""
     text = db.TextProperty()
     blob = db.BlobProperty()
+    tags = db.StringListProperty()
+
+    view_methods = Cacheable.view_methods + ('get_text', )
+
+    def get_text(self):
+        return self.text
 
 
 class CacheableTest(TestCase):
@@ -110,6 +124,281 @@ class CacheableTest(TestCase):
         self.assertAlmostEqual(history.average_put_interval(), 0.2)
 
 
+class CachedViewTest(TestCase):
+
+    def setUp(self):
+        self.saved = TestModel(key_name='s', text='s', blob='s',
+                               tags=['one', 'two'])
+        self.saved.put()
+
+    def test_lazy_properties(self):
+        """A cached view should decode properties on first access."""
+        view = TestModel.get_view_by_key_name('s')
+        self.assertTrue(isinstance(view, CachedView))
+        self.assertEqual(view.key().name(), 's')
+        self.assertEqual(view.get_cache_key(), self.saved.get_cache_key())
+        self.assertFalse('text' in view.__dict__)
+        self.assertEqual(view.text, 's')
+        self.assertTrue('text' in view.__dict__)
+        self.assertFalse('blob' in view.__dict__)
+        self.assertEqual(view.tags, ['one', 'two'])
+        self.assertEqual(view.get_text(), 's')
+        self.assertEqual(view.kind(), 'TestModel')
+        self.assertEqual(view.to_protobuf(), self.saved.to_protobuf())
+        # Still a view after reading.
+        self.assertTrue(isinstance(view, CachedView))
+
+    def test_datastore_fallback(self):
+        """Without memcache, a full instance should be returned."""
+        self.saved.cache_delete()
+        entity = TestModel.get_view_by_key_name('s')
+        self.assertTrue(isinstance(entity, TestModel))
+        self.assertEqual(TestModel.get_view_by_key_name('missing'), None)
+
+    def test_promote_on_write(self):
+        """Assignment should promote the view to a full instance."""
+        view = TestModel.get_view_by_key_name('s')
+        view.tags.append('three')
+        view.text = 'changed'
+        self.assertTrue(isinstance(view, TestModel))
+        self.assertEqual(view.tags, ['one', 'two', 'three'])
+        view.put()
+        entity = TestModel.get_by_key_name('s')
+        self.assertEqual(entity.text, 'changed')
+        self.assertEqual(entity.tags, ['one', 'two', 'three'])
+
+    def test_promote_on_method(self):
+        """Methods not listed in view_methods should promote the view."""
+        view = TestModel.get_view_by_key_name('s')
+        view.delete()
+        self.assertTrue(isinstance(view, TestModel))
+        self.assertEqual(TestModel.get_view_by_key_name('s'), None)
+
+
+class ChannelTest(TestCase):
+
+    def setUp(self):
+        # Not an AppTestCase, so drop tasks left over from other tests.
+        del tasks.LOCAL_TASKS[:]
+        self.channel_api = channel.channel
+        channel.channel = Mock()
+        memcache.flush_all()
+        channel.NO_SUBSCRIBERS.clear()
+        channel.PENDING.changes = None
+        self.expires = int(time.time() + 60)
+
+    def tearDown(self):
+        channel.channel = self.channel_api
+
+    def sent(self):
+        """Return a list of (channel_key, message) that were sent."""
+        return [args for (args, kwargs) in
+                channel.channel.send_message.call_args_list]
+
+    def test_dispatch_deferred(self):
+        """The writer should only add a task, not send messages."""
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires)
+        channel.dispatch_subscriptions('myapp/mydoc/', 'PUT', {'sha1': 'x'})
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(tasks.run_local_tasks(), 1)
+        self.assertEqual(len(self.sent()), 1)
+        self.assertEqual(self.sent()[0][0], 'c1')
+
+    def test_children(self):
+        """Blob changes go to parent document subscribers with children."""
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires)
+        channel.add_subscription('myapp/mydoc/', 'c2', self.expires,
+                                 {'children': True})
+        channel.add_subscription('myapp/mydoc/blob/', 'c3', self.expires)
+        channel.dispatch_subscriptions('myapp/mydoc/blob/', 'PUT', {})
+        tasks.run_local_tasks()
+        self.assertEqual(sorted([key for (key, message) in self.sent()]),
+                         ['c2', 'c3'])
+
+    def test_no_subscribers(self):
+        """Writes without subscribers should not add tasks."""
+        channel.add_subscription('myapp/other/', 'c1', self.expires)
+        channel.dispatch_subscriptions('myapp/mydoc/', 'PUT', {})
+        channel.dispatch_subscriptions('myapp/mydoc/blob/', 'PUT', {})
+        self.assertEqual(tasks.LOCAL_TASKS, [])
+        # Apps without any subscriptions are cached in this process.
+        channel.dispatch_subscriptions('otherapp/mydoc/', 'PUT', {})
+        self.assertTrue('otherapp' in channel.NO_SUBSCRIBERS)
+        channel.add_subscription('otherapp/mydoc/', 'c1', self.expires)
+        self.assertFalse('otherapp' in channel.NO_SUBSCRIBERS)
+        channel.dispatch_subscriptions('otherapp/mydoc/', 'PUT', {})
+        self.assertEqual(tasks.run_local_tasks(), 1)
+
+    def test_index(self):
+        """The app index records exact and children subscriptions."""
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires,
+                                 {'children': True})
+        channel.add_subscription('myapp/doc2/blob', 'c2', self.expires)
+        index = memcache.get(channel.subscription_index_key('myapp'))
+        self.assertEqual(sorted(index.keys()),
+                         ['myapp/doc2/blob/', 'myapp/mydoc/',
+                          'myapp/mydoc/*'])
+        self.assertTrue(channel.has_subscribers('myapp/mydoc/'))
+        self.assertTrue(channel.has_subscribers('myapp/mydoc/blob/'))
+        self.assertTrue(channel.has_subscribers('myapp/doc2/blob/'))
+        self.assertFalse(channel.has_subscribers('myapp/doc2/'))
+
+    def test_large_fan_out(self):
+        """Subscribers are sent the same message in batches of tasks."""
+        count = channel.FAN_OUT_BATCH_SIZE * 3 + 1
+        for index in range(count):
+            channel.add_subscription('myapp/mydoc/', 'c%d' % index,
+                                     self.expires)
+        channel.dispatch_subscriptions('myapp/mydoc/', 'PUT', {})
+        # One task for the dispatch, plus one for each batch.
+        self.assertEqual(tasks.run_local_tasks(), 1 + 4)
+        sent = self.sent()
+        self.assertEqual(len(sent), count)
+        self.assertEqual(len(set([message for (key, message) in sent])), 1)
+
+    def test_request_changes(self):
+        """Changes made in one request are sent from one task."""
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires,
+                                 {'children': True})
+        channel.add_subscription('myapp/mydoc/', 'c2', self.expires,
+                                 {'children': True, 'batch': True})
+        middleware = channel.ChannelMiddleware()
+        middleware.process_request(None)
+        for name in ('a', 'b', 'c', 'a'):
+            channel.dispatch_subscriptions('myapp/mydoc/' + name, 'PUT', {})
+        self.assertEqual(tasks.LOCAL_TASKS, [])
+        middleware.process_response(None, None)
+        self.assertEqual(tasks.run_local_tasks(), 1)
+        sent = self.sent()
+        # Legacy subscribers get a message for every change.
+        self.assertEqual(len([1 for (key, message) in sent if key == 'c1']),
+                         4)
+        # Batch subscribers get one message for the changed keys.
+        batch = [json.loads(message) for (key, message) in sent
+                 if key == 'c2']
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batch[0]['method'], 'BATCH')
+        self.assertEqual([change['key'] for change in batch[0]['changes']],
+                         ['mydoc/a', 'mydoc/b', 'mydoc/c'])
+
+    def test_rate_limit(self):
+        """Batch subscribers over the rate limit get coalesced changes."""
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires,
+                                 {'children': True, 'batch': True})
+        count = channel.MAX_CHANNEL_MESSAGES + 3
+        # Keep all changes in the same rate limit window.
+        coalesce_seconds = channel.COALESCE_SECONDS
+        channel.COALESCE_SECONDS = 3600
+        try:
+            for index in range(count):
+                channel.dispatch_subscriptions('myapp/mydoc/%d' % index,
+                                               'PUT', {})
+            tasks.run_local_tasks()
+        finally:
+            channel.COALESCE_SECONDS = coalesce_seconds
+        sent = [json.loads(message) for (key, message) in self.sent()]
+        self.assertEqual(len(sent), channel.MAX_CHANNEL_MESSAGES + 1)
+        self.assertEqual(sent[-1]['method'], 'BATCH')
+        self.assertEqual(len(sent[-1]['changes']), 3)
+
+    def test_expired(self):
+        """Expired subscriptions are removed during dispatch."""
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires)
+        channel.add_subscription('myapp/mydoc/', 'c2', int(time.time() + 1))
+        self.assertEqual(len(channel.get_subscribers('myapp/mydoc/')), 2)
+        shard_key = channel.subscription_shard_key('myapp/mydoc/', 'c2')
+        subscriptions = memcache.get(shard_key)
+        subscriptions['c2']['expires'] = int(time.time() - 1)
+        memcache.set(shard_key, subscriptions)
+        self.assertEqual(channel.get_subscribers('myapp/mydoc/').keys(),
+                         ['c1'])
+        self.assertFalse('c2' in memcache.get(shard_key))
+
+    def test_unsubscribe(self):
+        """Subscribing with expires=0 removes the subscription."""
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires)
+        channel.add_subscription('myapp/mydoc/', 'c1', 0)
+        self.assertEqual(channel.get_subscribers('myapp/mydoc/'), {})
+
+    def test_cas_conflict(self):
+        """A concurrent update to the same shard should not be lost."""
+        shard_key = channel.subscription_shard_key('myapp/mydoc/', 'c1')
+        channel.add_subscription('myapp/mydoc/', 'c1', self.expires)
+        calls = []
+
+        def update(subscriptions):
+            # Another request updates the shard between gets and cas.
+            if not calls:
+                channel.update_subscriptions(
+                    shard_key, lambda subs: subs.update(
+                        {'c2': {'expires': self.expires}}))
+            calls.append(1)
+            subscriptions['c3'] = {'expires': self.expires}
+
+        self.assertTrue(channel.update_subscriptions(shard_key, update))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(memcache.get(shard_key).keys()),
+                         ['c1', 'c2', 'c3'])
+
+    def test_parallel_subscribes(self):
+        """Parallel subscribes to the same key should all be saved."""
+        count = 20
+
+        def subscribe(thread):
+            for index in range(count):
+                channel.add_subscription('myapp/mydoc/',
+                                         'c%d-%d' % (thread, index),
+                                         self.expires)
+
+        threads = [threading.Thread(target=subscribe, args=(thread, ))
+                   for thread in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(channel.get_subscribers('myapp/mydoc/')),
+                         10 * count)
+
+
+class ChangeBusTest(TestCase):
+
+    def setUp(self):
+        self.listener = Mock()
+        self.bus = changes.MemoryBus([self.listener])
+
+    def test_publish(self):
+        """Listeners are called once, and the latest token changes."""
+        self.assertEqual(self.bus.latest('myapp/mydoc/'), None)
+        self.bus.publish('myapp/mydoc/', 'PUT', {'sha1': 'x'})
+        self.assertEqual(self.listener.call_count, 1)
+        self.assertEqual(self.listener.call_args[0],
+                         ('myapp/mydoc/', 'PUT', {'sha1': 'x'}))
+        token = self.bus.latest('myapp/mydoc/')
+        self.assertEqual(token[1], 'x')
+        self.bus.publish('myapp/mydoc/', 'PUT', {'sha1': 'x'})
+        self.assertNotEqual(self.bus.latest('myapp/mydoc/'), token)
+
+    def test_wait_timeout(self):
+        """Wait returns the same token if nothing was published."""
+        started = time.time()
+        self.assertEqual(self.bus.wait('myapp/mydoc/', None, 0.1), None)
+        self.assertTrue(time.time() - started >= 0.1)
+
+    def test_wait_delivered(self):
+        """A waiting thread gets the token of the next publish."""
+        delivered = []
+
+        def waiter():
+            delivered.append(self.bus.wait('myapp/mydoc/', None, 10))
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.01)
+        self.bus.publish('myapp/mydoc/', 'PUT', {'sha1': 'x'})
+        thread.join()
+        self.assertEqual(delivered[0][1], 'x')
+
+
 class DocTest(TestCase):
 
     def ignore_file(self, filename):
@@ -14,6 +14,7 @@ See pf.py --help for more information.
 import re
 import os
 import stat
+import posixpath
 import hmac
 import hashlib
 import urllib
@@ -58,6 +59,9 @@ IGNORE_FILENAMES = ('pf.py', 'pf', PF_FILENAME, OPTIONS_FILENAME, ERROR_FILENAME
                     '.*', '*~', '#*#', '*.bak', '*.rej', '*.orig')
 LOCAL_COMMANDS = ['dir', 'offline', 'info', 'compile', 'make', 'config']
 METAFILE_REMOVE = ('sha1', 'size', 'modified', 'created', 'docid')
+# Relative references to app files in HTML, see versioned_references.
+REFERENCE_REGEX = re.compile(r"""((?:src|href)\s*=\s*["'])([^"':?#]+)(["'])""",
+                             re.IGNORECASE)
 SHA_EXCLUDED = METAFILE_REMOVE + ('application',)
 
 commands = None
@@ -352,6 +356,9 @@ def config():
                       help="Ignore sha1 hashes and get/put all files.")
     parser.add_option('-n', '--noop', action='store_true',
                       help="don't perform update operations")
+    parser.add_option('--versioned', action='store_true',
+                      help="Rewrite references in HTML files to versioned "
+                      "URLs (/_v/<sha1>/path) that browsers cache forever.")
     options, args = parser.parse_args()
 
     if not args:
@@ -396,13 +403,19 @@ def upload_file(filename):
               (filename, intcomma(local_info['size']))
         return
 
+    data = None
+    local_sha1 = local_info['sha1']
+    if options.versioned and filename.endswith('.html'):
+        data = versioned_references(filename, read_local_file(filename))
+        local_sha1 = hashlib.sha1(data).hexdigest()
+
     # Compare if remote file has same hash as local one
     if filename in options.listing:
         info = options.listing[filename]
-        is_equal = info['sha1'] == local_info['sha1']
+        is_equal = info['sha1'] == local_sha1
         if options.verbose:
             print "SHA1 %s (local) %s %s (server) for %s" % \
-                (local_info['sha1'],
+                (local_sha1,
                  is_equal and "==" or "!=",
                  info['sha1'],
                  filename)
@@ -411,9 +424,8 @@ def upload_file(filename):
     elif options.verbose:
         print "Could not find %s on server." % filename
 
-    file = open(get_local_path(filename), 'rb')
-    data = file.read()
-    file.close()
+    if data is None:
+        data = read_local_file(filename)
 
     or_not = options.noop and " (Not!)" or ""
     if not options.quiet:
@@ -430,6 +442,38 @@ def upload_file(filename):
         print "Response: %s" % response.read()
 
 
+def read_local_file(filename):
+    file = open(get_local_path(filename), 'rb')
+    data = file.read()
+    file.close()
+    return data
+
+
+def versioned_references(filename, data):
+    """
+    Replace relative src and href references to other app files with
+    versioned URLs that include the SHA-1 hash of the file, so that
+    the server can let browsers cache them forever. References to
+    HTML files are not changed, because their content may be
+    rewritten too.
+    """
+    def replace(match):
+        path = match.group(2)
+        if path.startswith('/'):
+            target = path.lstrip('/')
+        else:
+            target = posixpath.join(posixpath.dirname(filename), path)
+        target = posixpath.normpath(target)
+        info = options.local_listing.get(target)
+        if (info is None or not info.get('sha1') or target.endswith('.html')
+            or is_data_path(target)):
+            return match.group(0)
+        return match.group(1) + '/_v/%s/%s' % (info['sha1'], target) + \
+            match.group(3)
+
+    return REFERENCE_REGEX.sub(replace, data)
+
+
 def delete_file(filename):
     """
     Delete one file from the server.
@@ -743,6 +787,9 @@ def put_command(args):
 
     paths = options.local_listing.keys()
     paths.sort()
+    if options.versioned:
+        # Upload HTML files last, after the files they reference.
+        paths.sort(key=lambda path: path.endswith('.html'))
     for path in paths:
         if path == META_FILENAME:
             continue
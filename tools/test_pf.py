@@ -107,7 +107,7 @@ class TestPF(unittest.TestCase):
                 'offline', 'vacuum', 'info', 'compile', 'make', 'config']
 
     options = ['help', 'server', 'username', 'password', 'application',
-               'docs', 'verbose', 'quiet', 'raw', 'force', 'noop']
+               'docs', 'verbose', 'quiet', 'raw', 'force', 'noop', 'versioned']
 
     def __init__(self, *args, **kwargs):
         super(TestPF, self).__init__(*args, **kwargs)
@@ -214,6 +214,32 @@ class TestLocal(TestPF):
         self.assertNotEqual(manifest.find("SIGNATURE"), -1, "Missing manifest Signature")
         self.assertNotEqual(manifest.find("AUTOGENERATED"), -1, "Missing AUTOGENERATED in manifest")
 
+    def test_versioned_references(self):
+        class Options(object):
+            pass
+        saved = getattr(pf, 'options', None)
+        pf.options = Options()
+        pf.options.local_listing = dict([(name, {'sha1': self.files[name]['sha1']})
+                                         for name in self.files])
+        try:
+            sha1 = self.files['scripts/test.js']['sha1']
+            html = ('<script src="scripts/test.js"></script>'
+                    '<script src="/scripts/test.js"></script>'
+                    '<a href="index.html">Home</a>'
+                    '<img src="http://example.com/test.txt">'
+                    '<script src="missing.js"></script>')
+            self.assertEqual(pf.versioned_references('index.html', html),
+                             '<script src="/_v/%s/scripts/test.js"></script>'
+                             '<script src="/_v/%s/scripts/test.js"></script>'
+                             '<a href="index.html">Home</a>'
+                             '<img src="http://example.com/test.txt">'
+                             '<script src="missing.js"></script>' % (sha1, sha1))
+            self.assertEqual(pf.versioned_references('scripts/page.html',
+                                                     "<link href='test.js'>"),
+                             "<link href='/_v/%s/scripts/test.js'>" % sha1)
+        finally:
+            pf.options = saved
+
 
 class TestServer(TestPF):
     """